@@ -18,16 +18,29 @@ with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import gzip
-from time import sleep, ctime
+from time import sleep, ctime, time
 from datetime import datetime
-import os, sys, re, subprocess, socket, shlex
-import threading
+import os, sys, re, subprocess, socket, shlex, codecs, json
+import threading, Queue, heapq
+import speech
+from StringIO import StringIO
+from cmd import Cmd
 from tt_attrdict import AttrDict
 from ttapi import TeamtalkServer
-from mycmd import MyCmd, say as mycmd_say, classproperty, ArgumentParser, CommandError
-from TableFormatter import TableFormatter
+from mycmd import MyCmd, say as mycmd_say, shutUp as mycmd_shutUp, classproperty, ArgumentParser, CommandError
+from mycmd import err, redirectThreadOutput, threadOutput, allowInput, mq
+from TableFormatter import TableFormatter, TableStreamer, recordStreamers
 from conf import conf
 from triggers import Triggers
+from actionpolicy import parsePolicy, reasons as dropReasons
+from listcache import ListCache, AccountCache, BanCache
+from filters import compileFilters
+from directory import directory
+from coalesce import parseWindows
+from eventfilter import parseRules
+from perfstats import PerfStats, ProfileWindow, timer
+from eventbus import bus
+from metrics import MetricsServer, parseAddress, render as renderMetrics
 from parmline import ParmLine, TTParms, KeywordParm, IntParm, StringParm, ListParm
 from textblock import TextBlock
 
@@ -55,9 +68,40 @@ class MyTeamtalkServer(TeamtalkServer):
 		self.parent = parent
 		self.silent = 0
 		self.hidden = 0
+		self.groups = set()
+		# Where output for a reply being waited on goes; see sendWithWait().
+		self.replyOutput = None
+		# This server's trigger subscription on the event bus; see subscribe().
+		self.triggerSub = None
 		# TODO: triggers can't be set here because we don't have a
 		# command processor object.
 		TeamtalkServer.__init__(self, *args, **kwargs)
+		self.accountCache = AccountCache(self)
+		self.banCache = BanCache(self)
+		# Commands that change what the caches hold.
+		self._cacheChangers = {
+			"newaccount": self.accountCache,
+			"delaccount": self.accountCache,
+			"ban": self.banCache,
+			"unban": self.banCache
+		}
+
+	def setCacheTTL(self, ttl):
+		"""Set how many seconds account and ban lists are cached (0 for no caching).
+		"""
+		self.accountCache.ttl = ttl
+		self.banCache.ttl = ttl
+
+	def send(self, line):
+		"""Send a command to this server. See TeamtalkServer.send().
+		Commands that change accounts or bans invalidate the cached lists,
+		which are then fetched again in the background.
+		"""
+		TeamtalkServer.send(self, line)
+		words = str(line).split(None, 1)
+		if not words: return
+		cache = self._cacheChangers.get(words[0].lower())
+		if cache: cache.invalidate()
 
 	def outputFromEvent(self, line, raw=False):
 		"""For event output. See output() for details.
@@ -71,32 +115,113 @@ class MyTeamtalkServer(TeamtalkServer):
 			return
 		TeamtalkServer.outputFromEvent(self, line, raw)
 
+	def output(self, line, raw=False, fromEvent=False):
+		"""Print a line about this server. See TeamtalkServer.output() for details.
+		Event output is published to the event bus, for the output and speech subscribers.
+		Output produced while a command waits for its reply goes
+		wherever that command's thread sends its own output.
+		"""
+		if fromEvent and not self.waitID:
+			if not raw: line = "[%s] %s" % (self.shortname, line)
+			bus.publish(self, "_output_", {"text": line}, stage="output")
+			return
+		dest = self.replyOutput
+		if dest is None or not self.waitID:
+			TeamtalkServer.output(self, line, raw, fromEvent)
+			return
+		prev = redirectThreadOutput(dest)
+		try: TeamtalkServer.output(self, line, raw, fromEvent)
+		finally: redirectThreadOutput(prev)
+
+	def sendWithWait(self, line, returnResults=False):
+		"""Send a command and wait for it to complete. See TeamtalkServer.sendWithWait().
+		Notes where the calling thread's output goes so the reply can follow it.
+		"""
+		self.replyOutput = threadOutput()
+		try: return TeamtalkServer.sendWithWait(self, line, returnResults)
+		finally: self.replyOutput = None
+
 	def hookEvents(self, eventline, afterDispatch):
 		"""Called on each event with the event's parmline as a parameter.
 		This method is called twice per event:
 		once before and once after the event is dispatched.
 		The afterDispatch parameter indicates which type of call is occurring.
+		The event is published to the event bus at each call,
+		as received and then as handled; logging and triggers subscribe there.
 		"""
 		TeamtalkServer.hookEvents(self, eventline, afterDispatch)
-		if not afterDispatch:
-			self.logstream.write("%s\n  %s: %s\n" % (
-				datetime.now().ctime(),
-				self.shortname,
-				eventline.initLine.rstrip()
-			))
-			return
-		if eventline.event in ["userbanned", "useraccount"]:
+		bus.publishLine(self, eventline, "handled" if afterDispatch else "received")
+
+	def needsLine(self, event, line):
+		"""Keep lines this server's triggers could match from being filtered out.
+		"""
+		triggers = getattr(self, "triggers", None)
+		return triggers is not None and triggers.needsLine(event, line)
+
+	def reportFilteredTriggers(self, report):
+		"""Call report(text) for each trigger match needing events the event filter would skip.
+		"""
+		flt = self.eventFilter
+		if not flt: return
+		events = set(self.eventNames()) | set(flt.include) | set(flt.exclude)
+		self.triggers.reportFiltered(flt.skips, sorted(events), report)
+
+	def subscribe(self):
+		"""Subscribe this server's triggers to its handled events.
+		Called when the server is added to the server list.
+		"""
+		if self.triggerSub: return
+		# Triggers run on their own thread, but no event may skip them,
+		# so a full queue holds up this server's reader instead of dropping.
+		# A sendWithWait action stuck behind that finishes at its timeout.
+		self.triggerSub = bus.subscribe("triggers " +self.shortname, self.triggerEvent,
+			servers=[self.shortname], block=True
+		)
+
+	def unsubscribe(self):
+		"""Undo subscribe().
+		"""
+		if self.triggerSub: bus.unsubscribe(self.triggerSub)
+		self.triggerSub = None
+
+	def triggerEvent(self, event):
+		"""Apply this server's triggers to a handled event.
+		Runs on the thread of this server's trigger subscription.
+		"""
+		if event.name in ["userbanned", "useraccount"]:
 			# These events are responses to listing commands and
 			# should not trigger activity.
 			return
+		eventline = event.line
+		coalescing = self.coalescer and self.coalescer.triggers == "coalesced"
+		if getattr(eventline, "merged", None):
+			# A flushed coalescing window; see hookCoalesced().
+			if not coalescing: return
+		elif coalescing and getattr(eventline, "coalesced", None):
+			return
+		timing = PerfStats.enabled
+		if timing: started = timer()
 		try: self.triggers.apply(eventline)
 		except Exception as e:
 			self.output("Trigger failure: %s" % (str(e)))
+		if timing: self.perf.recordTriggers(event.name, timer() -started)
+
+	def hookCoalesced(self, cw, record):
+		"""Publish a flushed coalescing window as an event of its own,
+		which is logged, and triggered on if triggers see only coalesced events.
+		The synthesized event carries the record's state as of the flush.
+		"""
+		parms = dict((k,v) for k,v in record.items() if isinstance(v, basestring))
+		eventline = ParmLine(cw.key[0], parms)
+		eventline.merged = cw.count
+		bus.publishLine(self, eventline, "received")
+		bus.publishLine(self, eventline, "handled")
 
 class Servers(dict):
 	def __init__(self):
 		self.logfilename = "ttcom.log"
 		self.logstream = NullLog()
+		self.logSub = None
 		if os.path.exists(self.logfilename):
 			self.logstream = open(self.logfilename, "a")
 		else:
@@ -118,6 +243,8 @@ class Servers(dict):
 		self.thFlusher.daemon = True
 		self.thFlusher.name = "flusher"
 		self.thFlusher.start()
+		# The log is the record replays read, so it never drops events.
+		self.logSub = bus.subscribe("log", self.logEvent, stage="received", block=True)
 		self.logGlobalEvent("starting")
 
 	def logGlobalEvent(self, event):
@@ -127,6 +254,26 @@ class Servers(dict):
 			event
 		))
 
+	def logEvent(self, event):
+		"""Log a line received from a server.
+		Runs on the thread of the log subscription.
+		Updates merged by coalescing are logged together when their window closes.
+		"""
+		eventline = event.line
+		if getattr(eventline, "coalesced", None): return
+		server = event.server
+		timing = PerfStats.enabled
+		if timing: started = timer()
+		merged = getattr(eventline, "merged", None)
+		if merged: text = "%s (%d updates merged)" % (str(eventline).rstrip(), merged)
+		else: text = eventline.initLine.rstrip()
+		self.logstream.write("%s\n  %s: %s\n" % (
+			datetime.fromtimestamp(event.time).ctime(),
+			server.shortname,
+			text
+		))
+		if timing: server.perf.recordLog(event.name, timer() -started)
+
 	def flusher(self):
 		"""Flushes the log periodically.
 		Runs in the Flusher() thread.
@@ -140,6 +287,7 @@ class Servers(dict):
 		"""
 		self[newServer.shortname] = newServer
 		newServer.logstream = self.logstream
+		newServer.subscribe()
 
 	def remove(self, shortname):
 		"""Stop and remove a server connection.
@@ -149,24 +297,77 @@ class Servers(dict):
 			shortname = shortname.shortname
 		server = self[shortname]
 		server.disconnect()
+		server.unsubscribe()
 		del self[shortname]
 
 class TTComCmd(MyCmd):
+	# Most servers a fan-out command works on at once; see fanOut().
+	maxFanOut = 16
+
 	@classproperty
 	def speakEvents(cls):
 		"Whether to speak events."
 		return conf.option("speakEvents")
 
+	def _getCurServer(self):
+		try: return self._threadServer.server
+		except AttributeError: return self._curServer
+	def _setCurServer(self, server):
+		if hasattr(self._threadServer, "server"): self._threadServer.server = server
+		else: self._curServer = server
+	curServer = property(_getCurServer, _setCurServer, None, "Current server, kept per thread during fan-outs")
+
 	def __init__(self, noAutoLogins=False, logins=[]):
 		if logins:
 			noAutoLogins = True
 		self.noAutoLogins = noAutoLogins
 		self.servers = Servers()
+		self._threadServer = threading.local()
 		self.curServer = None
+		# The daemon control socket, while TTCom runs headless; see daemon.py.
+		self.controlServer = None
+		bus.report = self.msg
+		self.outputSub = bus.subscribe("output", self.showEvent, stage="output")
+		self.speechSub = bus.subscribe("speech", self.speakEvent, stage="output",
+			where=lambda event: self.speaking()
+		)
 		MyCmd.__init__(self)
 		TeamtalkServer.write = self.msg
 		TeamtalkServer.writeEvent = self.msgFromEvent
 		self.readServers(logins)
+		self.startMetrics()
+
+	def showEvent(self, event):
+		"""Print event output. Runs on the thread of the output subscription.
+		Nothing prints while TTCom runs as a daemon.
+		"""
+		if self.controlServer: return
+		self.msg(event.parms.text, fromEvent=True)
+
+	def speaking(self):
+		"""Return True if events are to be spoken; see the speakEvents option.
+		"""
+		try: return int(self.speakEvents or 0) != 0
+		except ValueError: return False
+
+	def speakEvent(self, event):
+		"""Speak event output. Runs on the thread of the speech subscription.
+		"""
+		speech.queue.say(event.parms.text)
+
+	def startMetrics(self):
+		"""Serve Prometheus metrics if the metrics option says where.
+		"""
+		self.metricsServer = None
+		spec = conf.option("metrics")
+		if not spec: return
+		try:
+			ms = MetricsServer(parseAddress(spec), lambda: renderMetrics(self.servers.values(), mq))
+			ms.start()
+		except (ValueError, socket.error) as e:
+			print "Metrics not served on %s: %s" % (spec, str(e))
+			return
+		self.metricsServer = ms
 
 	def precmd(self, line):
 		"""Handles >-to-"server " translation.
@@ -191,6 +392,13 @@ class TTComCmd(MyCmd):
 			autoLogin = 0
 			silent = 0
 			hidden = 0
+			groups = set()
+			cacheTTL = 300
+			coalesce = {}
+			coalesceTriggers = "each"
+			coalesceDetail = "net"
+			includeEvents = {}
+			excludeEvents = {}
 			triggers = Triggers(self.onecmd)
 			doLogin = False
 			for k,v in pairs:
@@ -203,6 +411,24 @@ class TTComCmd(MyCmd):
 					silent = int(v)
 				elif k.lower() == "hidden":
 					hidden = int(v)
+				elif k.lower() == "cachettl":
+					cacheTTL = int(v)
+				elif k.lower() == "events":
+					includeEvents = parseRules(v)
+				elif k.lower() == "ignoreevents":
+					excludeEvents = parseRules(v)
+				elif k.lower() == "coalesce":
+					coalesce = parseWindows(v)
+				elif k.lower() == "coalescetriggers":
+					coalesceTriggers = v.strip().lower()
+					if coalesceTriggers not in ("each", "coalesced"):
+						raise ValueError("coalesceTriggers must be each or coalesced")
+				elif k.lower() == "coalescedetail":
+					coalesceDetail = v.strip().lower()
+					if coalesceDetail not in ("net", "all"):
+						raise ValueError("coalesceDetail must be net or all")
+				elif k.lower() == "group":
+					groups = set([g.strip().lower() for g in v.split(",") if g.strip()])
 				elif k.lower().startswith("match ") or k.lower().startswith("action "):
 					which,what = k.split(None, 1)
 					if "." in what:
@@ -213,6 +439,9 @@ class TTComCmd(MyCmd):
 						triggers.addMatch(triggerName, ParmLine(v), subname)
 					else:  # action
 						triggers.addAction(triggerName, v, subname)
+				elif k.lower().startswith("policy "):
+					# Rate limits, dedup, and batching of a trigger's actions; see actionpolicy.py.
+					triggers.setPolicy(k.split(None, 1)[1], parsePolicy(v))
 				else:
 					loginParms[k.lower()] = v
 			newServer = MyTeamtalkServer(self, host, shortname, loginParms)
@@ -222,6 +451,11 @@ class TTComCmd(MyCmd):
 				newServer.silent = silent
 			if hidden:
 				newServer.hidden = hidden
+			newServer.groups = groups
+			newServer.setCacheTTL(cacheTTL)
+			newServer.setCoalescing(coalesce, coalesceTriggers, coalesceDetail)
+			newServer.setEventFilter(includeEvents, excludeEvents)
+			reportInvalid = lambda text: self.msg("%s: %s" % (shortname, text))
 			# TODO: This is an odd way to get this link made.
 			triggers.server = newServer
 			newServer.triggers = triggers
@@ -245,14 +479,28 @@ class TTComCmd(MyCmd):
 				if oldServer.hidden != newServer.hidden:
 					print "hidden for %s changing to %d" % (shortname, newServer.hidden)
 				oldServer.hidden = newServer.hidden
+				oldServer.groups = newServer.groups
+				oldServer.setCacheTTL(cacheTTL)
+				oldServer.setCoalescing(coalesce, coalesceTriggers, coalesceDetail)
+				oldFilter = oldServer.eventFilter
+				oldServer.setEventFilter(includeEvents, excludeEvents)
+				filterChanged = (oldFilter is None) != (oldServer.eventFilter is None) or (oldFilter
+					and (oldFilter.include, oldFilter.exclude) != (includeEvents, excludeEvents)
+				)
 				if oldServer.triggers != newServer.triggers:
 					print "Updating triggers for %s" % (shortname)
-				oldServer.triggers = newServer.triggers
+					oldServer.triggers = newServer.triggers
+					triggers.reportInvalid(reportInvalid)
+					filterChanged = True
+				if filterChanged: oldServer.reportFilteredTriggers(reportInvalid)
+				# Unchanged triggers are kept, with their hit counts.
 				# TODO: Again, weird way to set this link up.
 				oldServer.triggers.server = oldServer
 			else:
 				self.curServer = newServer
 				self.servers.add(newServer)
+				triggers.reportInvalid(reportInvalid)
+				newServer.reportFilteredTriggers(reportInvalid)
 				doLogin = int(newServer.autoLogin)
 			if ((doLogin and not self.noAutoLogins)
 			or shortname in logins
@@ -289,24 +537,20 @@ class TTComCmd(MyCmd):
 		connected (this can happen on servers that don't
 		allow a user to see other users unless in a channel with them).
 		"""
-		# If checkAll is True, all servers' users are checked (not well tested or used).
-		if checkAll:
-			users = []
-			map(lambda s: users.extend(s.users),
-				self.servers
-			)
-		else:
-			users = self.curServer.users
-		if u.startswith("#") and u[1:].isdigit():
-			users = filter(lambda u1:
-				u1.userid == u[1:]
-			, users.values())
-		else:
-			users = filter(lambda u1:
-				u.lower() in self.curServer.nonEmptyNickname(u1, True).lower()
-			, users.values())
+		# If checkAll is True, all servers' users are checked.
+		if checkAll: servers = self.servers.values()
+		else: servers = [self.curServer]
+		users = []
+		owners = {}
+		for server in servers:
+			if u.startswith("#") and u[1:].isdigit():
+				found = filter(None, [server.users.get(u[1:])])
+			else:
+				found = server.findUsers(u)
+			for user in found: owners[id(user)] = server
+			users.extend(found)
 		if checkAll:
-			flt = lambda u1: u1.server.shortname +"/" +self.curServer.nonEmptyNickname(u1, True)
+			flt = lambda u1: owners[id(u1)].shortname +"/" +owners[id(u1)].nonEmptyNickname(u1, True)
 		else:
 			flt = lambda u1: self.curServer.nonEmptyNickname(u1, True)
 		return self.selectMatch(users, "Select a User", flt)
@@ -323,27 +567,26 @@ class TTComCmd(MyCmd):
 		channel exactly, except for case.
 		If noPrompt is passed and True, a KeyError is thrown if more than one channel matches.
 		"""
-		channels = self.curServer.channels
+		channels = self.curServer.snapshot().channels
 		if c == "/":
 			return channels["1"]
 		elif c.startswith("/") and c.endswith("/"):
 			# Exact match (except for case) required.
 			channels = filter(lambda c1:
 				c.lower() == self.curServer.channelname(c1["channelid"]).lower()
-			, channels.values())
+			, self.curServer.findChannels(c))
 		elif "=" in c:
 			# Specific parameter search like chanid=5.
-			channels = filter(lambda chan: self.filterPasses(chan, [c]), channels.values())
+			channels = self.compileFilters([c]).select(channels.values())
 		elif "/" in c:
 			# Containment match against full channel paths, case ignored.
-			channels = filter(lambda c1:
-				c.lower() in self.curServer.channelname(c1["channelid"]).lower()
-			, channels.values())
+			channels = self.curServer.findChannels(c)
 		else:
 			# Match against channel names (no paths), case and final / ignored.
+			# Any such match is also a match against the full path.
 			channels = filter(lambda c1:
 				c.lower() in self.curServer.channelname(c1["channelid"])[:-1].rpartition("/")[2].lower()
-			, channels.values())
+			, self.curServer.findChannels(c))
 		# selectMatch handles the 0 and 1 match cases properly without prompting.
 		if not noPrompt or len(channels) <= 1:
 			return self.selectMatch(channels, "Select a Channel",
@@ -445,9 +688,18 @@ TTCom version %ver%
 		With one argument, changes the current server.
 		With more arguments, runs command against a server without
 		changing the current one.
+		serverName can also be a comma-separated list of servers,
+		in which case the command runs against all of them at once
+		as with the All command.
 		"""
 		args = shlex.split(line)
 		newServer = None
+		if len(args) >= 1 and "," in args[0]:
+			servers = [self.serverMatch(s.strip()) for s in args.pop(0).split(",") if s.strip()]
+			if not args: raise SyntaxError("A command is required with a list of servers")
+			tmp,line = line.split(None, 1)
+			self.fanOut(servers, line)
+			return
 		if len(args) >= 1:
 			newServer = self.serverMatch(args.pop(0))
 		if len(args) == 0:
@@ -464,6 +716,113 @@ TTCom version %ver%
 		finally:
 			self.curServer = oldServer
 
+	def do_all(self, line):
+		"""Run a command against many servers at once.
+		Usage: all [-j<count>] [group] command
+		Without a group, the command runs against all logged-in servers not marked hidden.
+		With a group, it runs against the logged-in servers in that group;
+		servers join groups through a group= line in their ttcom.conf section,
+		such as group=europe,public.
+		Up to 16 servers are worked on at a time unless -j gives another count.
+		Output is collected per server and printed server by server in name order,
+		with the time each server took and any error.
+		Commands that would ask a question, such as a selection among several matches,
+		fail instead of asking.
+		Example: all -j32 ban list 24.114.
+		"""
+		args = line.split(None, 1)
+		maxThreads = self.maxFanOut
+		if args and args[0].startswith("-j"):
+			try: maxThreads = int(args[0][2:])
+			except ValueError: raise SyntaxError("Invalid thread count: " +args[0])
+			args = args[1:] and args[1].split(None, 1)
+		groups = set()
+		for server in self.servers.values(): groups |= server.groups
+		group = None
+		if len(args) == 2 and args[0].lower() in groups:
+			group = args.pop(0).lower()
+			args = args[0].split(None, 1)
+		if not args: raise SyntaxError("A command is required")
+		line = " ".join(args)
+		servers = []
+		offs = []
+		for shortname in sorted(self.servers):
+			server = self.servers[shortname]
+			if group:
+				if group not in server.groups: continue
+			elif server.hidden: continue
+			if server.state != "loggedIn":
+				offs.append(shortname)
+				continue
+			servers.append(server)
+		if offs:
+			self.msg("Not logged in: " +", ".join(offs))
+		if not servers:
+			raise CommandError("No servers to run against")
+		self.fanOut(servers, line, maxThreads)
+
+	def fanOut(self, servers, line, maxThreads=None):
+		"""Run a command line against each of the given servers concurrently.
+		At most maxThreads servers (default maxFanOut) are worked on at once.
+		Output is printed per server, in the order the servers are given,
+		once all servers are done.
+		"""
+		if not maxThreads or maxThreads < 1: maxThreads = self.maxFanOut
+		q = Queue.Queue()
+		for server in servers: q.put(server)
+		results = {}
+		def worker():
+			while True:
+				try: server = q.get_nowait()
+				except Queue.Empty: return
+				results[server.shortname] = self._runOn(server, line)
+		threads = []
+		start = time()
+		for i in range(min(maxThreads, len(servers))):
+			th = threading.Thread(target=worker)
+			th.daemon = True
+			th.name = "fanOut_" +th.name
+			th.start()
+			threads.append(th)
+		for th in threads:
+			# Short joins keep Ctrl+C working.
+			while th.isAlive(): th.join(0.2)
+		nerrors = 0
+		for server in servers:
+			elapsed,output,error = results[server.shortname]
+			buf = "[%s] (%0.2f sec)" % (server.shortname, elapsed)
+			if error:
+				nerrors += 1
+				buf += " " +error
+			self.msg(buf)
+			output = output.rstrip()
+			if output: print output
+		self.msg("%d servers in %0.2f sec, %d with errors" % (
+			len(servers),
+			time() -start,
+			nerrors
+		))
+
+	def _runOn(self, server, line):
+		"""Run one command against one server from a fan-out thread.
+		Returns (seconds taken, collected output, error message or None).
+		"""
+		buf = StringIO()
+		redirectThreadOutput(buf)
+		allowInput(False)
+		self._threadServer.server = server
+		error = None
+		start = time()
+		try:
+			Cmd.onecmd(self, self.precmd(line))
+		except Exception:
+			error = err()
+		finally:
+			del self._threadServer.server
+			allowInput(True)
+			redirectThreadOutput(None)
+		return (time() -start, buf.getvalue(), error)
+
 	def do_refresh(self, line=""):
 		"""Refresh server info and update connections as necessary.
 		"""
@@ -498,8 +857,7 @@ TTCom version %ver%
 			if server.state != "loggedIn":
 				offs.setdefault(server.state, [])
 				offs[server.state].append(shortname)
-			elif len(server.users) <= 1:
-				# 1 allows for this user.
+			elif not server.otherUserCount:
 				empties.append(shortname)
 			else:
 				sums.append(shortname)
@@ -532,8 +890,7 @@ TTCom version %ver%
 					state += self.conn.state
 				offs.setdefault(state, [])
 				offs[state].append(shortname)
-			elif len(server.users) <= 1:
-				# 1 allows for this user.
+			elif not server.otherUserCount:
 				continue
 			else:
 				sums.append(shortname)
@@ -551,14 +908,11 @@ TTCom version %ver%
 		"""Short-form summary for one server.
 		"""
 		# Users other than me and that are actuallly in a channel.
-		users = filter(lambda u:
-			(u.get("channelid") or u.get("chanid"))
-			and u.userid != server.me.userid
-		, server.users.values())
-		if not len(users):
+		occupancy = server.occupancy.copy()
+		occupancy.pop(None, None)
+		if not occupancy:
 			return
-		users = map(lambda u: server.nonEmptyNickname(u, False), users)
-		users.sort(key=lambda u: u.lower())
+		users = [entry[2] for entry in heapq.merge(*occupancy.values())]
 		line = "%s (%d): %s" % (
 			server.shortname,
 			len(users),
@@ -669,8 +1023,8 @@ TTCom version %ver%
 		for u in args[:-1]:
 			if u.startswith("@"):
 				chan = self.channelMatch(u[1:])
-				cid = self.curServer.channels[chan["channelid"]]["channelid"]
-				for u1 in self.curServer.users.values():
+				cid = chan["channelid"]
+				for u1 in self.curServer.snapshot().users.values():
 					if u1.get("channelid") == cid:
 						users.append(u1)
 			else:
@@ -842,20 +1196,30 @@ TTCom version %ver%
 
 	def ban_list(self, args):
 		"Use -h to get a full syntax description for this subcommand."
-		parser = ArgumentParser(prog="ban list", description="List all or selected bans.", epilog="Examples: ban list, ban li bob, ban li 24.114., ban li channel=/, ban li !nickname=Bob")
-		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific field, or just value to match against any field. Fields include bantime, username, nickname, ipaddr, and channel. More than one filter can be given. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces.')
+		parser = ArgumentParser(prog="ban list", description="List all or selected bans.", epilog="Examples: ban list, ban li bob, ban li 24.114., ban li channel=/, ban li !nickname=Bob, ban li -o bans.csv")
+		parser.add_argument("-r", "--refresh", action="store_true", help="Get the list from the server even if a recent copy is cached.")
+		self.addOutputArguments(parser)
+		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific field, or just value to match against any field. Fields include bantime, username, nickname, ipaddr, and channel. More than one filter can be given. fieldname*=text, fieldname~=regexp, fieldname>=number (or >, <=, <), and fieldname&mask (e.g., userrights&0x2) match substrings, regular expressions, numeric ranges, and bits. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces.')
 		opts = parser.parse_args(args)
-		bans = self.getBans()
+		flt = self.compileFilters(opts.filter, True)
 		if opts.filter: ttl = "Matching Bans"
 		else: ttl = "Bans"
-		parmsets = []
-		for ban in bans:
-			parms = ban.parms
-			if not self.filterPasses(parms, opts.filter, True): continue
-			parmsets.append(parms)
-		tbl = TableFormatter(ttl, [
-			"Username", "Nickname", "IP Address", "Time", "Channel"
-		])
+		cols = ["Username", "Nickname", "IP Address", "Time", "Channel"]
+		cache = self.curServer.banCache
+		streaming = opts.refresh or not cache.isFresh()
+		if streaming:
+			# Print bans as they arrive instead of collecting them all first.
+			parmsets = (ban.parms for ban in self.streamRequest("listbans")
+				if flt(ban.parms)
+			)
+		else:
+			bans = cache.get()
+			parmsets = flt.select([ban.parms for ban in bans], cache.index)
+		if self.outputFormat(opts) != "table":
+			self.exportRecords(opts, parmsets, ["username", "nickname", "ipaddr", "bantime", "channel"])
+			return
+		if streaming: tbl = TableStreamer(self.msg, ttl, cols, [16, 20, 15, 24])
+		else: tbl = TableFormatter(ttl, cols)
 		for parms in parmsets:
 			tbl.addRow([
 				parms.username, parms.nickname,
@@ -863,20 +1227,17 @@ TTCom version %ver%
 				ctime(float(parms.bantime)),
 				parms.channel
 			])
-		self.msg(tbl.format(2))
+		if streaming: tbl.finish()
+		else: self.msg(tbl.format(2))
 
 	def ban_add(self, args):
 		"Use -h to get a full syntax description for this subcommand."
 		parser = ArgumentParser(prog="ban add", description="Add a new ban (does not also kick; see kb for this)", epilog="Examples: ban add bob, ban add nickname=Bob, ban add 24.114., ban add -k 295")
 		parser.add_argument("-k", "--kick", action="store_true", help="Also kick the user(s) being banned.")
-		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific user field, or just value to match against any field. Fields include userid, username, usertype, userdata, nickname, ipaddr, udpaddr, clientname, version, packetprotocol, statusmode, statusmsg, sublocal, and subpeer (not all of these are likely to prove useful).  More than one filter can be given. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces. As a special case, a plain integer like 295 matches an exact userid.')
+		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific user field, or just value to match against any field. Fields include userid, username, usertype, userdata, nickname, ipaddr, udpaddr, clientname, version, packetprotocol, statusmode, statusmsg, sublocal, and subpeer (not all of these are likely to prove useful).  More than one filter can be given. fieldname*=text, fieldname~=regexp, fieldname>=number (or >, <=, <), and fieldname&mask (e.g., userrights&0x2) match substrings, regular expressions, numeric ranges, and bits. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces. As a special case, a plain integer like 295 matches an exact userid.')
 		opts = parser.parse_args(args)
-		users = self.curServer.users
-		parmsets = []
-		for user in users:
-			parms = users[user]
-			if not self.filterPasses(parms, opts.filter, True): continue
-			parmsets.append(parms)
+		server = self.curServer
+		parmsets = self.compileFilters(opts.filter, True).select(server.users.values(), server.userIndex)
 		flt = lambda u1: self.curServer.nonEmptyNickname(u1, True)
 		parmsets = self.selectMatch(parmsets, "Select One or More Users", flt, allowMultiple=True)
 		for user in parmsets:
@@ -893,13 +1254,11 @@ TTCom version %ver%
 	def ban_delete(self, args):
 		"Use -h to get a full syntax description for this subcommand."
 		parser = ArgumentParser(prog="ban delete", description="Delete all or selected bans.", epilog="Examples: ban delete, ban del bob, ban del 24.114., ban del !nickname=Bob")
-		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific field, or just value to match against any field. Fields include bantime, username, nickname, ipaddr, and channel. More than one filter can be given. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces.')
+		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific field, or just value to match against any field. Fields include bantime, username, nickname, ipaddr, and channel. More than one filter can be given. fieldname*=text, fieldname~=regexp, fieldname>=number (or >, <=, <), and fieldname&mask (e.g., userrights&0x2) match substrings, regular expressions, numeric ranges, and bits. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces.')
 		opts = parser.parse_args(args)
-		bans0 = self.getBans()
-		bans = []
-		for ban in bans0:
-			if not self.filterPasses(ban.parms, opts.filter, True): continue
-			bans.append(ban.parms)
+		flt = self.compileFilters(opts.filter, True)
+		cache = self.curServer.banCache
+		bans = flt.select([ban.parms for ban in cache.get()], cache.index)
 		if not bans:
 			raise CommandError("No matching bans")
 		# Select from remaining candidates exactly which ban(s) to delete.
@@ -919,33 +1278,35 @@ TTCom version %ver%
 		"""
 		self.do_ban("add -k "+str(line))
 
-	def getAccounts(self):
+	def getAccounts(self, refresh=False):
 		"""Return the set of accounts on this server.
 		Returns a dict of ParmLines, one for each account.
 		The keys are the usernames.
+		The list is cached per server (see cacheTTL in ttcom.conf);
+		pass refresh=True to fetch it from the server regardless.
 		"""
-		accts = self.request("listaccounts")
-		# Remove the final Ok event.
-		resp = accts.pop()
-		if resp.event != "ok":
-			# TODO: This ignores any but the last response line.
-			raise CommandError(resp)
-		d = {}
-		for acct in accts:
-			if acct.event == "ok": continue
-			d[acct.parms.username] = acct
-		return d
-
-	def getBans(self):
+		return self.curServer.accountCache.accounts(refresh)
+
+	def getBans(self, refresh=False):
 		"""Returns the bans on this server as a list of ParmLine objects.
 		The lines are the responses to the "listbans" command, one line per ban.
+		The list is cached per server (see cacheTTL in ttcom.conf);
+		pass refresh=True to fetch it from the server regardless.
 		"""
-		bans = self.request("listbans")
-		resp = bans.pop()
-		if resp.event != "ok":
+		return list(self.curServer.banCache.get(refresh))
+
+	def streamRequest(self, line):
+		"""Send a listing command and yield its response lines as they arrive.
+		The final Ok line is not yielded; a final line that is not an Ok raises CommandError.
+		Line can be a text line or a ParmLine object.
+		"""
+		prev = None
+		for parmline in self.curServer.sendWithStream(line):
+			if prev is not None: yield prev
+			prev = parmline
+		if prev is None or prev.event != "ok":
 			# TODO: This ignores any but the last response line.
-			raise CommandError(resp)
-		return bans
+			raise CommandError(prev or "No response to %s" % (str(line).split(None, 1)[0]))
 
 	def do_account(self, line):
 		"""Account management. Requires admin privileges.
@@ -955,68 +1316,111 @@ TTCom version %ver%
 		args = TTParms(line, True)
 		self.dispatchSubcommand("account_", args)
 
+	def compileFilters(self, filters, nullIsAnonymousAccount=False):
+		"""Compile a filter list, as typed for the listing commands, into a FilterSet.
+		See filters.compileFilters() for the filter syntax.
+		"""
+		try: return compileFilters(filters, nullIsAnonymousAccount)
+		except ValueError as e: raise CommandError(str(e))
+
 	def filterPasses(self, parms, filters, nullIsAnonymousAccount=False):
 		"""Returns True if the given parameter set passes the given filter list and False if not.
+		Code that checks many records should call compileFilters() once instead.
 		"""
 		if not filters: return True
-		if isinstance(parms, dict): vals = parms.values()
-		else: vals = parms
-		try: vals = ", ".join(vals)
-		except TypeError:
-			vals1 = []
-			for val in vals:
-				val1 = None
-				try: val1 = unicode(val)
-				except:
-					try: val1 = str(val)
-					except: pass
-				if val1 is None: continue
-				vals1.append(val1)
-			vals = ", ".join(vals1)
-		for filter in filters:
-			# ToDo: Bit of a kludge here.
-			if filter.startswith('"') and filter.endswith('"'): filter = filter[1:-1]
-			elif filter.endswith('"') and '="' in filter: filter = filter.replace('="', '=', 1)[:-1]
-			if "=" in filter:
-				fname,fvalWanted = filter.split("=", 1)
-				invert = False
-				if fname.startswith("!"):
-					fname = fname[1:]
-					invert = True
-				fvalActual = parms[fname]
-				if not invert and fvalActual != fvalWanted: return False
-				elif invert and fvalActual == fvalWanted: return False
-			elif filter == "" and nullIsAnonymousAccount:
-				# Special case for matching the anonymous account in an account list.
-				if parms["username"] != "": return False
-			else:
-				if filter.lower() not in vals.lower(): return False
-		return True
+		return self.compileFilters(filters, nullIsAnonymousAccount).passes(parms)
+
+	def addOutputArguments(self, parser):
+		"""Add the -f/--format and -o/--output options of the listing subcommands to parser.
+		"""
+		parser.add_argument("-f", "--format", choices=["table"] +sorted(recordStreamers), help="Output format: table (default), or csv, tsv, or json (one JSON object per line) for use by other programs. These write raw field values.")
+		parser.add_argument("-o", "--output", metavar="FILE", help="Write csv, tsv, or json output to FILE instead of the screen. The format defaults from the file extension.")
+
+	def outputFormat(self, opts):
+		"""Return the output format requested by the options from addOutputArguments().
+		"""
+		fmt = opts.format
+		if not fmt and opts.output:
+			ext = os.path.splitext(opts.output)[1].lower().lstrip(".")
+			if ext == "jsonl": ext = "json"
+			if ext in recordStreamers: fmt = ext
+			else: raise CommandError("Use -f to specify csv, tsv, or json output for %s" % (opts.output))
+		if fmt == "table" and opts.output:
+			raise CommandError("Only csv, tsv, and json output can be written to a file")
+		return fmt or "table"
+
+	def exportRecords(self, opts, parmsets, fields, exclude=()):
+		"""Write the records from parmsets as they come, in the machine-readable format opts ask for.
+		fields lists the fields to write; None means all but those in exclude.
+		Output goes to the file given in opts or to the screen.
+		"""
+		streamerClass = recordStreamers[self.outputFormat(opts)]
+		f = None
+		if opts.output:
+			try: f = codecs.open(opts.output, "w", "utf-8")
+			except IOError as e: raise CommandError(str(e))
+			write = lambda line: f.write(line +"\n")
+		else:
+			write = self.writeRaw
+		try:
+			out = streamerClass(write, fields, exclude)
+			for parms in parmsets:
+				out.addRecord(parms)
+			out.finish()
+		finally:
+			if f: f.close()
+		if f:
+			self.msg("{0} records written to {1}".format(out.rowcount, opts.output))
+
+	@staticmethod
+	def writeRaw(line):
+		"""Print line as is, in UTF-8, to the screen or wherever this thread's output goes.
+		Unlike msg(), this does no wrapping and keeps non-ASCII characters,
+		as machine-readable output needs.
+		"""
+		if isinstance(line, unicode): line = line.encode("utf-8")
+		sys.stdout.write(line +"\n")
 
 	def account_list(self, args):
 		"Use -h to get a full syntax description for this subcommand."
-		parser = ArgumentParser(prog="account list", description="List all or selected accounts.", epilog="Examples: account list, acc li -a, acc li usertype=1, acc li -l doug, acc li !userrights=259591")
+		parser = ArgumentParser(prog="account list", description="List all or selected accounts.", epilog="Examples: account list, acc li -a, acc li usertype=1, acc li -l doug, acc li !userrights=259591, acc li -e -o accounts.json")
 		parser.add_argument("-a", "--admin", action="store_true", help="List only admin accounts (usertype=2).")
 		parser.add_argument("-l", "--long", action="store_true", help="Long listing; include all non-empty fields except passwords.")
 		parser.add_argument("-e", "--everything", action="store_true", help="Full listing; include all fields, even empty fields, except passwords. Useful for determining what fields exist.")
 		parser.add_argument("-p", "--passwords", action="store_true", help="Includes passwords in output.")
-		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific field, or just value to match against any field. Fields include username, password, usertype, userdata, userrights, note, initchan, opchannels, and audiocodeclimit. More than one filter can be given. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces. As a special case, "" matches the anonymous account.')
+		parser.add_argument("-r", "--refresh", action="store_true", help="Get the list from the server even if a recent copy is cached.")
+		self.addOutputArguments(parser)
+		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific field, or just value to match against any field. Fields include username, password, usertype, userdata, userrights, note, initchan, opchannels, and audiocodeclimit. More than one filter can be given. fieldname*=text, fieldname~=regexp, fieldname>=number (or >, <=, <), and fieldname&mask (e.g., userrights&0x2) match substrings, regular expressions, numeric ranges, and bits. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces. As a special case, "" matches the anonymous account.')
 		opts = parser.parse_args(args)
 		if opts.admin: opts.filter.append("usertype=2")
-		accts = self.getAccounts()
+		flt = self.compileFilters(opts.filter, True)
 		if opts.filter: ttl = "Matching User Accounts"
 		else: ttl = "User Accounts"
-		parmsets = []
-		for username in sorted(accts):
-			acct = accts[username]
-			parms = acct.parms
-			if not self.filterPasses(parms, opts.filter, True): continue
-			parmsets.append(parms)
+		cache = self.curServer.accountCache
+		streaming = opts.refresh or not cache.isFresh()
+		if streaming:
+			# Print accounts as they arrive instead of collecting them all first.
+			parmsets = (acct.parms for acct in self.streamRequest("listaccounts")
+				if flt(acct.parms)
+			)
+		else:
+			accts = cache.accounts()
+			parmsets = flt.select([accts[username].parms for username in sorted(accts)], cache.index)
+		if self.outputFormat(opts) != "table":
+			if opts.long or opts.everything: fields = None
+			else: fields = ["username", "usertype", "userrights", "note"]
+			if opts.passwords:
+				if fields: fields.insert(1, "password")
+				exclude = ()
+			else: exclude = ("password",)
+			self.exportRecords(opts, parmsets, fields, exclude)
+			return
 		if not opts.long and not opts.everything:
 			# Short, tabular listing.
 			cols = ["Username", "Type", "Rights"]
 			if opts.passwords: cols.append("Password")
-			tbl = TableFormatter(ttl, cols)
+			if streaming: tbl = TableStreamer(self.msg, ttl, cols, [16, 7, 7])
+			else: tbl = TableFormatter(ttl, cols)
 			for parms in parmsets:
 				row = ([
 					parms.username,
@@ -1027,25 +1431,34 @@ TTCom version %ver%
 				tbl.addRow(row)
 				if parms.note.strip():
 					tbl.addRow("        " +parms.note.strip())
-			self.msg(tbl.format(2))
+			if streaming: tbl.finish()
+			else: self.msg(tbl.format(2))
 			return
 		# Long, multiline listing showing all or all non-empty fields.
-		if not parmsets:
-			self.msg("{0}:  0".format(ttl))
-			return
-		buf = "{0} ({1}):\n".format(ttl, str(len(parmsets)))
+		if not streaming:
+			parmsets = list(parmsets)
+			if not parmsets:
+				self.msg("{0}:  0".format(ttl))
+				return
+			self.msg("{0} ({1}):".format(ttl, str(len(parmsets))))
+		else:
+			self.msg("{0}:".format(ttl))
+		count = 0
 		for parms in parmsets:
+			count += 1
 			if opts.passwords:
-				buf += 'Account username "{0}" type {1} password "{2}"\n'.format(parms.username, parms.usertype, parms.password)
+				buf = 'Account username "{0}" type {1} password "{2}"\n'.format(parms.username, parms.usertype, parms.password)
 			else:
-				buf += 'Account username "{0}" type {1}\n'.format(parms.username, parms.usertype)
+				buf = 'Account username "{0}" type {1}\n'.format(parms.username, parms.usertype)
 			for k,v in sorted(parms.items()):
 				if k.lower() in ["username", "usertype", "password", "note"]: continue
 				if not opts.everything and (not v or (v.isdigit() and not int(v))): continue
 				if not opts.everything and "chan" in k.lower() and v == "[]": continue
 				buf += "    {0} {1}\n".format(k, v)
 			if parms.note: buf += 'Note: "{0}"\n'.format(parms.note)
-		self.msg(buf)
+			self.msg(buf.rstrip("\n"))
+		if streaming:
+			self.msg("{0}:  {1}".format(ttl, count))
 
 	def account_add(self, args):
 		"Use -h to get a full syntax description for this subcommand."
@@ -1055,20 +1468,15 @@ TTCom version %ver%
 		parser.add_argument("usertype", help="1 for regular account, 2 for admin account, or the username of an account to use for user rights (TT5 only).")
 		parser.add_argument("field", nargs="*", help="fieldname=value pairs to set other fields for the account. More than one pair may be specified. Example fields include note and userdata. Use quotes if a field value contains spaces. Warning: If you specify an invalid field name, such as by misspelling a field name, the field value will be ignored and will not be set on the account.")
 		opts = parser.parse_args(args)
-		acctDict = self.getAccounts()
-		pat = r'''[\s.,?/;:@#$%^&*'"!+=_-]+'''
-		u0 = re.sub(pat, '', opts.username.lower())
-		for username in acctDict.keys():
-			if username == opts.username: raise CommandError('Account "{0}" already exists'.format(opts.username))
-			if username.lower() == opts.username.lower():
-				if not self.confirm('Warning: There is already an account named "{0}" (same name but different letter casing). Proceed anyway (y/n)?'.format(username)):
-					return
-				else: continue
-			u1 = re.sub(pat, '', username.lower())
-			if u1 == u0:
-				if not self.confirm('Warning: There is already an account similarly named "{0}". Proceed anyway (y/n)?'.format(username)):
-					return
-				else: continue
+		cache = self.curServer.accountCache
+		acctDict = cache.accounts()
+		if acctDict.has_key(opts.username): raise CommandError('Account "{0}" already exists'.format(opts.username))
+		for username in cache.sameLetters(opts.username):
+			if not self.confirm('Warning: There is already an account named "{0}" (same name but different letter casing). Proceed anyway (y/n)?'.format(username)):
+				return
+		for username in cache.similar(opts.username):
+			if not self.confirm('Warning: There is already an account similarly named "{0}". Proceed anyway (y/n)?'.format(username)):
+				return
 		userRights = None
 		if self.curServer.is5():
 			# Default user rights as of TeamTalk5Classic 5.2.1.4781. [DGL, 2017-04-04
@@ -1104,16 +1512,15 @@ TTCom version %ver%
 		"Use -h to get a full syntax description for this subcommand."
 		parser = ArgumentParser(prog="account delete", description="Delete one or more existing accounts, with confirmation", epilog="Examples: account delete, acc del -a, acc del usertype=1, acc del !userrights=259591")
 		parser.add_argument("-a", "--admin", action="store_true", help="Consider only admin accounts (usertype=1).")
-		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific field, or just value to match against any field. More than one filter can be given. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces. As a special case, "" matches the anonymous account.')
+		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific field, or just value to match against any field. More than one filter can be given. fieldname*=text, fieldname~=regexp, fieldname>=number (or >, <=, <), and fieldname&mask (e.g., userrights&0x2) match substrings, regular expressions, numeric ranges, and bits. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces. As a special case, "" matches the anonymous account.')
 		opts = parser.parse_args(args)
 		if opts.admin: opts.filter.append("usertype=2")
-		accts = self.getAccounts()
+		flt = self.compileFilters(opts.filter, True)
+		cache = self.curServer.accountCache
+		accts = cache.accounts()
 		acctDict = {}
-		for username in sorted(accts):
-			acct = accts[username]
-			parms = acct.parms
-			if not self.filterPasses(parms, opts.filter, True): continue
-			acctDict[username] = parms
+		for parms in flt.select([accts[username].parms for username in sorted(accts)], cache.index):
+			acctDict[parms.username] = parms
 		if not acctDict:
 			raise CommandError("No matching accounts")
 		# Select from remaining candidates exactly which account(s) to delete.
@@ -1166,21 +1573,27 @@ TTCom version %ver%
 
 	def channel_list(self, args):
 		"Use -h to get a full syntax description for this subcommand."
-		parser = ArgumentParser(prog="channel list", description="List all or selected channels.", epilog="Examples: channel list, chan li protected=1, chan li !type=1")
+		parser = ArgumentParser(prog="channel list", description="List all or selected channels.", epilog="Examples: channel list, chan li protected=1, chan li !type=1, chan li -f csv")
 		parser.add_argument("-l", "--long", action="store_true", help="Long listing; include all non-empty fields except passwords.")
 		parser.add_argument("-e", "--everything", action="store_true", help="Full listing; include all fields, even empty fields, except passwords. Useful for determining what fields exist.")
 		parser.add_argument("-p", "--passwords", action="store_true", help="Includes passwords in output.")
-		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific field, or just value to match against any field. Useful fields include name, topic, protected, maxusers, and type. More than one filter can be given. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces.')
+		self.addOutputArguments(parser)
+		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific field, or just value to match against any field. Useful fields include name, topic, protected, maxusers, and type. More than one filter can be given. fieldname*=text, fieldname~=regexp, fieldname>=number (or >, <=, <), and fieldname&mask (e.g., userrights&0x2) match substrings, regular expressions, numeric ranges, and bits. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces.')
 		opts = parser.parse_args(args)
-		chans = self.curServer.channels
+		chans = self.curServer.snapshot().channels
 		if opts.filter: ttl = "Matching Channels"
 		else: ttl = "Channels"
-		parmsets = []
 		# ToDo: Sorting by chanid is not so useful.
-		for chanid in sorted(chans):
-			parms = chans[chanid]
-			if not self.filterPasses(parms, opts.filter): continue
-			parmsets.append(parms)
+		parmsets = self.compileFilters(opts.filter).select([chans[chanid] for chanid in sorted(chans)])
+		if self.outputFormat(opts) != "table":
+			if opts.long or opts.everything: fields = None
+			else: fields = ["chanid", "channel", "protected", "type", "maxusers", "topic"]
+			if opts.passwords:
+				if fields: fields.insert(2, "password")
+				exclude = ()
+			else: exclude = ("password", "oppassword")
+			self.exportRecords(opts, parmsets, fields, exclude)
+			return
 		if not opts.long and not opts.everything:
 			# Short, tabular listing.
 			if opts.passwords:
@@ -1266,6 +1679,11 @@ TTCom version %ver%
 		"""
 		mycmd_say(line)
 
+	def do_hush(self, line=""):
+		"""Stop speaking and discard any speech not yet spoken.
+		"""
+		mycmd_shutUp()
+
 	def do_system(self, line):
 		"""Run a system command in a subshell.
 		"""
@@ -1284,6 +1702,30 @@ TTCom version %ver%
 		motd = TTParms(motd, True).pop(0).value
 		self.msg(motd)
 
+	def do_where(self, line):
+		"""Show where users are connected, across all servers, by nickname, username, or IP address.
+		Usage: where <nickname, username, or IP address>
+		Case, spaces, and punctuation in names are ignored.
+		Exact matches are shown if there are any; otherwise, names and
+		addresses that start with what was typed.
+		No server is asked; the answer comes from user events already received.
+		"""
+		line = line.strip()
+		if not line:
+			raise SyntaxError("A nickname, username, or IP address must be specified")
+		found = []
+		for server,userid in directory.find(line):
+			user = server.users.get(userid)
+			if not user: continue
+			found.append((server.shortname.lower(), server.nicknameKey(user, True),
+				"%s: %s" % (server.shortname, server.nonEmptyNickname(user, True))
+			))
+		if not found:
+			self.msg("No matching users")
+			return
+		found.sort()
+		self.msg("\n".join([f[2] for f in found]))
+
 	def do_whoIs(self, line=""):
 		"""Show information about a user.
 		Syntax: whoIs <name>, where <name> can be a full or partial user name.
@@ -1337,11 +1779,11 @@ TTCom version %ver%
 		channel = u.pop("channel", "")
 		if channelid or channel:
 			if not channel:
-				channel = self.curServer.channels[channelid].channel
+				channel = self.curServer.snapshot().channels[channelid].channel
 			buf += "\nOn channel %s (%s)" % (channelid, channel)
 		server = u.pop("server", None)
 		if server:
-			channels = server.channels.values()
+			channels = server.snapshot().channels.values()
 		else:
 			channels = []
 		for which in [
@@ -1422,10 +1864,11 @@ TTCom version %ver%
 		line = line.strip()
 		if not line:
 			# List all ops on server.
-			for u in sorted(server.users.values(), key=lambda u1: server.nonEmptyNickname(u1)):
+			snap = server.snapshot()
+			for u in sorted(snap.users.values(), key=server.nicknameKey):
 				userid = u.userid
 				matches = filter(lambda c:
-					userid in (c.get(k) or []), server.channels.values()
+					userid in (c.get(k) or []), snap.channels.values()
 				)
 				matches = ", ".join(map(lambda c: c.channel, matches))
 				if matches:
@@ -1471,7 +1914,7 @@ TTCom version %ver%
 		# List ops for just this user.
 		userid = u.userid
 		matches = filter(lambda c:
-			userid in (c.get(k) or []), server.channels.values()
+			userid in (c.get(k) or []), server.snapshot().channels.values()
 		)
 		matches = ", ".join(map(lambda c: c.channel, matches))
 		if matches:
@@ -1484,7 +1927,7 @@ TTCom version %ver%
 		"""List the admins currently on server and where they are and come from.
 		"""
 		channelname = self.curServer.channelname
-		for u in self.curServer.users.values():
+		for u in self.curServer.snapshot().users.values():
 			if not u.usertype or int(u.usertype) != 2: continue
 			ch = None
 			if u.chanid: ch = channelname(u.chanid)
@@ -1551,11 +1994,216 @@ TTCom version %ver%
 		"""
 		return self.curServer.sendWithWait(line, True)
 
+	def do_perf(self, line):
+		"""Show where event handling time goes, by server and event type.
+		Run without arguments for the top consumers, or type a subcommand and -h for help with that subcommand.
+		Timing is off until "perf on" and costs next to nothing while off.
+		perf bus shows how far behind each event bus subscriber is, such as logging or a server's triggers.
+		Examples: perf on, perf show -n 10, perf reset, perf dump --json -o perf.json, perf profile 30s, perf bus.
+		"""
+		args = TTParms(line, True)
+		if not args: args = ["show"]
+		self.dispatchSubcommand("perf_", args)
+
+	def perf_on(self, args):
+		"Start timing event handling on all servers."
+		PerfStats.enabled = True
+		self.msg("Event timing on")
+
+	def perf_off(self, args):
+		"Stop timing event handling. What was collected is kept until perf reset."
+		PerfStats.enabled = False
+		self.msg("Event timing off")
+
+	def perf_reset(self, args):
+		"Discard collected event timings on all servers."
+		for server in self.servers.values():
+			server.perf.reset()
+		self.msg("Event timings cleared")
+
+	def perfServers(self, shortnames):
+		"""Return the servers named in shortnames, or all servers if none are named.
+		"""
+		if not shortnames: return self.servers.values()
+		servers = []
+		for shortname in shortnames:
+			try: servers.append(self.servers[shortname])
+			except KeyError: raise CommandError("No server named %s" % (shortname))
+		return servers
+
+	def perf_show(self, args):
+		"Use -h to get a full syntax description for this subcommand."
+		parser = ArgumentParser(prog="perf show", description="Show the servers and event types that take the most time.")
+		parser.add_argument("-n", "--top", type=int, default=20, help="How many rows to show (default 20).")
+		parser.add_argument("server", nargs="*", help="Shortnames of servers to include; all servers if none.")
+		opts = parser.parse_args(args)
+		servers = self.perfServers(opts.server)
+		rows = []
+		for server in servers:
+			for event,stats in server.perf.events.items():
+				rows.append((stats.total, server.shortname, event, stats))
+		rows.sort(reverse=True)
+		alltime = sum([row[0] for row in rows]) or 1
+		buf = []
+		if not PerfStats.enabled: buf.append("Event timing is off; use perf on to start it.")
+		buf.append(", ".join(["%s %0.1f lines/sec" % (server.shortname, server.perf.linesPerSecond())
+			for server in sorted(servers, key=lambda s: s.shortname.lower())
+			if server.perf.lines
+		]))
+		cols = ["Server", "Event", "Count", "Total ms", "Share", "Handler ms", "Max ms", "Trigger ms", "Log ms", "Parse ms"]
+		tbl = TableFormatter("Top Event Consumers", cols)
+		ms = lambda secs: "%0.1f" % (secs *1000)
+		for total,shortname,event,stats in rows[:opts.top]:
+			tbl.addRow([shortname, event, stats.count, ms(total),
+				"%0.1f%%" % (100 *total /alltime),
+				ms(stats.handler), ms(stats.handlerMax), ms(stats.triggers),
+				ms(stats.log), ms(stats.parse)
+			])
+		buf.append(tbl.format(2))
+		self.msg("\n".join([b for b in buf if b]))
+
+	def perf_bus(self, args):
+		"Use -h to get a full syntax description for this subcommand."
+		parser = ArgumentParser(prog="perf bus", description="Show the queue and counts of each event bus subscriber, slowest first.")
+		opts = parser.parse_args(args)
+		subs = sorted(bus.subscriptions, key=lambda sub: (-sub.maxLag, sub.name))
+		cols = ["Subscriber", "Queued", "Delivered", "Handled", "Dropped", "Errors", "Max lag ms", "Slow"]
+		tbl = TableFormatter("Event Subscribers", cols)
+		for sub in subs:
+			tbl.addRow([sub.name, sub.depth, sub.delivered, sub.handled, sub.dropped, sub.errors,
+				"%0.1f" % (sub.maxLag *1000),
+				"yes" if sub.slow else ""
+			])
+		self.msg(tbl.format(2))
+
+	def perf_dump(self, args):
+		"Use -h to get a full syntax description for this subcommand."
+		parser = ArgumentParser(prog="perf dump", description="Dump all collected event timings, in seconds.")
+		parser.add_argument("-j", "--json", action="store_true", help="Dump as JSON.")
+		parser.add_argument("-o", "--output", metavar="FILE", help="Write to FILE instead of the screen.")
+		parser.add_argument("server", nargs="*", help="Shortnames of servers to include; all servers if none.")
+		opts = parser.parse_args(args)
+		servers = self.perfServers(opts.server)
+		data = dict([(server.shortname, server.perf.toDict()) for server in servers])
+		if opts.json:
+			text = json.dumps({"enabled": PerfStats.enabled, "servers": data}, indent=1, sort_keys=True)
+		else:
+			buf = []
+			for shortname in sorted(data):
+				d = data[shortname]
+				buf.append("%s: %d lines, %0.1f lines/sec" % (shortname, d["lines"], d["linesPerSecond"]))
+				for event,stats in sorted(d["events"].items()):
+					buf.append("    %s: %s" % (event, ", ".join(["%s %s" % (k, v) for k,v in sorted(stats.items())])))
+			text = "\n".join(buf)
+		if not opts.output:
+			self.msg(text)
+			return
+		try: f = codecs.open(opts.output, "w", "utf-8")
+		except IOError as e: raise CommandError(str(e))
+		try: f.write(text +"\n")
+		finally: f.close()
+		self.msg("Event timings written to %s" % (opts.output))
+
+	def perf_profile(self, args):
+		"Use -h to get a full syntax description for this subcommand."
+		parser = ArgumentParser(prog="perf profile", description="Profile event handling on all servers with cProfile for a while, then show the functions taking the most time. Other commands can be used meanwhile.")
+		parser.add_argument("-n", "--top", type=int, default=30, help="How many functions to show (default 30).")
+		parser.add_argument("duration", help="How long to profile, like 30s or 2m; seconds if no unit is given.")
+		opts = parser.parse_args(args)
+		m = re.match(r'^(\d+(?:\.\d+)?)\s*([smh]?)$', opts.duration.strip().lower())
+		if not m: raise CommandError("Invalid duration: %s" % (opts.duration))
+		seconds = float(m.group(1)) *{"": 1, "s": 1, "m": 60, "h": 3600}[m.group(2)]
+		if PerfStats.profileWindow:
+			raise CommandError("A profile is already in progress")
+		report = lambda text: self.msg(text, fromEvent=True)
+		PerfStats.profileWindow = ProfileWindow(seconds, report, opts.top)
+		self.msg("Profiling event handling for %g seconds" % (seconds))
+
+	def do_triggers(self, line):
+		"""Show how often each trigger matches and what it costs.
+		Run without arguments for the costliest triggers, or type a subcommand and -h for help with that subcommand.
+		Counts start when a server's triggers are loaded and survive config reloads that leave them unchanged.
+		Dropped counts firings whose actions a trigger's policy dropped (see actionpolicy.py); -d shows them by reason.
+		Examples: triggers stats, triggers stats -d simon, triggers stats --dead, triggers reset.
+		"""
+		args = TTParms(line, True)
+		if not args: args = ["stats"]
+		self.dispatchSubcommand("triggers_", args)
+
+	def triggers_stats(self, args):
+		"Use -h to get a full syntax description for this subcommand."
+		parser = ArgumentParser(prog="triggers stats", description="Show each trigger's evaluations, hits, and time spent matching and acting, costliest first.")
+		parser.add_argument("-n", "--top", type=int, default=20, help="How many triggers to show (default 20).")
+		parser.add_argument("-s", "--sort", choices=["cost", "hits", "evaluations", "dropped", "name"], default="cost", help="What to sort by (default cost).")
+		parser.add_argument("--dead", action="store_true", help="Show only triggers that have never fired.")
+		parser.add_argument("-d", "--detail", action="store_true", help="Also show each match and each action's time histogram.")
+		parser.add_argument("server", nargs="*", help="Shortnames of servers to include; all servers if none.")
+		opts = parser.parse_args(args)
+		rows = []
+		for server in self.perfServers(opts.server):
+			for d in server.triggers.stats():
+				if opts.dead and d["hits"]: continue
+				rows.append((server.shortname, d))
+		if opts.sort == "name":
+			rows.sort(key=lambda row: (row[0].lower(), row[1]["name"].lower()))
+		else:
+			rows.sort(key=lambda row: row[1][opts.sort], reverse=True)
+		rows = rows[:opts.top]
+		ms = lambda secs: "%0.1f" % (secs *1000)
+		when = lambda t: datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S") if t else ""
+		cols = ["Server", "Trigger", "Evaluations", "Hits", "Last hit", "Match ms", "Action ms", "Cost ms", "Dropped"]
+		tbl = TableFormatter("Never Fired Triggers" if opts.dead else "Trigger Costs", cols)
+		for shortname,d in rows:
+			tbl.addRow([shortname, d["name"], d["evaluations"], d["hits"], when(d["lastHit"]),
+				ms(d["matchSeconds"]), ms(d["actionSeconds"]), ms(d["cost"]), d["dropped"]
+			])
+		buf = [tbl.format(2)]
+		if opts.detail:
+			cols = ["Server", "Trigger", "Match", "Evaluations", "Checks", "Hits", "Last hit", "ms"]
+			tbl = TableFormatter("Matches", cols)
+			for shortname,d in rows:
+				for m in d["matches"]:
+					tbl.addRow([shortname, d["name"], m["name"], m["evaluations"], m["checks"],
+						m["hits"], when(m["lastHit"]), ms(m["seconds"])
+					])
+			buf.append(tbl.format(2))
+			cols = ["Server", "Trigger", "Action", "Runs", "Total ms", "Max ms", "Times"]
+			tbl = TableFormatter("Actions", cols)
+			for shortname,d in rows:
+				for a in d["actions"]:
+					tbl.addRow([shortname, d["name"], a["name"], a["count"],
+						ms(a["total"]), ms(a["max"]), a["histogram"]
+					])
+			buf.append(tbl.format(2))
+			cols = ["Server", "Trigger", "Policy"] +["Dropped (%s)" % (reason) for reason in dropReasons]
+			tbl = TableFormatter("Action Policies", cols)
+			for shortname,d in rows:
+				p = d["policy"]
+				if not p: continue
+				tbl.addRow([shortname, d["name"], p["policy"]] +[p[reason] for reason in dropReasons])
+			buf.append(tbl.format(2))
+		self.msg("\n".join(buf))
+
+	def triggers_reset(self, args):
+		"Use -h to get a full syntax description for this subcommand."
+		parser = ArgumentParser(prog="triggers reset", description="Discard trigger hit counts and timings.")
+		parser.add_argument("server", nargs="*", help="Shortnames of servers to reset; all servers if none.")
+		opts = parser.parse_args(args)
+		for server in self.perfServers(opts.server):
+			server.triggers.resetStats()
+		self.msg("Trigger statistics cleared")
+
 	def do_option(self, line=""):
 		"""Get or set a TTCom option by its name.  Valid options:
 			queueMessages: Set non-zero to make messages print only when Enter is pressed.
 				This keeps events from disrupting input lines.
-			speakEvents: Set non-zero to make events speak through MacOS on arrival.
+			speakEvents: Set non-zero to make events speak on arrival.
+				Bursts of similar events are spoken as one summary, messages are spoken before logins and channel changes,
+				and the hush command discards anything not yet spoken.
+			metrics: Where to serve Prometheus metrics: a port, host:port, or Unix socket path.
+				Only 127.0.0.1 is used unless a host is given. Takes effect when TTCom starts.
+			control: The control socket path when TTCom runs as a daemon (ttcom.py -d).
+				The default is ttcom.sock in the current directory.
 		Type with no parameters for a list of all options and their values.
 		"""
 		optname,sep,newval = line.partition(" ")
@@ -1564,7 +2212,9 @@ TTCom version %ver%
 		if not newval: newval = None
 		opts = [
 			("queueMessages", "Queue messages on arrival and print on Enter."),
-			("speakEvents", "Speak events through MacOS on arrival")
+			("speakEvents", "Speak events on arrival"),
+			("metrics", "Where to serve Prometheus metrics"),
+			("control", "Control socket path for daemon mode")
 		]
 		if not optname:
 			lst = []
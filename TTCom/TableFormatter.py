@@ -1,6 +1,7 @@
 """Formatter of plain-text tabular data.
 Given optional (but common) column headers and rows of cells, produces a nicely formatted text output.
 Rows that are not cells are treated as strings and printed across all columns.
+Also streaming writers of records as CSV, TSV, or JSON lines, for output meant for other programs.
 
 Copyright (C) 2011-2017 Doug Lee
 
@@ -19,22 +20,38 @@ with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
+import json
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
 class TableFormatter(object):
 	"""Usage:
 		tbl = TableFormatter(title[, colHeaders])
 		tbl.addRow(...)  # each a row of cells or a string to print across all columns)
 		print tbl.format([gutterWidth])
+	Cells are converted to strings and column widths updated as rows are added,
+	so format() makes one pass over the rows.
 	"""
 	def __init__(self, title="", colheaders=[]):
 		self.title = title
-		self.colheaders = colheaders
+		self.colheaders = [unicode(hdr) for hdr in colheaders]
+		self.widths = [len(hdr) for hdr in self.colheaders]
 		self.rows = []
 		self.rowcount = 0
 
 	def addRow(self, row, excludeFromCount=False):
+		if isinstance(row, basestring):
+			# Printed across all columns and never counted.
+			self.rows.append(row)
+			return
+		row = [unicode(cell) for cell in row]
+		widths = self.widths
+		for i,cell in enumerate(row):
+			if i < len(widths):
+				if len(cell) > widths[i]: widths[i] = len(cell)
+			else: widths.append(len(cell))
 		self.rows.append(row)
-		# Exclude row from count when requested and also when it's not a list--i.e., it prints ignoring columns.
-		if not excludeFromCount and row.__class__.__dict__.has_key("__iter__"):
+		if not excludeFromCount:
 			self.rowcount += 1
 
 	def format(self, gutterwidth=2):
@@ -48,37 +65,170 @@ class TableFormatter(object):
 		if not len(self.rows):
 			if not self.title: return ""
 			return self.title +":  0"
-		if self.colheaders:
-			widths = [len(unicode(hdr)) for hdr in self.colheaders]
-		elif len(self.rows):
-			widths = [len(unicode(cell)) for cell in self.rows[0]]
-		for row in self.rows:
-			# Skip rows that have no columns.
-			if not row.__class__.__dict__.has_key("__iter__"): continue
-			for i,cell in enumerate(row):
-				widths[i] = max(widths[i], len(unicode(cell)))
-		tabs = True
-		gutter = "\t"
-		if gutterwidth:
-			tabs = False
-			gutter = " " * gutterwidth
-		result = ""
+		widths = self.widths
+		tabs = not gutterwidth
+		if tabs: gutter = "\t"
+		else: gutter = " " * gutterwidth
+		lines = []
 		lmargin = ""
 		if self.title:
-			result = "%s (%d):\n" % (self.title, self.rowcount)
+			lines.append("%s (%d):" % (self.title, self.rowcount))
 			lmargin = "    "
 		allRows = []
 		if self.colheaders: allRows.append(self.colheaders)
 		allRows.extend(self.rows)
 		for row in allRows:
-			if not row.__class__.__dict__.has_key("__iter__"):
-				result += lmargin +"    " +row +"\n"
+			if isinstance(row, basestring):
+				lines.append(lmargin +"    " +row)
 				continue
-			fields = []
-			for i,cell in enumerate(row):
-				if tabs: fmt = "%s"
-				else: fmt = "%-" +unicode(widths[i]) +"s"
-				fields.append( fmt % (cell))
-			result += lmargin +gutter.join(fields) +"\n"
-		return result
+			if tabs: fields = row
+			else: fields = [cell.ljust(widths[i]) for i,cell in enumerate(row)]
+			lines.append(lmargin +gutter.join(fields))
+		lines.append("")
+		return "\n".join(lines)
+
+class TableStreamer(object):
+	"""Writes a table a row at a time, for tables too large to collect before printing.
+	Usage:
+		tbl = TableStreamer(write, title[, colHeaders[, widths]])
+		tbl.addRow(...)  # written immediately
+		tbl.finish()  # writes the row count
+	write is called with each line of output.
+	Column widths cannot depend on rows not yet seen, so each column is
+	as wide as its header or its entry in widths, whichever is larger.
+	A longer cell pushes the rest of its row to the right.
+	"""
+	def __init__(self, write, title="", colheaders=[], widths=None, gutterwidth=2):
+		self.write = write
+		self.title = title
+		self.colheaders = colheaders
+		self.rowcount = 0
+		self.widths = [len(unicode(hdr)) for hdr in colheaders]
+		if widths:
+			for i,width in enumerate(widths):
+				if i < len(self.widths): self.widths[i] = max(self.widths[i], width)
+				else: self.widths.append(width)
+		self.gutter = " " * gutterwidth
+		self.lmargin = ""
+		if title:
+			self.write("%s:" % (title))
+			self.lmargin = "    "
+		if colheaders: self._writeCells(colheaders)
+
+	def _writeCells(self, row):
+		fields = []
+		for i,cell in enumerate(row):
+			cell = unicode(cell)
+			if i < len(self.widths): cell = cell.ljust(self.widths[i])
+			fields.append(cell)
+		self.write(self.lmargin +self.gutter.join(fields).rstrip())
+
+	def addRow(self, row, excludeFromCount=False):
+		"""Write one row: a list of cells, or a string to print across all columns.
+		"""
+		if isinstance(row, basestring):
+			self.write(self.lmargin +"    " +row)
+			return
+		if not excludeFromCount: self.rowcount += 1
+		self._writeCells(row)
+
+	def finish(self):
+		"""Write the closing row count.
+		"""
+		if self.title: self.write("%s:  %d" % (self.title, self.rowcount))
+		else: self.write("%d" % (self.rowcount))
+
+class RecordStreamer(object):
+	"""Abstract base for writers of machine-readable records, one per line, as they are added.
+	Usage:
+		out = CSVStreamer(write[, fields])
+		out.addRecord(parms)  # written immediately
+		out.finish()
+	fields lists the record fields to write, in order.
+	If fields is None, the first record's fields are used, sorted,
+	except for those listed in exclude.
+	write is called with each line of output.
+	There is no title or row count; rowcount says how many records were written.
+	Subclasses must define writeRecord().
+	"""
+	__metaclass__ = ABCMeta
+
+	def __init__(self, write, fields=None, exclude=()):
+		self.write = write
+		self.fields = fields
+		self.exclude = exclude
+		self.rowcount = 0
+		if fields is not None: self.start()
+
+	def addRecord(self, parms):
+		if self.fields is None:
+			self.fields = sorted([k for k in parms.keys() if k not in self.exclude])
+			self.start()
+		self.rowcount += 1
+		self.writeRecord([(field, parms.get(field)) for field in self.fields])
+
+	def start(self):
+		"""Write anything that precedes the first record.
+		"""
+		pass
+
+	@abstractmethod
+	def writeRecord(self, items):
+		"""Write one record given as a list of (field, value) pairs.
+		"""
+
+	def finish(self):
+		"""Write anything that follows the last record.
+		"""
+		pass
+
+	@staticmethod
+	def text(val):
+		if val is None: return u""
+		if isinstance(val, basestring): return val
+		return unicode(val)
+
+class CSVStreamer(RecordStreamer):
+	"""Writes records as comma-separated values with a header line.
+	"""
+	mustQuote = set(',"\r\n')
+
+	def quote(self, val):
+		val = self.text(val)
+		if (self.mustQuote.intersection(val)
+		or val != val.strip()):
+			return '"' +val.replace('"', '""') +'"'
+		return val
+
+	def start(self):
+		self.write(",".join([self.quote(field) for field in self.fields]))
+
+	def writeRecord(self, items):
+		self.write(",".join([self.quote(val) for field,val in items]))
+
+class TSVStreamer(RecordStreamer):
+	"""Writes records as tab-separated values with a header line.
+	Tabs, newlines, and backslashes in values are written as \\t, \\n, and \\\\.
+	"""
+	def escape(self, val):
+		val = self.text(val)
+		return val.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+	def start(self):
+		self.write("\t".join([self.escape(field) for field in self.fields]))
+
+	def writeRecord(self, items):
+		self.write("\t".join([self.escape(val) for field,val in items]))
+
+class JSONLinesStreamer(RecordStreamer):
+	"""Writes each record as a JSON object on its own line.
+	Fields missing from a record are left out of its object.
+	"""
+	def writeRecord(self, items):
+		self.write(json.dumps(OrderedDict([item for item in items if item[1] is not None]), ensure_ascii=False))
 
+recordStreamers = {
+	"csv": CSVStreamer,
+	"tsv": TSVStreamer,
+	"json": JSONLinesStreamer,
+}
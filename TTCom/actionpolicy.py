@@ -0,0 +1,189 @@
+"""Rate limits, deduplication, and batching of trigger actions.
+A trigger's policy is set in its server's configuration section like its
+matches and actions:
+	policy kickflood=rate:5/60 dedup:30 batch:0.5
+where each item is optional:
+	rate:N/S: At most N firings per S seconds, as a token bucket that
+		holds N tokens and refills at N per S seconds; rate:N means N per second.
+	dedup:S: A firing whose actions, after substitutions, are the same as
+		those of one performed in the last S seconds is dropped.
+	batch:S: Firings are held for S seconds after the first and then run
+		together, identical ones only once, with sends to the server written
+		back to back before waiting for any reply.
+A policy admits or drops all of one firing's actions together, so a
+trigger never runs only part of its action list.
+Firings a policy drops are counted by reason (rate, dedup, or batched)
+and reported when dropping starts and when it stops.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import threading
+from time import time
+from OrderedDict import OrderedDict
+
+# Reasons an action can be dropped.
+reasons = ("rate", "dedup", "batched")
+# What is reported when actions start being dropped for each reason.
+_starting = {
+	"rate": "dropping firings over the rate limit",
+	"dedup": "dropping repeated firings",
+	"batched": "merging identical batched firings",
+}
+
+def parsePolicy(spec):
+	"""Parse a policy setting like "rate:5/60 dedup:30 batch:0.5"
+	into a dict with any of the keys rate (a (count, seconds) tuple), dedup, and batch.
+	Raises ValueError for anything unparseable.
+	"""
+	policy = {}
+	for item in spec.replace(",", " ").split():
+		kind,sep,value = item.partition(":")
+		kind = kind.lower()
+		if not sep or not value:
+			raise ValueError("Policy item %s needs a value, like %s:10" % (item, kind))
+		if kind == "rate":
+			count,sep,secs = value.partition("/")
+			count = int(count)
+			secs = float(secs) if sep else 1.0
+			if count < 1 or secs <= 0:
+				raise ValueError("Invalid rate: " +value)
+			policy["rate"] = (count, secs)
+		elif kind in ("dedup", "batch"):
+			secs = float(value)
+			if secs <= 0:
+				raise ValueError("Invalid %s time: %s" % (kind, value))
+			policy[kind] = secs
+		else:
+			raise ValueError("Unknown policy item %s; use rate, dedup, or batch" % (kind))
+	return policy
+
+class TokenBucket(object):
+	"""Allows count takes per seconds, in bursts of up to count.
+	"""
+	def __init__(self, count, seconds):
+		self.capacity = float(count)
+		self.refill = count /float(seconds)
+		self.tokens = self.capacity
+		self.when = time()
+
+	def take(self, now):
+		"""Take a token and return True, or return False if none is left.
+		"""
+		self.tokens = min(self.capacity, self.tokens +(now -self.when) *self.refill)
+		self.when = now
+		if self.tokens < 1: return False
+		self.tokens -= 1
+		return True
+
+class ActionPolicy(object):
+	"""Decides which firings of a trigger run their actions, and when.
+	Usage:
+		policy = ActionPolicy(parsePolicy(spec), runBatch, report)
+		if policy.admit(key, items): run(items)
+	key is the firing's action texts after substitution, joined, and items
+	are whatever the caller needs to run them, such as (text, name) pairs.
+	admit() returns True for a firing to run at once; firings held for
+	a batch are later passed to runBatch(items) from a timer thread,
+	with their items joined in the order the firings were first admitted.
+	report(text) is called when firings start or stop being dropped.
+	"""
+	# Remembered firing keys before expired ones are pruned.
+	maxSeen = 1000
+
+	def __init__(self, spec, runBatch, report):
+		self.spec = spec
+		self.runBatch = runBatch
+		self.report = report
+		rate = spec.get("rate")
+		self.bucket = TokenBucket(*rate) if rate else None
+		self.dedup = spec.get("dedup")
+		self.batch = spec.get("batch")
+		self.suppressed = dict([(reason, 0) for reason in reasons])
+		# Drops since dropping last started, reported when it stops.
+		self._streak = 0
+		# Firing key -> when it last ran or was batched.
+		self._seen = {}
+		# Batched firing key -> items.
+		self._pending = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __eq__(self, other):
+		return isinstance(other, ActionPolicy) and self.spec == other.spec
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def describe(self):
+		"""Return the policy as it would be written in a configuration.
+		"""
+		items = []
+		if self.bucket: items.append("rate:%d/%g" % self.spec["rate"])
+		if self.dedup: items.append("dedup:%g" % (self.dedup))
+		if self.batch: items.append("batch:%g" % (self.batch))
+		return " ".join(items)
+
+	def admit(self, key, items=()):
+		"""Return True if the firing with key should run its actions now.
+		items are passed back to runBatch if the firing is batched.
+		"""
+		now = time()
+		with self._lock:
+			if self.batch and key in self._pending:
+				reason = "batched"
+			elif self.dedup and now -self._seen.get(key, 0) < self.dedup:
+				reason = "dedup"
+			elif self.bucket and not self.bucket.take(now):
+				reason = "rate"
+			else:
+				reason = None
+				if self.dedup: self._remember(key, now)
+			if reason:
+				self.suppressed[reason] += 1
+				self._streak += 1
+				started = self._streak == 1
+			else:
+				stopped,self._streak = self._streak,0
+			if not reason and self.batch:
+				if not self._pending: self._startTimer()
+				self._pending[key] = list(items)
+		if reason:
+			if started: self.report(_starting[reason])
+			return False
+		if stopped: self.report("%d firings dropped" % (stopped))
+		return not self.batch
+
+	def _remember(self, key, now):
+		if len(self._seen) >= self.maxSeen:
+			self._seen = dict([(k, t) for k,t in self._seen.items() if now -t < self.dedup])
+		self._seen[key] = now
+
+	def _startTimer(self):
+		th = threading.Timer(self.batch, self._flush)
+		th.daemon = True
+		th.name = "actionBatch"
+		th.start()
+
+	def _flush(self):
+		with self._lock:
+			pending,self._pending = self._pending.values(),OrderedDict()
+		items = [item for firing in pending for item in firing]
+		if items: self.runBatch(items)
+
+	def toDict(self):
+		d = dict(self.suppressed)
+		d["policy"] = self.describe()
+		return d
@@ -0,0 +1,229 @@
+"""Matching of IP addresses against many address prefixes at once.
+Used by triggers for address= matches, such as block lists of thousands of prefixes.
+Each prefix goes into a binary trie for its address family, so checking an
+address costs one walk down the trie, however many prefixes there are.
+
+Prefixes can be written as
+	A full address, matching only that address: 10.1.2.3, 2001:db8::1.
+	The first parts of an IPv4 address, matching whole parts only:
+		10.1 (or 10.1.) matches 10.1.x.x but not 10.10.x.x.
+	The first groups of an IPv6 address: 2001:db8 (or 2001:db8: or 2001:db8::)
+		matches 2001:db8:x:x:x:x:x:x. A trailing :: always makes a prefix,
+		so fe80:: matches fe80::1, not only the address fe80::.
+	CIDR notation: 10.0.0.0/8, 192.168.4.0/22, 2001:db8::/32.
+IPv4 addresses written as IPv6 (::ffff:10.1.2.3) match as IPv4, in both
+prefixes and addresses. Addresses can carry ports and brackets as in
+TeamTalk's udpaddr values, such as [::ffff:10.1.2.3]:10333 or 10.1.2.3:10333.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+# Address bits per family.
+familyBits = {4: 32, 6: 128}
+
+def _parse4(text):
+	"""Return the integer for a dotted IPv4 address, or None.
+	"""
+	parts = text.split(".")
+	if len(parts) != 4: return None
+	value = 0
+	for part in parts:
+		if not part.isdigit() or int(part) > 255: return None
+		value = value <<8 | int(part)
+	return value
+
+def _groups6(text):
+	"""Return the 16-bit groups of an IPv6 address as written, expanding ::, or None.
+	An IPv4 address at the end counts as two groups.
+	"""
+	head,sep,tail = text.rpartition(":")
+	if "." in tail:
+		v4 = _parse4(tail)
+		if v4 is None: return None
+		text = "%s:%x:%x" % (head, v4 >>16, v4 &0xffff)
+	if text.count("::") > 1: return None
+	if "::" in text:
+		left,right = text.split("::")
+		left = left.split(":") if left else []
+		right = right.split(":") if right else []
+		missing = 8 -len(left) -len(right)
+		if missing < 1: return None
+		groups = left +["0"] *missing +right
+	else:
+		groups = text.split(":")
+	values = []
+	for group in groups:
+		if not 1 <= len(group) <= 4: return None
+		try: values.append(int(group, 16))
+		except ValueError: return None
+	return values
+
+def _parse6(text):
+	"""Return the integer for an IPv6 address, or None.
+	"""
+	groups = _groups6(text)
+	if groups is None or len(groups) != 8: return None
+	value = 0
+	for group in groups: value = value <<16 | group
+	return value
+
+def _family(value6):
+	"""Return (family, value) for an IPv6 value, as IPv4 if it is a mapped IPv4 address.
+	"""
+	if value6 >>32 == 0xffff: return 4, value6 &0xffffffff
+	return 6, value6
+
+def parseAddress(text):
+	"""Return (family, value) for an address parameter value, or None if it isn't one.
+	Brackets, ports, and IPv6 zone indexes are ignored.
+	"""
+	text = text.strip()
+	if text.startswith("["):
+		text = text[1:].partition("]")[0]
+	elif text.count(":") == 1:
+		# IPv4 with a port.
+		text = text.partition(":")[0]
+	if ":" in text:
+		value = _parse6(text.partition("%")[0])
+		if value is None: return None
+		return _family(value)
+	value = _parse4(text)
+	if value is None: return None
+	return 4, value
+
+def parsePrefix(spec):
+	"""Return (family, value, length) for an address prefix; see the top of this module.
+	Raises ValueError for anything that is not a prefix.
+	"""
+	text = spec.strip()
+	if "/" in text:
+		text,sep,length = text.partition("/")
+		addr = parseAddress(text)
+		if addr is None or not length.isdigit():
+			raise ValueError("Invalid CIDR address: " +spec)
+		family,value = addr
+		length = int(length)
+		if ":" in text and family == 4:
+			# ::ffff:10.0.0.0/104 is 10.0.0.0/8.
+			length -= 96
+		bits = familyBits[family]
+		if not 0 <= length <= bits:
+			raise ValueError("Invalid prefix length: " +spec)
+		return family, value >>(bits -length) <<(bits -length), length
+	if ":" in text:
+		if text.endswith("::") and text != "::":
+			# The groups before :: are a prefix, as they were when matches compared text.
+			text = text[:-2]
+		value = _parse6(text)
+		if value is not None:
+			family,value = _family(value)
+			return family, value, familyBits[family]
+		# A partial address: whole groups only.
+		partial = text.rstrip(":")
+		if text.lower().startswith("::ffff:"):
+			# Mapped IPv4, such as ::ffff:10.1.
+			family,value,length = parsePrefix(text[7:])
+			if family == 4: return family, value, length
+		groups = _groups6(partial +"::") if "::" not in partial else None
+		if not partial or groups is None:
+			raise ValueError("Invalid address prefix: " +spec)
+		length = 16 *len(partial.split(":"))
+		value = 0
+		for group in groups: value = value <<16 | group
+		return 6, value >>(128 -length) <<(128 -length), length
+	parts = text.rstrip(".").split(".")
+	if not 1 <= len(parts) <= 4 or not all([p.isdigit() and int(p) <= 255 for p in parts]):
+		raise ValueError("Invalid address prefix: " +spec)
+	value = 0
+	for part in parts: value = value <<8 | int(part)
+	length = 8 *len(parts)
+	return 4, value <<(32 -length), length
+
+class PrefixTrie(object):
+	"""A binary trie of address prefixes for one address family.
+	Each node is a list: [child for bit 0, child for bit 1, keys ending here].
+	"""
+	def __init__(self, bits):
+		self.bits = bits
+		self.root = [None, None, []]
+		# The longest prefix added, past which lookups need not walk.
+		self.longest = 0
+
+	def add(self, value, length, key):
+		node = self.root
+		for i in range(length):
+			bit = value >>(self.bits -1 -i) &1
+			child = node[bit]
+			if child is None: child = node[bit] = [None, None, []]
+			node = child
+		node[2].append(key)
+		if length > self.longest: self.longest = length
+
+	def lookup(self, value):
+		"""Return the keys of every prefix that value starts with.
+		"""
+		node = self.root
+		found = list(node[2])
+		shift = self.bits -1
+		for i in xrange(self.longest):
+			node = node[value >>(shift -i) &1]
+			if node is None: break
+			if node[2]: found.extend(node[2])
+		return found
+
+class AddressMatcher(object):
+	"""Matches addresses against a set of prefixes.
+	Usage:
+		am = AddressMatcher()
+		am.add("10.1")
+		am.add("2001:db8::/32", key=someObject)
+		am.lookup("[::ffff:10.1.2.3]:10333")  # -> set(["10.1"])
+	add() raises ValueError for prefixes it can't parse.
+	Lookups are cached by address text, so repeated addresses cost one dict lookup.
+	"""
+	# Addresses whose results are kept before the cache starts over.
+	maxCache = 10000
+
+	def __init__(self):
+		self.tries = dict([(family, PrefixTrie(bits)) for family,bits in familyBits.items()])
+		self.count = 0
+		self._cache = {}
+
+	def __len__(self):
+		return self.count
+
+	def add(self, spec, key=None):
+		"""Add a prefix; lookups return key (spec by default) for addresses it matches.
+		"""
+		family,value,length = parsePrefix(spec)
+		self.tries[family].add(value, length, spec if key is None else key)
+		self.count += 1
+		self._cache = {}
+
+	def lookup(self, addr):
+		"""Return the set of keys of prefixes that match addr, which may be empty.
+		"""
+		try: return self._cache[addr]
+		except KeyError: pass
+		parsed = parseAddress(addr)
+		if parsed is None: found = frozenset()
+		else:
+			family,value = parsed
+			found = frozenset(self.tries[family].lookup(value))
+		if len(self._cache) >= self.maxCache: self._cache = {}
+		self._cache[addr] = found
+		return found
@@ -0,0 +1,364 @@
+#! /usr/bin/env python
+
+"""Micro-benchmarks for TTCom's parsing, state, and formatting hot paths.
+Each benchmark runs on fixed inputs: data generated by fakeserver from a
+fixed seed, or lines from a recorded ttcom.log when one is given.
+Results are reported as operations per second and as gc-tracked objects
+left behind per thousand operations, and can be saved as JSON and
+compared against an earlier run to catch regressions.
+
+Usage:
+	python benchmarks.py [-k name] [-j results.json] [-l ttcom.log]
+	python benchmarks.py -c old.json [new.json]
+With -c and one file, the benchmarks are run now and compared to that file.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import sys, gc, json, platform, argparse
+from time import time
+from timeit import default_timer
+from itertools import islice
+from conf import conf
+if not hasattr(conf, "version"): conf.version = "benchmark"
+from tt_attrdict import AttrDict
+from parmline import ParmLine, Parser, TTParms
+from triggers import Triggers
+from TableFormatter import TableFormatter
+import mycmd
+from fakeserver import FakeWorld
+from replay import ReplayServer, readLog
+
+# Name -> setup function; see benchmark().
+benchmarks = []
+
+def benchmark(name):
+	"""Decorator registering a benchmark setup function.
+	The setup function takes the Inputs and returns (op, count), where op is
+	a function taking no arguments and count is how many operations one call of op performs.
+	"""
+	def register(setup):
+		benchmarks.append((name, setup))
+		return setup
+	return register
+
+class Inputs(object):
+	"""The fixed data benchmarks run on, built once and shared.
+	"""
+	def __init__(self, logPath=None, users=3000, channels=500, seed=1):
+		self.world = FakeWorld("Bench", users, channels, 0, 0, seed)
+		self.lines = [l.rstrip() for l in self.world.loginDump()]
+		if logPath:
+			self.lines = [line for timestamp,shortname,line in islice(readLog(logPath), 20000)]
+		self._server = None
+
+	@property
+	def server(self):
+		"""An offline server loaded with the generated users and channels.
+		"""
+		if self._server is None:
+			server = ReplayServer("bench")
+			server.processLine('welcome userid=100000 servername="Bench" usertimeout=60 version="5.2"')
+			server.processLine('accepted userid=100000 nickname="Me" username="me" usertype=2')
+			for line in self.world.loginDump():
+				server.processLine(line.rstrip())
+			server.processLine("ok")
+			self._server = server
+		return self._server
+
+@benchmark("parmline.construct")
+def benchParmLine(inputs):
+	lines = inputs.lines[:2000]
+	def op():
+		for line in lines: ParmLine(line)
+	return op, len(lines)
+
+@benchmark("parmline.makeline")
+def benchMakeline(inputs):
+	parmlines = [ParmLine(line) for line in inputs.lines[:2000]]
+	def op():
+		for pl in parmlines: pl.makeline(pl.event, pl.parms)
+	return op, len(parmlines)
+
+def longLine():
+	parts = ["updateuser"]
+	for i in range(50):
+		parts.append('field%d="%s"' % (i, "x\\\"y " *20))
+		parts.append("num%d=%d" % (i, i *1000))
+		parts.append("list%d=[1,2,3,4,5]" % (i))
+	return " ".join(parts)
+
+@benchmark("parser.long")
+def benchParser(inputs):
+	line = longLine()
+	def op(): Parser(line).getParms()
+	return op, 1
+
+@benchmark("ttparms.long")
+def benchTTParms(inputs):
+	line = longLine()
+	def op(): str(TTParms(line))
+	return op, 1
+
+@benchmark("attrdict.get")
+def benchAttrGet(inputs):
+	d = AttrDict(inputs.world.users.values()[0])
+	def op():
+		for i in xrange(100):
+			d.nickname; d.get("username"); d.chanid; d["userid"]
+	return op, 400
+
+@benchmark("attrdict.set")
+def benchAttrSet(inputs):
+	d = AttrDict(inputs.world.users.values()[0])
+	def op():
+		for i in xrange(100):
+			d.statusmsg = "a"; d.chanid = "2"; d["statusmode"] = "1"; d.nickname = "n"
+	return op, 400
+
+@benchmark("server.updateParms")
+def benchUpdateParms(inputs):
+	server = inputs.server
+	user = server.users[sorted(server.users)[10]]
+	updates = [AttrDict(user, statusmode=str(mode), statusmsg=msg)
+		for mode,msg in ((0, ""), (1, "Away"), (257, "Away"), (0, "Back"))
+	]
+	def op():
+		for parms in updates: server.updateParms(user.nickname, user, parms)
+	return op, len(updates)
+
+@benchmark("server.doStatus")
+def benchDoStatus(inputs):
+	server = inputs.server
+	pairs = [(AttrDict(statusmode="0", statusmsg=""), AttrDict(statusmode="2305", statusmsg="Busy")),
+		(AttrDict(statusmode="257", statusmsg="Away"), AttrDict(statusmode="0", statusmsg="")),
+	]
+	def op():
+		lst = []
+		for old,new in pairs: server.doStatus(lst, new, old)
+	return op, len(pairs)
+
+@benchmark("server.doFlagBits")
+def benchDoFlagBits(inputs):
+	server = inputs.server
+	def op():
+		server.doFlagBits(0, 0xFFFF)
+		server.doFlagBits(0x1234, 0x4321, 3, ["active", "idle", "question", "stat3"])
+	return op, 2
+
+def makeTriggers(inputs, count):
+	triggers = Triggers(lambda cmd: None)
+	triggers.server = inputs.server
+	for i in range(count):
+		triggers.addMatch("t%d" % (i), ParmLine('updateuser nickname="Nobody %d.*" statusmode="%d"' % (i, i)))
+	return triggers
+
+@benchmark("trigger.isMatch.500")
+def benchIsMatch(inputs):
+	triggers = makeTriggers(inputs, 500)
+	pairs = [(trigger, match) for trigger in triggers.triggers.values() for match in trigger.matches.values()]
+	event = ParmLine(inputs.world.userLine("updateuser", inputs.world.users.values()[0]))
+	def op():
+		for trigger,match in pairs: trigger._isMatch(match, event)
+	return op, len(pairs)
+
+@benchmark("triggers.apply.500")
+def benchTriggersApply(inputs):
+	triggers = makeTriggers(inputs, 500)
+	event = ParmLine(inputs.world.userLine("updateuser", inputs.world.users.values()[0]))
+	def op(): triggers.apply(event)
+	return op, 1
+
+@benchmark("triggers.address.2000")
+def benchTriggersAddress(inputs):
+	triggers = Triggers(lambda cmd: None)
+	triggers.server = inputs.server
+	for i in range(2000):
+		triggers.addMatch("block%d" % (i), ParmLine('loggedin address="10.%d.%d"' % (i /250, i %250)))
+	event = ParmLine(inputs.world.userLine("loggedin", inputs.world.users.values()[0]))
+	def op():
+		event.addressMatches = None
+		triggers.apply(event)
+	return op, 1
+
+@benchmark("server.channelname.deep")
+def benchChannelname(inputs):
+	world = FakeWorld("Deep", 0, 1, 0, 0)
+	parent = "1"
+	for depth in range(30):
+		parent = world.addChannel(parent, "Level %d" % (depth))["channelid"]
+	server = ReplayServer("deep")
+	for chanid in sorted(world.channels, key=int):
+		server.processLine(ParmLine("addchannel", world.channels[chanid]).line)
+	ids = sorted(world.channels, key=int)
+	def op():
+		for id in ids: server.channelname(id)
+	return op, len(ids)
+
+class CommandStub(object):
+	"""Just enough of a TTComCmd to run its matching methods without a console or config.
+	"""
+	def __init__(self, server):
+		from TTComCmd import TTComCmd
+		self.curServer = server
+		self.servers = {server.shortname: server}
+		self.selectMatch = TTComCmd.selectMatch
+		self._userMatch = TTComCmd.userMatch.im_func
+		self._channelMatch = TTComCmd.channelMatch.im_func
+
+	def userMatch(self, u, checkAll=False):
+		return self._userMatch(self, u, checkAll)
+
+	def channelMatch(self, c, noPrompt=False):
+		return self._channelMatch(self, c, noPrompt)
+
+@benchmark("cmd.userMatch")
+def benchUserMatch(inputs):
+	cmd = CommandStub(inputs.server)
+	users = sorted(inputs.world.users.values(), key=lambda u: int(u["userid"]))
+	texts = [u["nickname"] for u in users[-10:]] +["#" +u["userid"] for u in users[:10]]
+	def op():
+		for text in texts: cmd.userMatch(text)
+	return op, len(texts)
+
+@benchmark("cmd.channelMatch")
+def benchChannelMatch(inputs):
+	cmd = CommandStub(inputs.server)
+	chans = sorted(inputs.world.channels.values(), key=lambda c: -int(c["channelid"]))[:20]
+	texts = [c["name"] for c in chans]
+	def op():
+		for text in texts: cmd.channelMatch(text)
+	return op, len(texts)
+
+@benchmark("tableformatter.format")
+def benchTableFormatter(inputs):
+	users = inputs.world.users.values()[:1000]
+	fields = ["userid", "nickname", "username", "ipaddr", "statusmode", "channelid"]
+	def op():
+		tbl = TableFormatter("Users", fields)
+		for user in users: tbl.addRow([user[f] for f in fields])
+		tbl.format()
+	return op, 1
+
+@benchmark("mycmd.format")
+def benchFormat(inputs):
+	text = "\n".join(["    " *(i %3) +"This is line %d of a long block of output text that wraps. " % (i) *3 for i in range(50)])
+	def op(): mycmd.format(text)
+	return op, 1
+
+def measure(op, count, minTime=0.2, repeat=3):
+	"""Return (operations per second, objects left per thousand operations) for op.
+	op is called enough times to run at least minTime seconds, and the
+	best of repeat such runs is used. Python 2 has no allocation tracer,
+	so allocation is measured as the growth in gc-tracked objects.
+	"""
+	op()
+	loops = 1
+	while True:
+		t0 = default_timer()
+		for i in xrange(loops): op()
+		spent = default_timer() -t0
+		if spent >= minTime: break
+		loops *= 2 if spent < minTime /10 else max(2, int(minTime /spent) +1)
+	best = spent
+	for i in range(repeat -1):
+		t0 = default_timer()
+		for i in xrange(loops): op()
+		best = min(best, default_timer() -t0)
+	gc.collect()
+	before = len(gc.get_objects())
+	for i in xrange(loops): op()
+	gc.collect()
+	objects = len(gc.get_objects()) -before
+	ops = loops *count
+	return ops /best, 1000.0 *objects /ops
+
+def runBenchmarks(inputs, selected=None, progress=None):
+	"""Run the benchmarks whose names contain any of selected, or all of them.
+	Returns a dict of name -> {"ops": ops/sec, "objects": objects per thousand ops}.
+	"""
+	results = {}
+	for name,setup in benchmarks:
+		if selected and not any([s in name for s in selected]): continue
+		op,count = setup(inputs)
+		ops,objects = measure(op, count)
+		results[name] = {"ops": ops, "objects": objects}
+		if progress: progress(name, results[name])
+	return results
+
+def compareResults(old, new, threshold=0.1):
+	"""Return (report text, names of regressed benchmarks) comparing two result dicts.
+	A benchmark regresses when its ops/sec drops by more than threshold (a fraction).
+	"""
+	tbl = TableFormatter("Comparison", ["Benchmark", "Old ops/s", "New ops/s", "Change", "Old obj/k", "New obj/k"])
+	regressed = []
+	for name in sorted(set(old) | set(new)):
+		o = old.get(name)
+		n = new.get(name)
+		if not o or not n:
+			tbl.addRow([name, fmtOps(o), fmtOps(n), "", "", ""])
+			continue
+		change = n["ops"] /o["ops"] -1
+		flag = ""
+		if change < -threshold:
+			regressed.append(name)
+			flag = " *"
+		tbl.addRow([name, fmtOps(o), fmtOps(n), "%+0.1f%%%s" % (100 *change, flag),
+			"%0.1f" % (o["objects"]), "%0.1f" % (n["objects"])
+		])
+	return tbl.format(), regressed
+
+def fmtOps(result):
+	if not result: return "-"
+	return "%0.0f" % (result["ops"])
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description="Benchmark TTCom hot paths")
+	parser.add_argument("-k", dest="selected", action="append", help="Run only benchmarks whose names contain this (can be repeated)")
+	parser.add_argument("-j", "--json", help="Save results to this JSON file")
+	parser.add_argument("-l", "--log", help="Take protocol lines from this recorded ttcom.log instead of generating them")
+	parser.add_argument("-c", "--compare", nargs="+", metavar="JSON", help="Compare results: old.json [new.json]")
+	parser.add_argument("-t", "--threshold", type=float, default=10, help="Percent slowdown reported as a regression (default 10)")
+	parser.add_argument("--list", action="store_true", help="List the benchmarks and exit")
+	opts = parser.parse_args(args)
+	if opts.list:
+		for name,setup in benchmarks: print name
+		return 0
+	if opts.compare and len(opts.compare) > 2:
+		parser.error("--compare takes one or two files")
+	if opts.compare and len(opts.compare) == 2:
+		new = json.load(open(opts.compare[1]))["results"]
+	else:
+		def progress(name, result):
+			print "%-28s %12.0f ops/s %8.1f obj/k" % (name, result["ops"], result["objects"])
+			sys.stdout.flush()
+		new = runBenchmarks(Inputs(opts.log), opts.selected, progress)
+		if opts.json:
+			json.dump({"time": time(), "python": platform.python_version(),
+				"platform": platform.platform(), "results": new
+			}, open(opts.json, "w"), indent=1, sort_keys=True)
+	if not opts.compare: return 0
+	old = json.load(open(opts.compare[0]))["results"]
+	report,regressed = compareResults(old, new, opts.threshold /100.0)
+	print report
+	if regressed:
+		print "Regressed: " +", ".join(regressed)
+		return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
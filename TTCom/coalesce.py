@@ -0,0 +1,150 @@
+"""Coalescing of rapid update events about the same user or channel.
+Some clients change status or UDP address many times a second.
+Within a configurable window, repeated updates for one user or channel
+still update state at once, but are reported as one net change when the
+window closes.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import threading
+from time import time
+from tt_attrdict import AttrDict
+
+# Events that can be coalesced, and the parameter that says what they are about.
+coalescable = {
+	"updateuser": "userid",
+	"updatechannel": "channelid",
+}
+
+def parseWindows(spec):
+	"""Parse a coalesce= setting like "updateuser:2 updatechannel:5"
+	into a dict of event name to window length in seconds.
+	Raises ValueError for anything unparseable or not coalescable.
+	"""
+	windows = {}
+	for item in spec.replace(",", " ").split():
+		event,sep,secs = item.partition(":")
+		event = event.lower()
+		if event not in coalescable:
+			raise ValueError("%s events can't be coalesced; use %s" % (event, " or ".join(sorted(coalescable))))
+		if not sep: secs = "1"
+		windows[event] = float(secs)
+	return windows
+
+class CoalesceWindow(object):
+	"""The updates merged for one user or channel.
+	base: The record as it was before the first merged update.
+	count: How many updates were merged.
+	details: Each merged update's own change report, if these are kept.
+	"""
+	def __init__(self, key, deadline, keepDetails):
+		self.key = key
+		self.deadline = deadline
+		self.keepDetails = keepDetails
+		self.base = None
+		self.count = 0
+		self.details = []
+
+	def addDetail(self, text):
+		if text: self.details.append(text)
+
+class Coalescer(object):
+	"""Decides which events of a server are merged and flushes them when their windows close.
+	The first update for a user or channel is handled as usual and opens
+	a window; later ones in that window are merged, and the server's
+	flushCoalesced() reports them together when the window closes.
+	windows: Event name -> window length in seconds.
+	triggers: "each" if triggers see every event, "coalesced" if they see only
+		unmerged events and one synthesized event per flushed window.
+	detail: "net" to report only the net change over a window,
+		"all" to keep every merged update's own report.
+	"""
+	def __init__(self, server, windows, triggers="each", detail="net"):
+		self.server = server
+		self.windows = windows
+		self.triggers = triggers
+		self.detail = detail
+		self._open = {}
+		self._cv = threading.Condition()
+		self._thread = None
+
+	def check(self, parmline):
+		"""Called for each event before it is dispatched.
+		Returns the CoalesceWindow the event merges into, or None if it is handled as usual.
+		"""
+		window = self.windows.get(parmline.event)
+		if not window: return None
+		key = (parmline.event, parmline.parms.get(coalescable[parmline.event]))
+		now = time()
+		closed = None
+		with self._cv:
+			cw = self._open.get(key)
+			if cw is None or cw.deadline <= now:
+				# Handled as usual, and starts a window for what follows.
+				# A window that closed before the flush thread took it is flushed here,
+				# so its merged updates are reported before this event.
+				if cw is not None and cw.count: closed = cw
+				self._open[key] = CoalesceWindow(key, now +window, self.detail == "all")
+				self._cv.notify()
+				self._start()
+			else:
+				if cw.base is None:
+					record = self.server.coalescedRecord(key)
+					if record is None: return None
+					cw.base = AttrDict(record)
+				cw.count += 1
+				return cw
+		if closed: self._flush(closed)
+		return None
+
+	def clear(self):
+		"""Drop all open windows without reporting them.
+		"""
+		with self._cv:
+			self._open = {}
+
+	def _start(self):
+		if self._thread: return
+		self._thread = threading.Thread(target=self._flushLoop)
+		self._thread.daemon = True
+		self._thread.name = self.server.shortname +"_coalescer"
+		self._thread.start()
+
+	def _flushLoop(self):
+		"""Flush windows as they close, forever.
+		Runs in its own thread, started when the first window opens.
+		"""
+		while True:
+			with self._cv:
+				while True:
+					now = time()
+					due = [cw for cw in self._open.values() if cw.deadline <= now]
+					if due: break
+					if self._open:
+						self._cv.wait(min([cw.deadline for cw in self._open.values()]) -now)
+					else:
+						self._cv.wait()
+				for cw in due:
+					if self._open.get(cw.key) is cw: del self._open[cw.key]
+			for cw in due:
+				if cw.count: self._flush(cw)
+
+	def _flush(self, cw):
+		try: self.server.flushCoalesced(cw)
+		except Exception as e:
+			self.server.errorFromEvent("Coalesced event failure: %s" % (str(e)))
@@ -0,0 +1,262 @@
+"""Headless operation of TTCom, controlled through a Unix domain socket.
+In daemon mode (ttcom.py -d), TTCom keeps its server connections without
+reading from a terminal and takes commands from any number of local clients.
+
+Protocol: Each line a client sends is one command.
+A line that starts with "{" is a JSON request:
+	{"id": 1, "command": "who"}
+and is answered with one JSON line:
+	{"id": 1, "output": "...", "error": null}
+Any other line is typed as at the TTCom prompt, and its output comes back
+as lines ending with a line holding only a period; output lines that
+start with a period get another one in front, as in SMTP.
+Each client has its own current server, and a command's output goes only
+to the client that sent it. Commands that would ask a question fail instead.
+
+These commands are handled here rather than by TTCom:
+	subscribe [events|output] [server ...]: Stream events from the given
+		servers, or from all servers: events sends each line a server sends,
+		and output sends the event text TTCom would print.
+		Plain clients get "event <shortname> <line>" and "output <text>" lines;
+		JSON clients get {"type": "event", "server": ..., "event": ..., "parms": {...}}
+		and {"type": "output", "text": ...}.
+	unsubscribe [events|output]: Stop streaming some or all events.
+	quit or exit: Close this connection.
+	shutdown: Stop the daemon.
+Streams are event bus subscriptions (see eventbus.py), one per client and kind.
+A client that can't keep up with its stream has stream lines dropped,
+never replies, and is told how many were dropped when it catches up.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os, sys, socket, json, threading, Queue, SocketServer
+from cmd import Cmd
+from StringIO import StringIO
+from mycmd import err, redirectThreadOutput, allowInput
+from eventbus import bus
+
+class ClientHandler(SocketServer.StreamRequestHandler):
+	"""One connected client, served by its own thread.
+	Replies and stream lines are written by a second thread from a bounded queue,
+	so a slow client never holds up event handling.
+	"""
+	# Stream lines held for a client before more are dropped.
+	maxQueue = 1000
+
+	def setup(self):
+		SocketServer.StreamRequestHandler.setup(self)
+		self.app = self.server.app
+		self.json = False
+		# Kind (events or output) -> event bus Subscription.
+		self.subscriptions = {}
+		self.dropped = 0
+		self._q = Queue.Queue(self.maxQueue)
+		self._writer = threading.Thread(target=self._writeLoop)
+		self._writer.daemon = True
+		self._writer.name = "controlWriter"
+		self._writer.start()
+
+	def handle(self):
+		allowInput(False)
+		# This client's current server starts as the daemon's.
+		self.app._threadServer.server = self.app.curServer
+		while True:
+			line = self.rfile.readline()
+			if not line: break
+			line = line.decode("utf-8", "replace").strip()
+			if not line: continue
+			if line.startswith("{"):
+				self.json = True
+				try: request = json.loads(line)
+				except ValueError as e:
+					self.reply(None, "", "Invalid JSON: " +str(e))
+					continue
+				if not isinstance(request, dict):
+					self.reply(None, "", "A request must be a JSON object")
+					continue
+				id = request.get("id")
+				line = request.get("command") or ""
+				if not isinstance(line, basestring):
+					self.reply(id, "", "command must be a string")
+					continue
+			else:
+				self.json = False
+				id = None
+			if not self.runLine(id, line): break
+
+	def finish(self):
+		self.unsubscribe([])
+		self._q.put(None)
+		self._writer.join(5)
+		try: SocketServer.StreamRequestHandler.finish(self)
+		except socket.error: pass
+
+	def runLine(self, id, line):
+		"""Run one command line and send its reply.
+		Returns False when the connection should close.
+		"""
+		words = line.split(None, 1)
+		word = words[0].lower() if words else ""
+		rest = words[1] if len(words) > 1 else ""
+		if word == "shutdown":
+			self.reply(id, "Shutting down", None)
+			self.server.stop()
+			return False
+		if word in ("subscribe", "unsubscribe"):
+			try: output = getattr(self, word)(rest.split())
+			except ValueError as e: self.reply(id, "", str(e))
+			else: self.reply(id, output, None)
+			return True
+		buf = StringIO()
+		redirectThreadOutput(buf)
+		error = None
+		stop = False
+		try:
+			line = self.app.precmd(line)
+			stop = Cmd.onecmd(self.app, line)
+		except Exception:
+			error = err()
+		finally:
+			redirectThreadOutput(None)
+		self.reply(id, buf.getvalue(), error)
+		# Quit and exit end this connection, not the daemon.
+		return not stop
+
+	def _kind(self, args):
+		if args and args[0].lower() in ("events", "output"):
+			return args.pop(0).lower()
+		return None
+
+	def subscribe(self, args):
+		kind = self._kind(args) or "events"
+		for shortname in args:
+			if shortname not in self.app.servers:
+				raise ValueError("No server named %s" % (shortname))
+		self.unsubscribe([kind])
+		name = "control %s %x" % (kind, id(self))
+		if kind == "events":
+			sub = bus.subscribe(name, self.streamEvent, servers=args,
+				where=lambda event: not getattr(event.line, "merged", None)
+			)
+		else:
+			sub = bus.subscribe(name, self.streamOutput, servers=args, stage="output")
+		self.subscriptions[kind] = sub
+		return "Subscribed to %s from %s" % (kind, ", ".join(sorted(args)) or "all servers")
+
+	def unsubscribe(self, args):
+		kind = self._kind(args)
+		kinds = [kind] if kind else self.subscriptions.keys()
+		for kind in kinds:
+			sub = self.subscriptions.pop(kind, None)
+			if sub: bus.unsubscribe(sub)
+		return "Unsubscribed"
+
+	def streamEvent(self, event):
+		shortname = event.server.shortname
+		plain = "event %s %s" % (shortname, event.line.initLine.rstrip())
+		self.stream(plain, {"type": "event",
+			"server": shortname,
+			"event": event.name,
+			"parms": dict(event.parms)
+		})
+
+	def streamOutput(self, event):
+		text = event.parms.text
+		self.stream("output " +text, {"type": "output", "server": event.server.shortname, "text": text})
+
+	def reply(self, id, output, error):
+		"""Queue the reply to a command. Replies are never dropped.
+		"""
+		if self.json:
+			text = json.dumps({"id": id, "output": output.rstrip("\n"), "error": error})
+		else:
+			lines = output.splitlines()
+			if error: lines.append(error)
+			lines = ["." +l if l.startswith(".") else l for l in lines]
+			lines.append(".")
+			text = "\n".join(lines)
+		self._q.put(text)
+
+	def stream(self, plain, record):
+		"""Queue a stream line, dropping it if the client is too far behind.
+		"""
+		if self.json: text = json.dumps(record)
+		else: text = plain
+		try: self._q.put_nowait(text)
+		except Queue.Full: self.dropped += 1
+
+	def _writeLoop(self):
+		while True:
+			text = self._q.get()
+			if text is None: return
+			if self.dropped:
+				dropped,self.dropped = self.dropped,0
+				notice = "%d stream lines dropped" % (dropped)
+				if self.json: notice = json.dumps({"type": "dropped", "count": dropped})
+				text = notice +"\n" +text
+			if isinstance(text, unicode): text = text.encode("utf-8")
+			try: self.wfile.write(text +"\n")
+			except socket.error: return
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	"""The control socket of a TTCom daemon.
+	Usage:
+		control = ControlServer(app, "ttcom.sock")
+		control.serve()
+	serve() returns when a client sends shutdown.
+	"""
+	daemon_threads = True
+
+	def __init__(self, app, path):
+		self.app = app
+		self.path = path
+		if os.path.exists(path):
+			# Only a socket left by a daemon that is gone may be replaced.
+			probe = socket.socket(socket.AF_UNIX)
+			try: probe.connect(path)
+			except socket.error: os.unlink(path)
+			else: raise socket.error("Another daemon is using " +path)
+			finally: probe.close()
+		# Only this user may connect.
+		umask = os.umask(077)
+		try: SocketServer.UnixStreamServer.__init__(self, path, ClientHandler)
+		finally: os.umask(umask)
+		# Cmd writes unknown-command and help text to self.stdout,
+		# which must follow each client thread's output too.
+		redirectThreadOutput(None)
+		app.stdout = sys.stdout
+
+	def serve(self):
+		"""Serve clients until one sends shutdown or the process is interrupted.
+		"""
+		# This also keeps event output off the console.
+		self.app.controlServer = self
+		try: self.serve_forever()
+		except KeyboardInterrupt: pass
+		finally:
+			self.app.controlServer = None
+			self.server_close()
+			try: os.unlink(self.path)
+			except OSError: pass
+
+	def stop(self):
+		"""Make serve() return. Must be called from a thread other than the serving one.
+		"""
+		th = threading.Thread(target=self.shutdown)
+		th.daemon = True
+		th.start()
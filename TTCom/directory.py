@@ -0,0 +1,163 @@
+"""Directory of the users on all connected servers, by nickname, username, and IP address.
+Servers keep it current from their user events, so finding where someone is
+connected takes no requests to any server.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import re
+import threading
+from bisect import bisect_left, insort
+
+class UserDirectory(object):
+	"""Maps normalized nicknames, usernames, and IP addresses to (server, userid) entries.
+	Usage:
+		directory.update(server, user)  # after a user is added or changes
+		directory.remove(server, userid)
+		directory.removeServer(server)  # on logout or disconnect
+		directory.find("bob")  # exact matches, or prefix matches if none
+	Lookups are dictionary lookups, plus a binary search of the sorted keys
+	for prefix matches. The sorted keys are kept in order as keys come and go,
+	by binary search, so no lookup ever sorts. Servers update from their own
+	threads, so all access is locked.
+	"""
+	namePunctuation = re.compile(r'''[\s.,?/;:@#$%^&*'"!+=_()<>\[\]{}|~`-]+''')
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._entries = {}
+		# All keys of _entries in order.
+		self._sortedKeys = []
+		self._userKeys = {}
+		# Server -> set of its entries in _userKeys.
+		self._serverEntries = {}
+
+	@classmethod
+	def normalize(cls, text):
+		"""Return the form of a nickname or username used as a directory key.
+		Case, spaces, and punctuation are ignored.
+		"""
+		return cls.namePunctuation.sub('', text.lower())
+
+	@staticmethod
+	def normalizeAddress(addr):
+		"""Return the form of an IP address used as a directory key.
+		Ports, brackets, and the IPv4-mapped IPv6 prefix are dropped.
+		"""
+		addr = addr.strip().lower()
+		if addr.startswith("["): addr = addr[1:].split("]", 1)[0]
+		elif addr.count(":") == 1: addr = addr.split(":", 1)[0]
+		if addr.startswith("::ffff:") and "." in addr: addr = addr[7:]
+		if addr in ("", "0.0.0.0", "::"): return ""
+		return addr
+
+	def keysOf(self, user):
+		"""Return the directory keys for user.
+		"""
+		keys = set()
+		for field in ("nickname", "username"):
+			val = user.get(field)
+			if val:
+				val = self.normalize(val)
+				if val: keys.add(val)
+		for field in ("ipaddr", "udpaddr"):
+			val = user.get(field)
+			if val:
+				val = self.normalizeAddress(val)
+				if val: keys.add(val)
+		return frozenset(keys)
+
+	def update(self, server, user):
+		"""Add or update user, who is on server.
+		"""
+		entry = (server, user.userid)
+		keys = self.keysOf(user)
+		with self._lock:
+			old = self._userKeys.get(entry, frozenset())
+			if old == keys: return
+			for key in old -keys: self._removeKey(key, entry)
+			for key in keys -old: self._addKey(key, entry)
+			if keys:
+				self._userKeys[entry] = keys
+				self._serverEntries.setdefault(server, set()).add(entry)
+			else: self._forget(entry)
+
+	def remove(self, server, userid):
+		"""Remove the user with userid on server.
+		"""
+		entry = (server, userid)
+		with self._lock:
+			for key in self._userKeys.get(entry, ()): self._removeKey(key, entry)
+			self._forget(entry)
+
+	def removeServer(self, server):
+		"""Remove all users of server.
+		"""
+		with self._lock:
+			for entry in self._serverEntries.pop(server, ()):
+				for key in self._userKeys.pop(entry, ()): self._removeKey(key, entry)
+
+	def _forget(self, entry):
+		self._userKeys.pop(entry, None)
+		entries = self._serverEntries.get(entry[0])
+		if entries is None: return
+		entries.discard(entry)
+		if not entries: del self._serverEntries[entry[0]]
+
+	def _addKey(self, key, entry):
+		entries = self._entries.get(key)
+		if entries is None:
+			self._entries[key] = entries = set()
+			insort(self._sortedKeys, key)
+		entries.add(entry)
+
+	def _removeKey(self, key, entry):
+		entries = self._entries.get(key)
+		if entries is None: return
+		entries.discard(entry)
+		if entries: return
+		del self._entries[key]
+		i = bisect_left(self._sortedKeys, key)
+		if i < len(self._sortedKeys) and self._sortedKeys[i] == key:
+			del self._sortedKeys[i]
+
+	def find(self, query, limit=200):
+		"""Return the (server, userid) entries whose nickname, username, or IP address matches query.
+		Exact matches are returned if there are any; otherwise,
+		up to limit entries whose keys start with query.
+		"""
+		keys = set([self.normalize(query), self.normalizeAddress(query)])
+		keys.discard("")
+		with self._lock:
+			found = set()
+			for key in keys:
+				found.update(self._entries.get(key, ()))
+			if found: return list(found)
+			sortedKeys = self._sortedKeys
+			for prefix in keys:
+				i = bisect_left(sortedKeys, prefix)
+				while i < len(sortedKeys) and sortedKeys[i].startswith(prefix):
+					found.update(self._entries[sortedKeys[i]])
+					if len(found) >= limit: return list(found)
+					i += 1
+			return list(found)
+
+	def __len__(self):
+		return len(self._userKeys)
+
+# The directory shared by all servers.
+directory = UserDirectory()
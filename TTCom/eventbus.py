@@ -0,0 +1,267 @@
+"""In-process publish/subscribe for TeamTalk server events.
+Servers publish each event to the bus, and every subscriber gets the
+events it registered for on its own bounded queue, handled by its own
+thread, so one slow subscriber never holds up another or the server's
+socket reader. TTCom's own logging, triggers, speech, and event output
+are subscribers like any other.
+
+Events are published at one of three stages:
+	received: As a line arrives from a server, before it updates any state.
+	handled: After the line has updated state (the default).
+	output: Event text TTCom would print; the event is named _output_
+		and its text is in parms.text.
+
+Usage, for example from ttcom_triggers.py:
+	from eventbus import bus
+	def onLogin(event):
+		print event.server.shortname, event.parms.nickname
+	sub = bus.subscribe("logins", onLogin, events=["loggedin"],
+		servers=["simon"], parms={"usertype": "1"})
+	...
+	bus.unsubscribe(sub)
+A subscriber whose queue fills up, or whose events wait longer than
+slowAfter seconds, is reported once as slow until it catches up.
+Events arriving for a full queue are dropped and counted, unless the
+subscriber asked to block instead, as the log and triggers do;
+dropping suits optional sinks such as daemon client streams.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import threading, Queue
+from time import time
+from tt_attrdict import AttrDict
+from mycmd import err
+
+stages = ("received", "handled", "output")
+
+class Event(object):
+	"""One published event.
+	server: The TeamtalkServer the event came from.
+	name: The event name, such as loggedin.
+	parms: The event's parameters as an AttrDict.
+	line: The ParmLine the event came from, or None for output events.
+	stage: When the event was published; see stages.
+	time: When the event was published.
+	"""
+	__slots__ = ("server", "name", "parms", "line", "stage", "time")
+
+	def __init__(self, server, name, parms, line=None, stage="handled"):
+		self.server = server
+		self.name = name
+		self.parms = parms
+		self.line = line
+		self.stage = stage
+		self.time = time()
+
+class Subscription(object):
+	"""One subscriber's registration, queue, and handling thread.
+	Made by EventBus.subscribe(); see there for the parameters.
+	"""
+	def __init__(self, name, handler, events=None, servers=None, parms=None,
+		where=None, stage="handled", maxQueue=10000, block=False, slowAfter=5.0
+	):
+		if stage not in stages:
+			raise ValueError("Unknown stage %s; use %s" % (stage, ", ".join(stages)))
+		self.name = name
+		self.handler = handler
+		self.events = frozenset([e.lower() for e in events]) if events else None
+		self.servers = frozenset(servers) if servers else None
+		self.parms = parms or {}
+		self.where = where
+		self.stage = stage
+		self.maxQueue = maxQueue
+		self.block = block
+		self.slowAfter = slowAfter
+		self.bus = None
+		self._q = Queue.Queue(maxQueue)
+		self._thread = None
+		self._lock = threading.Lock()
+		self.delivered = 0
+		self.handled = 0
+		self.dropped = 0
+		self.errors = 0
+		self.maxLag = 0.0
+		self.slow = False
+
+	@property
+	def depth(self):
+		return self._q.qsize()
+
+	def matches(self, event):
+		"""Return True if this subscription wants event.
+		The event name, stage, and server are already checked by the bus index.
+		"""
+		for k,want in self.parms.items():
+			val = event.parms.get(k)
+			if val is None: return False
+			if callable(want):
+				if not want(val): return False
+			elif hasattr(want, "match"):
+				if not want.match(val): return False
+			elif val.lower() != want.lower(): return False
+		if self.where and not self.where(event): return False
+		return True
+
+	def deliver(self, event):
+		"""Queue event for this subscriber.
+		"""
+		if not self._thread: self._start()
+		if self.block:
+			self._q.put(event)
+		else:
+			try: self._q.put_nowait(event)
+			except Queue.Full:
+				self.dropped += 1
+				self._setSlow("queue full, dropping events")
+				return
+		self.delivered += 1
+		if not self.slow and self._q.qsize() >= self.maxQueue *3 /4:
+			self._setSlow("queue %d of %d" % (self._q.qsize(), self.maxQueue))
+
+	def _start(self):
+		with self._lock:
+			if self._thread: return
+			th = threading.Thread(target=self._run)
+			th.daemon = True
+			th.name = "bus_" +self.name.replace(" ", "_")
+			th.start()
+			self._thread = th
+
+	def _run(self):
+		while True:
+			event = self._q.get()
+			if event is None:
+				self._thread = None
+				return
+			lag = time() -event.time
+			if lag > self.maxLag: self.maxLag = lag
+			if lag > self.slowAfter:
+				self._setSlow("events waiting %0.1f seconds" % (lag))
+			elif self.slow and self._q.empty():
+				self.slow = False
+			try: self.handler(event)
+			except Exception:
+				self.errors += 1
+				if self.bus: self.bus.report("Subscriber %s failed on %s: %s" % (self.name, event.name, err()))
+			self.handled += 1
+
+	def _setSlow(self, reason):
+		if self.slow: return
+		self.slow = True
+		if self.bus: self.bus.report("Slow event subscriber %s: %s" % (self.name, reason))
+
+	def stop(self):
+		"""Let the handling thread finish what is queued and exit.
+		"""
+		if self._thread: self._q.put(None)
+
+class EventBus(object):
+	"""Delivers published events to matching subscriptions.
+	Subscriptions are indexed by stage, server, and event name,
+	so publishing costs a few dict lookups plus the subscribers that match.
+	"""
+	def __init__(self, report=None):
+		self.report = report or self._print
+		self.subscriptions = []
+		self._index = {}
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def _print(text):
+		print text
+
+	def subscribe(self, name, handler, **kwargs):
+		"""Register handler(event) for events and return the Subscription.
+		name: A name for reports, such as "log" or "triggers simon".
+		events: Event names to receive, or None for all.
+		servers: Server shortnames to receive events from, or None for all.
+		parms: Parameter predicates, all of which must hold: each value is
+			a string the parameter must equal (ignoring case), a compiled regexp
+			it must match, or a function of the value returning True or False.
+			Events without the parameter never match.
+		where: A function of the Event returning True for events to receive.
+		stage: received, handled (the default), or output.
+		maxQueue: Events held before the subscriber is behind; default 10000.
+		block: True to make publishers wait for room instead of dropping events.
+		slowAfter: Seconds an event may wait before the subscriber is reported slow.
+		"""
+		return self.add(Subscription(name, handler, **kwargs))
+
+	def add(self, sub):
+		"""Register a Subscription, such as one removed earlier.
+		"""
+		with self._lock:
+			sub.bus = self
+			self.subscriptions.append(sub)
+			self._reindex()
+		return sub
+
+	def unsubscribe(self, sub):
+		"""Remove a subscription. Events already queued for it are still handled.
+		"""
+		with self._lock:
+			if sub not in self.subscriptions: return
+			self.subscriptions.remove(sub)
+			self._reindex()
+		sub.stop()
+
+	def _reindex(self):
+		# Built anew and swapped in whole, so publish() needs no lock.
+		index = {}
+		for sub in self.subscriptions:
+			for server in sub.servers or [None]:
+				for event in sub.events or [None]:
+					index.setdefault((sub.stage, server, event), []).append(sub)
+		self._index = index
+
+	def publish(self, server, name, parms, line=None, stage="handled"):
+		"""Deliver an event to each subscription that wants it.
+		Returns the Event, or None if nobody wanted it.
+		"""
+		index = self._index
+		shortname = server.shortname
+		subs = []
+		for key in ((stage, shortname, name), (stage, shortname, None), (stage, None, name), (stage, None, None)):
+			found = index.get(key)
+			if found: subs.extend(found)
+		if not subs: return None
+		if not isinstance(parms, AttrDict): parms = AttrDict(parms)
+		event = Event(server, name, parms, line, stage)
+		for sub in subs:
+			if sub.matches(event): sub.deliver(event)
+		return event
+
+	def publishLine(self, server, parmline, stage="handled"):
+		"""Publish a ParmLine from a server.
+		"""
+		return self.publish(server, parmline.event, parmline.parms, parmline, stage)
+
+	def stats(self):
+		"""Return a dict of counts for each subscription, keyed by name.
+		"""
+		return dict([(sub.name, {"depth": sub.depth,
+			"delivered": sub.delivered,
+			"handled": sub.handled,
+			"dropped": sub.dropped,
+			"errors": sub.errors,
+			"maxLag": sub.maxLag,
+			"slow": sub.slow,
+		}) for sub in self.subscriptions])
+
+# The bus all servers publish to.
+bus = EventBus()
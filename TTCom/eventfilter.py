@@ -0,0 +1,117 @@
+"""Per-server rules for which incoming events TTCom pays attention to.
+The connection's reader thread checks each line against the rules
+before it is parsed, so unwanted events cost one prefix test.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import re
+
+# What classify() says to do with a line.
+PASS = 0  # Parse, dispatch, log, and trigger as usual.
+QUIET = 1  # Parse and dispatch to keep state current, but don't output, log, or trigger.
+DROP = 2  # Don't even parse.
+
+# Events that change what TTCom knows about a server or drive its login and command handling.
+# These are never dropped, only quieted.
+stateEvents = frozenset([
+	"welcome", "accepted", "ok", "error", "begin", "end", "kicked",
+	"serverupdate", "loggedin", "loggedout", "adduser", "removeuser", "updateuser",
+	"addchannel", "updatechannel", "removechannel", "addfile", "removefile",
+])
+
+ruleFormat = re.compile(r'^([a-z_]+)(?:\+([a-z0-9_]+))?$')
+
+def parseRules(spec):
+	"""Parse an events= or ignoreEvents= setting into a dict of event name to parameter names.
+	Rules are separated by spaces or commas. Each is an event name, which
+	matches every line of that event, or event+parm, which matches only those
+	lines that include parm. A None among an event's parameter names means the whole event.
+	Raises ValueError on a malformed rule.
+	"""
+	rules = {}
+	for item in spec.replace(",", " ").lower().split():
+		m = ruleFormat.match(item)
+		if not m:
+			raise ValueError("Invalid event rule: %s" % (item))
+		event,parm = m.groups()
+		rules.setdefault(event, []).append(parm)
+	return rules
+
+class EventFilter(object):
+	"""Decides which incoming lines a server parses, dispatches, logs, and triggers on.
+	include: Rules for the only events wanted, or empty to want all events.
+	exclude: Rules for events not wanted even if included.
+	Both are dicts as returned by parseRules().
+	keep: A function of an event name and line (as given to classify())
+		that returns True for lines something else needs, such as a trigger;
+		these pass whatever the rules say.
+	Unwanted state events are quieted rather than dropped so the
+	server's user and channel tables stay correct.
+	"""
+	def __init__(self, include=None, exclude=None, keep=None):
+		self.include = include or {}
+		self.exclude = exclude or {}
+		self.keep = keep
+		# One startswith() call finds lines that no rule mentions.
+		self._prefixes = tuple(set(self.include) | set(self.exclude))
+		self.dropped = 0
+		self.quieted = 0
+
+	def __nonzero__(self):
+		return bool(self._prefixes)
+
+	@staticmethod
+	def _matches(parms, rest):
+		"""Return True if any of parms (a rule's parameter list) matches rest, a line without its event name.
+		"""
+		for parm in parms:
+			if parm is None: return True
+			if rest.startswith(parm +"=") or (" " +parm +"=") in rest:
+				return True
+		return False
+
+	def skips(self, event):
+		"""Return True if the rules would keep some or all lines of event from triggers.
+		"""
+		if self.include:
+			parms = self.include.get(event)
+			if parms is None or None not in parms: return True
+		return event in self.exclude
+
+	def classify(self, line):
+		"""Return PASS, QUIET, or DROP for a line, which must be stripped and lower-cased.
+		"""
+		if not line.startswith(self._prefixes):
+			if not self.include: return PASS
+			event = line.partition(" ")[0]
+		else:
+			event,sep,rest = line.partition(" ")
+			if self.include:
+				parms = self.include.get(event)
+				wanted = parms is not None and self._matches(parms, rest)
+			else:
+				wanted = True
+			if wanted:
+				parms = self.exclude.get(event)
+				if parms is None or not self._matches(parms, rest): return PASS
+		if self.keep and self.keep(event, line): return PASS
+		if event in stateEvents:
+			self.quieted += 1
+			return QUIET
+		self.dropped += 1
+		return DROP
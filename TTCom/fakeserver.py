@@ -0,0 +1,469 @@
+#! /usr/bin/env python
+
+"""A stand-in TeamTalk server for load and regression testing TTCom.
+Speaks the subset of the TeamTalk text protocol that TTCom uses,
+on localhost, for any number of simulated servers at once.
+Each simulated server has its own users, channels, accounts, and bans,
+generated from a seed so that runs are repeatable, and can generate
+user churn at configurable rates while clients are connected.
+
+Usage:
+	python fakeserver.py [options]
+For example, 50 servers on ports 20000 through 20049, each with
+10000 users in 500 channels and 20 status updates a second:
+	python fakeserver.py -p 20000 -s 50 -u 10000 -c 500 -r updateuser:20
+Point ttcom.conf server entries at host=localhost and those ports.
+Very large loads are best spread over several of these processes,
+each given its own range of ports.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import sys, socket, random, argparse
+import asyncore, asynchat
+from time import time
+from parmline import ParmLine
+
+# Error numbers sent for the failures this server reports.
+ERR_SYNTAX = 1000
+ERR_UNKNOWN_COMMAND = 1001
+ERR_NOT_LOGGEDIN = 2004
+ERR_USER_NOT_FOUND = 3002
+ERR_CHANNEL_NOT_FOUND = 3003
+
+# Events the churn generator can produce; see FakeServer.generate().
+generatedEvents = ("updateuser", "moveuser", "loggedin", "loggedout", "messagedeliver")
+
+def parseRates(spec):
+	"""Parse a rate spec like "updateuser:20 loggedin:0.5" into a dict of event to events per second.
+	Raises ValueError on an unknown event or bad number.
+	"""
+	rates = {}
+	for item in spec.replace(",", " ").split():
+		event,sep,rate = item.partition(":")
+		if event not in generatedEvents:
+			raise ValueError("Can't generate %s events; use %s" % (event, ", ".join(generatedEvents)))
+		rates[event] = float(rate or "1")
+	return rates
+
+class FakeWorld(object):
+	"""The users, channels, accounts, and bans of one simulated server.
+	Users and channels are dicts of protocol parameters keyed by id.
+	"""
+	def __init__(self, name, nUsers=100, nChannels=10, nAccounts=50, nBans=10, seed=0):
+		self.name = name
+		self.rand = random.Random(seed)
+		self.users = {}
+		self.channels = {}
+		self.accounts = []
+		self.bans = []
+		self._nextUserid = 1
+		self._nextChannelid = 1
+		self.addChannel(None, "")
+		for i in range(1, nChannels):
+			parent = self.rand.choice(self.channels.keys()) if i > 5 else "1"
+			self.addChannel(parent, "Channel %d" % (i))
+		for i in range(nUsers):
+			self.addUser()
+		for i in range(nAccounts):
+			self.accounts.append({"username": "user%d" % (i), "password": "pw%d" % (i),
+				"usertype": self.rand.choice(("1", "1", "1", "2")),
+				"userrights": "259591", "note": "", "userdata": "0",
+				"initchan": "", "autooperatorchannels": "",
+			})
+		for i in range(nBans):
+			self.bans.append({"ipaddr": self.randomAddress(),
+				"username": "user%d" % (self.rand.randrange(max(nAccounts, 1))),
+				# Seconds since the epoch, as TTCom reads it, in 2017.
+				"channel": "", "bantime": str(1483272000 +self.rand.randrange(365 *86400)),
+				"nickname": "Banned %d" % (i), "owner": "admin", "type": "1",
+			})
+
+	def randomAddress(self):
+		return "10.%d.%d.%d" % (self.rand.randrange(256), self.rand.randrange(256), self.rand.randrange(1, 255))
+
+	def addChannel(self, parentid, name):
+		"""Create a channel under parentid, or the root channel if parentid is None.
+		"""
+		chanid = str(self._nextChannelid)
+		self._nextChannelid += 1
+		if parentid is None: path = "/"
+		else: path = self.channels[parentid]["channel"] +name +"/"
+		self.channels[chanid] = {"channelid": chanid, "parentid": parentid or "0",
+			"channel": path, "name": name, "topic": "", "password": "",
+			"protected": "0", "userlimit": "1000", "diskquota": "0",
+		}
+		return self.channels[chanid]
+
+	def newUserid(self):
+		userid = str(self._nextUserid)
+		self._nextUserid += 1
+		return userid
+
+	def addUser(self, nickname=None, username=None, channelid=None):
+		"""Create a simulated user, in a random channel unless channelid is given ("0" for none).
+		"""
+		userid = self.newUserid()
+		if channelid is None:
+			channelid = self.rand.choice(self.channels.keys()) if self.rand.random() < 0.7 else "0"
+		self.users[userid] = {"userid": userid,
+			"nickname": nickname if nickname is not None else "Fake User %s" % (userid),
+			"username": username if username is not None else "user%s" % (self.rand.randrange(1000)),
+			"ipaddr": self.randomAddress(), "udpaddr": "0.0.0.0:0",
+			"statusmode": "0", "statusmsg": "", "usertype": "1",
+			"version": "5.2.3", "clientname": "FakeClient", "channelid": channelid,
+		}
+		return self.users[userid]
+
+	def userLine(self, event, user):
+		"""Return the loggedin, updateuser, or loggedout line for user.
+		"""
+		parms = dict(user)
+		del parms["channelid"]
+		return line(event, parms)
+
+	def channelLine(self, event, user, channelid=None):
+		"""Return the adduser or removeuser line for user and a channel, by default the user's own.
+		"""
+		parms = dict(user)
+		if channelid is not None: parms["channelid"] = channelid
+		return line(event, parms)
+
+	def loginDump(self):
+		"""Return the lines a server sends between accepted and ok on login.
+		"""
+		lines = [line("serverupdate", self.serverParms())]
+		for chanid in sorted(self.channels, key=int):
+			lines.append(line("addchannel", self.channels[chanid]))
+		users = self.users.values()
+		for user in users:
+			lines.append(self.userLine("loggedin", user))
+		for user in users:
+			if user["channelid"] != "0":
+				lines.append(self.channelLine("adduser", user))
+		return lines
+
+	def serverParms(self):
+		return {"servername": self.name, "maxusers": "100000", "usertimeout": "60",
+			"motd": "Fake server for testing", "version": "5.2.3",
+		}
+
+def line(event, parms):
+	"""Return a protocol line for event and a dict of parameters.
+	"""
+	return ParmLine(event, parms).line +"\r\n"
+
+class FakeClient(asynchat.async_chat):
+	"""One client connection to a FakeServer.
+	"""
+	def __init__(self, sock, server):
+		asynchat.async_chat.__init__(self, sock)
+		self.server = server
+		self.set_terminator("\n")
+		self._buf = []
+		# Functions to call once the current command's reply is sent.
+		self._afterReply = []
+		self.user = dict(server.world.addUser("", "", "0"))
+		# Not visible to anyone until logged in.
+		del server.world.users[self.user["userid"]]
+		self.push(line("teamtalk", dict(server.world.serverParms(),
+			userid=self.user["userid"], protocol="5.0",
+		)))
+
+	def collect_incoming_data(self, data):
+		self._buf.append(data)
+
+	def found_terminator(self):
+		text = "".join(self._buf).strip()
+		self._buf = []
+		if not text: return
+		self.server.linesIn += 1
+		try: cmd = ParmLine(text)
+		except ValueError:
+			self.push(line("error", {"number": ERR_SYNTAX, "message": "Syntax error"}))
+			return
+		id = cmd.parms.pop("id", None)
+		func = getattr(self, "cmd_" +cmd.event.lower(), None)
+		if func and cmd.event.lower() not in ("login", "ping") and not self.loggedIn:
+			func = self.notLoggedIn
+		elif not func:
+			func = self.unknownCommand
+		reply = func(cmd.parms)
+		if id is not None:
+			reply.insert(0, "begin id=%s\r\n" % (id))
+			reply.append("end id=%s\r\n" % (id))
+		self.push("".join(reply))
+		after,self._afterReply = self._afterReply,[]
+		for func in after: func()
+
+	@property
+	def loggedIn(self):
+		return self.user["userid"] in self.server.world.users
+
+	def handle_close(self):
+		if self.loggedIn: self.server.logout(self.user)
+		self.server.clients.discard(self)
+		self.close()
+
+	def ok(self):
+		return [line("ok", {})]
+
+	def error(self, number, message):
+		return [line("error", {"number": number, "message": message})]
+
+	def notLoggedIn(self, parms):
+		return self.error(ERR_NOT_LOGGEDIN, "Not logged in")
+
+	def unknownCommand(self, parms):
+		return self.error(ERR_UNKNOWN_COMMAND, "Unknown command")
+
+	def cmd_ping(self, parms):
+		return ["pong\r\n"]
+
+	def cmd_login(self, parms):
+		world = self.server.world
+		if self.loggedIn: return self.ok()
+		self.user.update({"nickname": parms.nickname or "",
+			"username": parms.username or "", "usertype": "2",
+			"userrights": "259591", "clientname": parms.clientname or "",
+			"version": parms.version or "",
+		})
+		reply = [world.userLine("accepted", self.user)]
+		reply.extend(world.loginDump())
+		reply.extend(self.ok())
+		# Others hear of this login only after its reply, as from a real server.
+		self._afterReply.append(lambda: self.server.login(self.user, False))
+		return reply
+
+	def cmd_logout(self, parms):
+		self.server.logout(self.user)
+		self.close_when_done()
+		return self.ok()
+
+	def cmd_listaccounts(self, parms):
+		reply = [line("useraccount", acct) for acct in self.server.world.accounts]
+		return reply +self.ok()
+
+	def cmd_listbans(self, parms):
+		reply = [line("userbanned", ban) for ban in self.server.world.bans]
+		return reply +self.ok()
+
+	def cmd_message(self, parms):
+		"""Deliver a user (type 1), channel (type 2), or broadcast (type 3) message to connected clients.
+		"""
+		msgtype = parms.type or "1"
+		msg = {"type": msgtype, "srcuserid": self.user["userid"], "content": parms.content or ""}
+		if msgtype == "1":
+			if parms.get("destuserid") not in self.server.world.users:
+				return self.error(ERR_USER_NOT_FOUND, "User not found")
+			msg["destuserid"] = parms.destuserid
+			dests = [c for c in self.server.clients if c.user["userid"] == parms.destuserid]
+		elif msgtype == "2":
+			chanid = parms.chanid
+			if chanid not in self.server.world.channels:
+				return self.error(ERR_CHANNEL_NOT_FOUND, "Channel not found")
+			msg["chanid"] = chanid
+			dests = [c for c in self.server.clients if c.user["channelid"] == chanid and c is not self]
+		else:
+			dests = [c for c in self.server.clients if c is not self]
+		self.server.sendTo(dests, line("messagedeliver", msg))
+		return self.ok()
+
+	def cmd_moveuser(self, parms):
+		world = self.server.world
+		user = world.users.get(parms.get("userid"))
+		if not user: return self.error(ERR_USER_NOT_FOUND, "User not found")
+		chanid = parms.chanid
+		if chanid not in world.channels:
+			return self.error(ERR_CHANNEL_NOT_FOUND, "Channel not found")
+		self.server.move(user, chanid)
+		return self.ok()
+
+	def cmd_kick(self, parms):
+		"""Kick a user from a channel if chanid is given and nonzero, otherwise from the server.
+		"""
+		world = self.server.world
+		user = world.users.get(parms.get("userid"))
+		if not user: return self.error(ERR_USER_NOT_FOUND, "User not found")
+		chanid = parms.chanid or "0"
+		if chanid not in ("", "0"):
+			if user["channelid"] != chanid:
+				return self.error(ERR_USER_NOT_FOUND, "User not in channel")
+			self.server.move(user, "0")
+			return self.ok()
+		for client in list(self.server.clients):
+			if client.user["userid"] == user["userid"]:
+				client.push(line("kicked", {"kickerid": self.user["userid"]}))
+				client.close_when_done()
+		self.server.logout(user)
+		return self.ok()
+
+class FakeServer(asyncore.dispatcher):
+	"""One simulated TeamTalk server listening on a port.
+	rates: Events per second to generate while clients are connected; see parseRates().
+	"""
+	def __init__(self, world, host="127.0.0.1", port=10333, rates=None):
+		asyncore.dispatcher.__init__(self)
+		self.world = world
+		self.rates = rates or {}
+		self.clients = set()
+		self.linesIn = 0
+		self.linesOut = 0
+		self._due = dict.fromkeys(self.rates, 0.0)
+		# Logged-in users that are not clients, kept as events change them
+		# so picking one costs the same however many there are.
+		self._simulated = []
+		self._simIndex = {}
+		for user in world.users.values():
+			self._addSimulated(user)
+		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.set_reuse_addr()
+		self.bind((host, port))
+		self.listen(64)
+
+	def handle_accept(self):
+		pair = self.accept()
+		if pair is None: return
+		sock,addr = pair
+		self.clients.add(FakeClient(sock, self))
+
+	def sendTo(self, clients, text):
+		for client in clients:
+			client.push(text)
+			self.linesOut += 1
+
+	def broadcast(self, text, exclude=None):
+		self.sendTo([c for c in self.clients if c.loggedIn and c is not exclude], text)
+
+	def _addSimulated(self, user):
+		self._simIndex[user["userid"]] = len(self._simulated)
+		self._simulated.append(user)
+
+	def _dropSimulated(self, userid):
+		i = self._simIndex.pop(userid, None)
+		if i is None: return
+		# Move the last user into the gap.
+		last = self._simulated.pop()
+		if i < len(self._simulated):
+			self._simulated[i] = last
+			self._simIndex[last["userid"]] = i
+
+	def login(self, user, simulated=True):
+		"""Log in user; simulated is False for a client's own user.
+		"""
+		self.world.users[user["userid"]] = user
+		if simulated: self._addSimulated(user)
+		self.broadcast(self.world.userLine("loggedin", user))
+
+	def logout(self, user):
+		if user["userid"] not in self.world.users: return
+		if user["channelid"] != "0": self.move(user, "0")
+		self.broadcast(self.world.userLine("loggedout", user))
+		del self.world.users[user["userid"]]
+		self._dropSimulated(user["userid"])
+
+	def move(self, user, chanid):
+		"""Move user to channel chanid, or out of all channels if chanid is "0".
+		"""
+		if user["channelid"] != "0":
+			self.broadcast(self.world.channelLine("removeuser", user))
+		user["channelid"] = chanid
+		if chanid != "0":
+			self.broadcast(self.world.channelLine("adduser", user))
+
+	def simulatedUsers(self):
+		"""Return the logged-in users that are not clients, as a list not to be changed.
+		"""
+		return self._simulated
+
+	def generate(self, elapsed):
+		"""Generate the events due after elapsed seconds at the configured rates.
+		"""
+		if not self.clients: return
+		world = self.world
+		rand = world.rand
+		for event,rate in self.rates.items():
+			self._due[event] += rate *elapsed
+			count = int(self._due[event])
+			self._due[event] -= count
+			for i in range(count):
+				users = self.simulatedUsers()
+				if event == "loggedin" or not users:
+					user = world.addUser()
+					del world.users[user["userid"]]
+					chanid = user["channelid"]
+					user["channelid"] = "0"
+					self.login(user)
+					if chanid != "0": self.move(user, chanid)
+					continue
+				user = rand.choice(users)
+				if event == "updateuser":
+					user["statusmode"] = str(rand.choice((0, 1, 2, 256, 257)))
+					user["statusmsg"] = rand.choice(("", "Away", "Busy", "Back soon"))
+					self.broadcast(world.userLine("updateuser", user))
+				elif event == "moveuser":
+					self.move(user, rand.choice(world.channels.keys()))
+				elif event == "loggedout":
+					self.logout(user)
+				elif event == "messagedeliver":
+					for client in self.clients:
+						if not client.loggedIn: continue
+						self.sendTo([client], line("messagedeliver", {"type": "1",
+							"srcuserid": user["userid"], "destuserid": client.user["userid"],
+							"content": "Message %d" % (rand.randrange(1000000)),
+						}))
+
+def run(servers, duration=None, tick=0.05):
+	"""Serve until interrupted or for duration seconds, generating events every tick seconds.
+	"""
+	start = last = time()
+	while duration is None or time() -start < duration:
+		asyncore.loop(timeout=tick, use_poll=True, count=1)
+		now = time()
+		if now -last >= tick:
+			for server in servers: server.generate(now -last)
+			last = now
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description="Stand-in TeamTalk server(s) for testing TTCom")
+	parser.add_argument("-H", "--host", default="127.0.0.1", help="Address to listen on")
+	parser.add_argument("-p", "--port", type=int, default=10333, help="First port to listen on")
+	parser.add_argument("-s", "--servers", type=int, default=1, help="Servers to simulate, on consecutive ports")
+	parser.add_argument("-u", "--users", type=int, default=100, help="Users per server")
+	parser.add_argument("-c", "--channels", type=int, default=10, help="Channels per server")
+	parser.add_argument("-a", "--accounts", type=int, default=50, help="Accounts per server")
+	parser.add_argument("-b", "--bans", type=int, default=10, help="Bans per server")
+	parser.add_argument("-r", "--rates", default="", help='Events per second per server, e.g. "updateuser:20 moveuser:2"')
+	parser.add_argument("--seed", type=int, default=0, help="Seed for generated data")
+	parser.add_argument("-t", "--time", type=float, default=None, help="Seconds to run before exiting")
+	opts = parser.parse_args(args)
+	try: rates = parseRates(opts.rates)
+	except ValueError as e: parser.error(str(e))
+	servers = []
+	for i in range(opts.servers):
+		world = FakeWorld("Fake %d" % (i+1), opts.users, max(opts.channels, 1),
+			opts.accounts, opts.bans, opts.seed +i
+		)
+		servers.append(FakeServer(world, opts.host, opts.port +i, rates))
+	print "Serving %d fake server(s) on %s ports %d-%d" % (len(servers),
+		opts.host, opts.port, opts.port +len(servers) -1
+	)
+	try: run(servers, opts.time)
+	except KeyboardInterrupt: pass
+
+if __name__ == "__main__":
+	main()
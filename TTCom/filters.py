@@ -0,0 +1,215 @@
+"""Compiled filters for the listing and selection commands.
+A filter list such as ["usertype=2", "!username=admin", "bob"] is parsed
+once into a FilterSet, which is then applied to any number of records.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import re, operator
+
+# fieldname, operator, value.
+# Operators: = exact, *= substring, ~= regular expression,
+# > >= < <= numeric comparison, & any bit of a mask set.
+termPattern = re.compile(r'^(?P<invert>!?)(?P<field>[A-Za-z_][A-Za-z0-9_]*)(?P<op>\*=|~=|>=|<=|=|>|<|&)(?P<value>.*)$')
+
+numericOps = {
+	">": operator.gt, ">=": operator.ge,
+	"<": operator.lt, "<=": operator.le,
+	"&": lambda n, mask: bool(n & mask),
+}
+
+def toText(val):
+	"""Return val as a unicode string, or None if it cannot be converted.
+	"""
+	if isinstance(val, basestring): return val
+	try: return unicode(val)
+	except:
+		try: return str(val)
+		except: return None
+
+def toNumber(val):
+	"""Return val as an integer, accepting 0x and 0 prefixes, or None if it is not a number.
+	"""
+	if val is None: return None
+	try: return int(val)
+	except (TypeError, ValueError): pass
+	try: return int(val, 0)
+	except (TypeError, ValueError): return None
+
+class FilterTerm(object):
+	"""One compiled fieldname/operator/value filter.
+	passes(parms) is built once here, so checking a record costs a
+	dictionary lookup and one comparison.
+	"""
+	def __init__(self, field, op, value, invert=False):
+		self.field = field
+		self.op = op
+		self.value = value
+		self.invert = invert
+		if op == "=":
+			test = lambda actual: actual == value
+		elif op == "*=":
+			needle = value.lower()
+			test = lambda actual: actual is not None and needle in toText(actual).lower()
+		elif op == "~=":
+			try: pattern = re.compile(value, re.IGNORECASE | re.UNICODE)
+			except re.error as e:
+				raise ValueError("Bad regular expression for %s: %s" % (field, e))
+			search = pattern.search
+			test = lambda actual: actual is not None and search(toText(actual)) is not None
+		else:
+			wanted = toNumber(value)
+			if wanted is None:
+				raise ValueError("%s%s requires a number, not %s" % (field, op, value))
+			test = self._numericTest(numericOps[op], wanted)
+		self.test = test
+		dget = dict.get
+		def passes(parms):
+			actual = dget(parms, field)
+			# AttrDict.get also finds chanid as channelid and mixed-case keys.
+			if actual is None: actual = parms.get(field)
+			return test(actual) != invert
+		self.passes = passes
+
+	@staticmethod
+	def _numericTest(compare, wanted):
+		"""Return a test for compare(actual, wanted) on integer values.
+		Values that are not numbers never pass.
+		"""
+		def test(actual):
+			try: return compare(int(actual), wanted)
+			except (TypeError, ValueError):
+				n = toNumber(actual)
+				return n is not None and compare(n, wanted)
+		return test
+
+	def isIndexable(self):
+		"""True if this term can be answered from an index on its field.
+		"""
+		return self.op == "=" and not self.invert
+
+class TextTerm(object):
+	"""A free-text filter, matched case-insensitively against every field value.
+	"""
+	def __init__(self, text):
+		self.text = text.lower()
+
+	def passes(self, parms):
+		if isinstance(parms, dict): vals = parms.values()
+		else: vals = parms
+		# One join and one search is much faster than a search per value.
+		# The separator keeps a match from spanning two values.
+		try: vals = "\n".join(vals)
+		except TypeError:
+			vals = "\n".join([val for val in map(toText, vals) if val is not None])
+		return self.text in vals.lower()
+
+class AnonymousTerm(object):
+	"""Matches the anonymous account, whose username is empty.
+	"""
+	def passes(self, parms):
+		return parms.get("username") == ""
+
+class FilterSet(object):
+	"""A compiled list of filters; a record passes if it passes every one.
+	Usage:
+		flt = compileFilters(["usertype=2", "bob"])
+		if flt(parms): ...
+		matches = flt.select(records[, index])
+	"""
+	def __init__(self, terms):
+		self.terms = terms
+		# Cheap exact tests first, scans of every value last.
+		self._ordered = sorted(terms, key=lambda t: isinstance(t, TextTerm))
+
+	def __len__(self):
+		return len(self.terms)
+
+	def passes(self, parms):
+		for term in self._ordered:
+			if not term.passes(parms): return False
+		return True
+
+	def __call__(self, parms):
+		return self.passes(parms)
+
+	def _bestIndexTerm(self, index):
+		"""Return the indexable term that index narrows down the most, or None.
+		"""
+		best = None
+		for term in self.terms:
+			if not isinstance(term, FilterTerm) or not term.isIndexable(): continue
+			if term.field not in index: continue
+			if best is None or index.count(term.field, term.value) < index.count(best.field, best.value):
+				best = term
+		return best
+
+	def select(self, records, index=None):
+		"""Return the records, in order, that pass this filter set.
+		If index (a FieldIndex over the same records) covers a field tested
+		for an exact value, only the records it finds for that value are checked,
+		and they come back in the index's key order.
+		"""
+		if not self.terms: return list(records)
+		if index is not None:
+			term = self._bestIndexTerm(index)
+			if term is not None:
+				others = FilterSet([t for t in self._ordered if t is not term])
+				return [parms for parms in index.find(term.field, term.value)
+					if others.passes(parms)
+				]
+		if len(self._ordered) == 1: passes = self._ordered[0].passes
+		else: passes = self.passes
+		return [parms for parms in records if passes(parms)]
+
+def compileFilter(filter, nullIsAnonymousAccount=False):
+	"""Compile one filter string into a term object.
+	Raises ValueError for a bad regular expression.
+	"""
+	# ToDo: Bit of a kludge here.
+	if filter.startswith('"') and filter.endswith('"') and len(filter) > 1: filter = filter[1:-1]
+	elif filter.endswith('"') and '="' in filter: filter = filter.replace('="', '=', 1)[:-1]
+	m = termPattern.match(filter)
+	if m and (m.group("op") in ("=", "*=", "~=") or toNumber(m.group("value")) is not None):
+		return FilterTerm(m.group("field").lower(), m.group("op"), m.group("value"), bool(m.group("invert")))
+	# Anything else, including text like "tom&jerry", is matched the traditional way.
+	if "=" in filter:
+		# Field names that are not identifiers are still matched exactly.
+		fname,fvalWanted = filter.split("=", 1)
+		invert = False
+		if fname.startswith("!"):
+			fname = fname[1:]
+			invert = True
+		return FilterTerm(fname.lower(), "=", fvalWanted, invert)
+	if filter == "" and nullIsAnonymousAccount:
+		# Special case for matching the anonymous account in an account list.
+		return AnonymousTerm()
+	return TextTerm(filter)
+
+def compileFilters(filters, nullIsAnonymousAccount=False):
+	"""Compile a list of filter strings into a FilterSet.
+	Each filter is one of
+		fieldname=value: exact match
+		fieldname*=text: field contains text, case ignored
+		fieldname~=regexp: field matches a regular expression, case ignored
+		fieldname>=number, >, <=, <: numeric comparison
+		fieldname&mask: at least one bit of mask (e.g., 0x2) is set
+		text: any field contains text, case ignored
+	A "!" before fieldname inverts the test.
+	If nullIsAnonymousAccount is True, an empty filter matches only the anonymous account.
+	"""
+	return FilterSet([compileFilter(f, nullIsAnonymousAccount) for f in filters or []])
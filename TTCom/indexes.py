@@ -0,0 +1,171 @@
+"""Indexes of records by field value, for fast selection of users, accounts, and bans.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+class FieldIndex(object):
+	"""Index of records by the values of selected fields.
+	Usage:
+		idx = FieldIndex(["channelid", "ipaddr"])
+		idx.update(key, record)  # after adding or changing a record
+		idx.remove(key)  # after removing one
+		idx.find("ipaddr", "1.2.3.4")  # records with that exact value
+	Records are dicts or AttrDicts, identified by a key unique among them.
+	Keeping the index current is up to the owner of the records.
+	"""
+	def __init__(self, fields):
+		self.fields = tuple([field.lower() for field in fields])
+		self.clear()
+
+	def clear(self):
+		"""Forget all records.
+		"""
+		self._byField = dict([(field, {}) for field in self.fields])
+		self._values = {}
+
+	def __len__(self):
+		return len(self._values)
+
+	def __contains__(self, field):
+		return field.lower() in self._byField
+
+	def _valuesOf(self, record):
+		return tuple([record.get(field) for field in self.fields])
+
+	def update(self, key, record):
+		"""Index record, replacing any previous record indexed under key.
+		"""
+		values = self._valuesOf(record)
+		old = self._values.get(key)
+		if old is not None:
+			oldValues,oldRecord = old
+			if oldValues == values and oldRecord is record: return
+			self._unindex(key, oldValues)
+		self._values[key] = (values, record)
+		for field,value in zip(self.fields, values):
+			if value is None: continue
+			self._byField[field].setdefault(value, {})[key] = record
+
+	def remove(self, key):
+		"""Remove the record indexed under key, if there is one.
+		"""
+		old = self._values.pop(key, None)
+		if old is not None: self._unindex(key, old[0])
+
+	def _unindex(self, key, values):
+		for field,value in zip(self.fields, values):
+			if value is None: continue
+			bucket = self._byField[field].get(value)
+			if bucket is None: continue
+			bucket.pop(key, None)
+			if not bucket: del self._byField[field][value]
+
+	def count(self, field, value):
+		"""Return how many records have value in field.
+		"""
+		return len(self._byField[field.lower()].get(value, ()))
+
+	def find(self, field, value):
+		"""Return the records with value in field, in key order.
+		"""
+		bucket = self._byField[field.lower()].get(value)
+		if not bucket: return []
+		return [bucket[key] for key in sorted(bucket)]
+
+	def values(self, field):
+		"""Return the distinct values present in field.
+		"""
+		return self._byField[field.lower()].keys()
+
+class NgramIndex(object):
+	"""Index of texts by their n-grams (trigrams by default), for fast containment searches.
+	Usage:
+		idx = NgramIndex()
+		idx.update(key, text)  # after adding or changing what key is known by
+		idx.remove(key)
+		idx.search("bob")  # keys whose text contains "bob", case ignored
+	A search intersects the key sets of the query's n-grams, smallest first,
+	then confirms each remaining candidate with a real substring test.
+	Queries shorter than n fall back to scanning every text.
+	"""
+	def __init__(self, n=3):
+		self.n = n
+		self.clear()
+
+	def clear(self):
+		"""Forget all texts.
+		"""
+		self._grams = {}
+		self._texts = {}
+
+	def __len__(self):
+		return len(self._texts)
+
+	def _gramsOf(self, text):
+		n = self.n
+		return set([text[i:i+n] for i in xrange(len(text) -n +1)])
+
+	def update(self, key, text):
+		"""Index text for key, replacing what key was indexed under before.
+		"""
+		text = text.lower()
+		old = self._texts.get(key)
+		if old == text: return
+		oldGrams = self._gramsOf(old) if old is not None else set()
+		newGrams = self._gramsOf(text)
+		self._texts[key] = text
+		grams = self._grams
+		for gram in oldGrams -newGrams:
+			keys = grams.get(gram)
+			if keys is None: continue
+			keys.discard(key)
+			if not keys: del grams[gram]
+		for gram in newGrams -oldGrams:
+			keys = grams.get(gram)
+			if keys is None: grams[gram] = keys = set()
+			keys.add(key)
+
+	def remove(self, key):
+		"""Forget key and its text, if it is indexed.
+		"""
+		old = self._texts.pop(key, None)
+		if old is None: return
+		grams = self._grams
+		for gram in self._gramsOf(old):
+			keys = grams.get(gram)
+			if keys is None: continue
+			keys.discard(key)
+			if not keys: del grams[gram]
+
+	def search(self, query):
+		"""Return the keys whose text contains query, case ignored.
+		"""
+		query = query.lower()
+		texts = self._texts
+		if len(query) < self.n:
+			return [key for key,text in texts.items() if query in text]
+		sets = []
+		for gram in self._gramsOf(query):
+			keys = self._grams.get(gram)
+			if not keys: return []
+			sets.append(keys)
+		sets.sort(key=len)
+		candidates = set(sets[0])
+		for keys in sets[1:]:
+			candidates &= keys
+			if not candidates: return []
+		return [key for key in candidates if query in (texts.get(key) or "")]
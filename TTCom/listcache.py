@@ -0,0 +1,187 @@
+"""Per-server caches of account and ban lists.
+These save a listaccounts or listbans round trip, and the parsing of
+its whole result, on every command that needs the list.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import re
+import threading
+from time import time
+from mycmd import CommandError
+from indexes import FieldIndex
+
+class ListCache(object):
+	"""The cached response to one listing command on one server.
+	Usage:
+		cache = ListCache(server, "listbans"[, ttl])
+		lines = cache.get()  # list of ParmLines, fetched if necessary
+		cache.invalidate()  # after something changes the list on the server
+	Cached lines are reused for ttl seconds, as long as the server
+	connection that fetched them remains up. A ttl of 0 disables caching.
+	Callers must not modify what they are given.
+	Subclasses set index to a FieldIndex of the cached records' parms.
+	"""
+	def __init__(self, server, command, ttl=300):
+		self.server = server
+		self.command = command
+		self.ttl = ttl
+		self._lines = None
+		self._fetched = 0
+		self._conn = None
+		self._refreshing = False
+		self.index = None
+
+	def isFresh(self):
+		"""Returns True if the cached list can be used without fetching.
+		"""
+		return (self._lines is not None
+			and self.ttl > 0
+			and self._conn is not None
+			and self._conn is self.server.conn
+			and time() -self._fetched < self.ttl
+		)
+
+	def get(self, refresh=False):
+		"""Return the list, fetching it first if it is not fresh or if refresh is True.
+		"""
+		# Keep hold of the lines checked, since invalidate() can clear them meanwhile.
+		lines = self._lines
+		if refresh or lines is None or not self.isFresh():
+			lines = self.fetch()
+		return lines
+
+	def fetch(self):
+		"""Fetch the list from the server and cache it.
+		Raises CommandError if the server does not end the list with an ok.
+		"""
+		conn = self.server.conn
+		lines = self.server.sendWithWait(self.command, True)
+		# Remove the final Ok event.
+		resp = None
+		if lines: resp = lines.pop()
+		if resp is None or resp.event != "ok":
+			# TODO: This ignores any but the last response line.
+			raise CommandError(resp or "No response to %s" % (self.command))
+		self.store(lines, conn)
+		return lines
+
+	def store(self, lines, conn):
+		"""Cache lines, fetched over connection conn.
+		Subclasses extend this to build their indexes.
+		"""
+		self._lines = lines
+		self._conn = conn
+		self._fetched = time()
+
+	def invalidate(self, refresh=True):
+		"""Forget the cached list.
+		If refresh is True and caching is on, fetch it again in the background.
+		"""
+		self._lines = None
+		if refresh and self.ttl > 0: self.refreshLater()
+
+	def refreshLater(self):
+		"""Fetch the list in a background thread.
+		The fetch queues behind any command already waiting on the server.
+		"""
+		if self._refreshing: return
+		self._refreshing = True
+		th = threading.Thread(target=self._refresh)
+		th.daemon = True
+		th.name = self.server.shortname +"_" +self.command +"_" +th.name
+		th.start()
+
+	def _refresh(self):
+		"""Does the work for refreshLater().
+		"""
+		try:
+			if self.server.state == "loggedIn": self.fetch()
+		except Exception: pass
+		finally: self._refreshing = False
+
+class BanCache(ListCache):
+	"""Cache of a server's bans, indexed by IP address, username, and channel.
+	"""
+	def __init__(self, server, ttl=300):
+		ListCache.__init__(self, server, "listbans", ttl)
+
+	def store(self, lines, conn):
+		index = FieldIndex(("ipaddr", "username", "channel"))
+		for i,ban in enumerate(lines):
+			index.update(i, ban.parms)
+		self.index = index
+		ListCache.store(self, lines, conn)
+
+class AccountCache(ListCache):
+	"""Cache of a server's accounts, indexed by exact, lower-case, and normalized username.
+	The normalized form ignores case, spaces, and punctuation, so that
+	names like "Doug.Lee" and "douglee" are found as similar.
+	"""
+	namePunctuation = re.compile(r'''[\s.,?/;:@#$%^&*'"!+=_-]+''')
+
+	def __init__(self, server, ttl=300):
+		ListCache.__init__(self, server, "listaccounts", ttl)
+		self.byName = {}
+		self.byLower = {}
+		self.byNormalized = {}
+
+	@classmethod
+	def normalize(cls, username):
+		"""Return the form of username used to find similar names.
+		"""
+		return cls.namePunctuation.sub('', username.lower())
+
+	def store(self, lines, conn):
+		byName = {}
+		byLower = {}
+		byNormalized = {}
+		index = FieldIndex(("usertype",))
+		for acct in lines:
+			if acct.event == "ok": continue
+			username = acct.parms.username
+			byName[username] = acct
+			byLower.setdefault(username.lower(), []).append(username)
+			byNormalized.setdefault(self.normalize(username), []).append(username)
+			index.update(username, acct.parms)
+		self.byName = byName
+		self.byLower = byLower
+		self.byNormalized = byNormalized
+		self.index = index
+		ListCache.store(self, lines, conn)
+
+	def accounts(self, refresh=False):
+		"""Return a dict of ParmLines, one for each account, keyed by username.
+		"""
+		self.get(refresh)
+		return dict(self.byName)
+
+	def sameLetters(self, username):
+		"""Return the usernames other than username itself that differ from it only by letter casing.
+		"""
+		self.get()
+		return [u for u in self.byLower.get(username.lower(), []) if u != username]
+
+	def similar(self, username):
+		"""Return the usernames that match username when normalized,
+		excluding username itself and names that differ from it only by casing.
+		"""
+		self.get()
+		lower = username.lower()
+		return [u for u in self.byNormalized.get(self.normalize(username), [])
+			if u.lower() != lower
+		]
@@ -0,0 +1,198 @@
+"""Prometheus metrics for TTCom, served over HTTP on a local port or a Unix socket.
+Every value served is a running total or size kept as events happen
+(see TeamtalkServer.eventCounts, reconnects, commandTimeouts, and pingRTT,
+and the event bus subscription counts),
+so a scrape reads a few numbers per server and never walks user or channel tables.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os, threading, resource, SocketServer
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from ttapi import ServerState
+from eventbus import bus
+
+def escape(value):
+	"""Escape a label value for the Prometheus text format.
+	"""
+	value = unicode(value)
+	return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def parseAddress(spec):
+	"""Parse a metrics= option into an address to listen on.
+	A port number or host:port listens on TCP, by default on 127.0.0.1;
+	anything containing a slash is a Unix socket path.
+	Raises ValueError for anything else.
+	"""
+	spec = spec.strip()
+	if "/" in spec: return spec
+	host,sep,port = spec.rpartition(":")
+	return (host or "127.0.0.1", int(port))
+
+def residentBytes():
+	"""Return this process's resident memory size in bytes.
+	Falls back to the peak size where /proc is not available.
+	"""
+	try:
+		for line in open("/proc/self/status"):
+			if line.startswith("VmRSS:"):
+				return int(line.split()[1]) *1024
+	except (IOError, ValueError): pass
+	# Kilobytes on Linux, bytes on MacOS.
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if os.uname()[0] == "Darwin": return rss
+	return rss *1024
+
+class Metrics(object):
+	"""Collects metric lines in the Prometheus text format.
+	"""
+	def __init__(self):
+		self.lines = []
+
+	def family(self, name, kind, help):
+		self.lines.append("# HELP %s %s" % (name, help))
+		self.lines.append("# TYPE %s %s" % (name, kind))
+
+	def sample(self, name, value, **labels):
+		if value is None: return
+		if labels:
+			labels = ",".join(['%s="%s"' % (k, escape(v)) for k,v in sorted(labels.items())])
+			self.lines.append("%s{%s} %s" % (name, labels, value))
+		else:
+			self.lines.append("%s %s" % (name, value))
+
+	def text(self):
+		return u"\n".join(self.lines) +u"\n"
+
+def render(servers, outputQueue=None):
+	"""Return the metrics for servers, and for this process, as Prometheus text.
+	outputQueue is the queue of output held for the user, if any.
+	"""
+	servers = sorted(servers, key=lambda s: s.shortname.lower())
+	m = Metrics()
+	m.family("ttcom_server_state", "gauge", "1 for the connection state each server is in.")
+	for server in servers:
+		current = server._state.index
+		for i,state in enumerate(ServerState.states):
+			m.sample("ttcom_server_state", int(i == current), server=server.shortname, state=state)
+	m.family("ttcom_server_users", "gauge", "Users known on each server.")
+	for server in servers:
+		m.sample("ttcom_server_users", len(server.users), server=server.shortname)
+	m.family("ttcom_server_channels", "gauge", "Channels known on each server.")
+	for server in servers:
+		m.sample("ttcom_server_channels", len(server.channels), server=server.shortname)
+	m.family("ttcom_events_total", "counter", "Lines received from each server, by event type.")
+	for server in servers:
+		for event,count in sorted(server.eventCounts.items()):
+			m.sample("ttcom_events_total", count, server=server.shortname, event=event)
+	m.family("ttcom_reconnects_total", "counter", "Automatic reconnections started for each server.")
+	for server in servers:
+		m.sample("ttcom_reconnects_total", server.reconnects, server=server.shortname)
+	m.family("ttcom_command_timeouts_total", "counter", "Commands whose replies timed out, for each server.")
+	for server in servers:
+		m.sample("ttcom_command_timeouts_total", server.commandTimeouts, server=server.shortname)
+	m.family("ttcom_trigger_queue_depth", "gauge", "Events waiting for trigger processing on each server.")
+	for server in servers:
+		sub = getattr(server, "triggerSub", None)
+		if sub is not None:
+			m.sample("ttcom_trigger_queue_depth", sub.depth, server=server.shortname)
+	m.family("ttcom_trigger_actions_dropped_total", "counter", "Trigger firings whose actions were dropped by action policies, by trigger and reason.")
+	for server in servers:
+		triggers = getattr(server, "triggers", None)
+		if triggers is None: continue
+		for trigger in triggers.triggers.values():
+			if not trigger.policy: continue
+			for reason,count in sorted(trigger.policy.suppressed.items()):
+				m.sample("ttcom_trigger_actions_dropped_total", count, server=server.shortname, trigger=trigger.name, reason=reason)
+	subs = sorted(bus.subscriptions, key=lambda sub: sub.name)
+	m.family("ttcom_subscriber_queue_depth", "gauge", "Events waiting for each event bus subscriber.")
+	for sub in subs:
+		m.sample("ttcom_subscriber_queue_depth", sub.depth, subscriber=sub.name)
+	m.family("ttcom_subscriber_dropped_total", "counter", "Events dropped because an event bus subscriber was behind.")
+	for sub in subs:
+		m.sample("ttcom_subscriber_dropped_total", sub.dropped, subscriber=sub.name)
+	m.family("ttcom_subscriber_lag_max_seconds", "gauge", "Longest time an event waited for each event bus subscriber.")
+	for sub in subs:
+		m.sample("ttcom_subscriber_lag_max_seconds", "%0.3f" % (sub.maxLag), subscriber=sub.name)
+	m.family("ttcom_ping_rtt_seconds", "gauge", "Round trip time of the last keep-alive ping to each server.")
+	for server in servers:
+		m.sample("ttcom_ping_rtt_seconds", server.pingRTT(), server=server.shortname)
+	if outputQueue is not None:
+		m.family("ttcom_output_queue_depth", "gauge", "Output lines held for the user.")
+		m.sample("ttcom_output_queue_depth", len(outputQueue))
+	m.family("process_resident_memory_bytes", "gauge", "Resident memory size in bytes.")
+	m.sample("process_resident_memory_bytes", residentBytes())
+	m.family("ttcom_threads", "gauge", "Running Python threads.")
+	m.sample("ttcom_threads", threading.active_count())
+	return m.text()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	"""Answers every GET with the current metrics.
+	"""
+	def do_GET(self):
+		try: body = self.server.metrics().encode("utf-8")
+		except Exception as e:
+			self.send_error(500, str(e))
+			return
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def address_string(self):
+		# Unix socket clients have no address.
+		return str(self.client_address)
+
+	def log_message(self, format, *args):
+		pass
+
+class UnixHTTPServer(SocketServer.UnixStreamServer):
+	def get_request(self):
+		request,addr = SocketServer.UnixStreamServer.get_request(self)
+		return request, ("local", 0)
+
+class MetricsServer(object):
+	"""Serves metrics in a background thread.
+	Usage:
+		ms = MetricsServer(parseAddress("9464"), metricsFunc)
+		ms.start()
+	metricsFunc takes no arguments and returns the metrics text; see render().
+	"""
+	def __init__(self, address, metricsFunc):
+		self.address = address
+		self.metricsFunc = metricsFunc
+		self.httpd = None
+
+	def start(self):
+		"""Start listening. Raises socket.error if the address can't be used.
+		"""
+		if isinstance(self.address, basestring):
+			if os.path.exists(self.address): os.unlink(self.address)
+			httpd = UnixHTTPServer(self.address, MetricsHandler)
+		else:
+			httpd = HTTPServer(self.address, MetricsHandler)
+		httpd.metrics = self.metricsFunc
+		self.httpd = httpd
+		th = threading.Thread(target=httpd.serve_forever)
+		th.daemon = True
+		th.name = "metrics"
+		th.start()
+
+	def stop(self):
+		if self.httpd: self.httpd.shutdown()
+		self.httpd = None
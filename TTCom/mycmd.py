@@ -32,7 +32,7 @@ if sys.platform == 'win32':
 	if _tz is not None and '/' in _tz:
 		os.unsetenv('TZ')
 
-import subprocess, time, re, shlex, tempfile
+import subprocess, time, re, shlex
 from cmd import Cmd
 import argparse
 import threading
@@ -40,15 +40,7 @@ try: from win32api import SetConsoleTitle
 except ImportError: pass
 import __main__
 from conf import conf
-
-# For Say on Windows.
-Dispatch = None
-SayTools = None
-try:
-	import pythoncom
-	from win32com.client import Dispatch
-	SayTools = Dispatch("Say.Tools")
-except: pass
+import speech
 
 class classproperty(object):
 	"""Allows for a class-level property. Example: speakEvents.
@@ -71,7 +63,7 @@ class ArgumentParser(argparse.ArgumentParser):
 	def exit(self, status=0, msg=""):
 		raise CommandError(msg)
 
-class MyCmd(Cmd):
+class MyCmd(Cmd, object):
 	"""Custom wrapper for the cmd.Cmd class.
 	Includes window title setting under Windows when win32 is available.
 	Include a doc string in the main module; it is used as intro and version command text.
@@ -613,7 +605,8 @@ When a numbered list of options appears followed by a prompt to make one or more
 		try: speakEvents = cls.speakEvents
 		except: pass
 		if int(speakEvents) != 0:
-			mq_vo.extend(args)
+			for arg in args:
+				if arg is not None: speech.queue.say(arg)
 		cls.msg(*args, **kwargs)
 
 	@classmethod
@@ -735,7 +728,10 @@ When a numbered list of options appears followed by a prompt to make one or more
 		"""
 		raw_input() wrapper that keeps its line out of readline history.
 		This is to avoid storing question answers like "1."
+		Raises CommandError in threads where input is not available; see allowInput().
 		"""
+		if not getattr(threadState, "inputAllowed", True):
+			raise CommandError("This command needs a response that cannot be requested here")
 		l = raw_input(prompt)
 		if len(l) == 0: return l
 		try: readline.remove_history_item(readline.get_current_history_length() -1)
@@ -755,6 +751,53 @@ __builtins__["raw_input"] = raw_input
 
 # Output helpers.
 
+# Per-thread output redirection and input permission.
+threadState = threading.local()
+
+class ThreadOutput(object):
+	"""Stand-in for sys.stdout that sends each thread's output where that thread asks.
+	Threads that have not asked for anything write to the original stream.
+	Installed by redirectThreadOutput().
+	"""
+	softspace = 0
+
+	def __init__(self, stream):
+		self.stream = stream
+
+	def write(self, s):
+		out = getattr(threadState, "output", None)
+		if out is None: self.stream.write(s)
+		else: out.write(s)
+
+	def flush(self):
+		out = getattr(threadState, "output", None)
+		if out is None: self.stream.flush()
+
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+def redirectThreadOutput(dest):
+	"""Send printed output from the calling thread to dest, a file-like object.
+	Pass None to send it back to the console.
+	Returns the previous destination so callers can restore it.
+	"""
+	if not isinstance(sys.stdout, ThreadOutput):
+		sys.stdout = ThreadOutput(sys.stdout)
+	prev = getattr(threadState, "output", None)
+	threadState.output = dest
+	return prev
+
+def threadOutput():
+	"""Return where the calling thread's printed output goes, None meaning the console.
+	"""
+	return getattr(threadState, "output", None)
+
+def allowInput(allow=True):
+	"""Allow or forbid prompting for input from the calling thread.
+	Prompts in a thread where input is forbidden raise CommandError instead of waiting.
+	"""
+	threadState.inputAllowed = allow
+
 # Formatter for output.
 import textwrap
 fmt = textwrap.TextWrapper()
@@ -782,16 +825,7 @@ def format(text, indent1=None, indent2=None, width=79):
 class MessageQueue(list):
 	def __init__(self, *args, **kwargs):
 		self.holdAsyncOutput = False
-		speechQueue = False
-		if "speechQueue" in kwargs:
-			speechQueue = kwargs["speechQueue"]
-			del kwargs["speechQueue"]
-		self.speechQueue = speechQueue
 		list.__init__(self, *args, **kwargs)
-		if speechQueue:
-			self.thr = threading.Timer(0, self.watch)
-			self.thr.setDaemon(True)
-			self.thr.start()
 
 	def output(self, nmsgs=0):
 		"""
@@ -814,21 +848,11 @@ class MessageQueue(list):
 			if nmsgs > 0:
 				nmsgs -= 1
 
-	def watch(self):
-		while True:
-			if len(self) > 0:
-				say(" ")
-				while len(self):
-					m = self.pop(0)
-					say(m)
-			time.sleep(2.0)
-
 	def append(self, *args, **kwargs):
 		list.append(self, *args, **kwargs)
 		self.output()
 
 mq = MessageQueue()
-mq_vo = MessageQueue(speechQueue=True)
 
 def pendingMessageCount():
 	return len(mq)
@@ -876,30 +900,19 @@ def errTrace(e=None):
 
 def say(*args):
 	"""
-	On MacOS, speak via the default Mac voice.
-	On Windows. speak via SayTools if available.
+	Queue the given text for speaking and return without waiting.
+	See the speech module for how speech is produced on each platform.
 	"""
 	try: s = " ".join(args)
 	except TypeError: s = unicode(args)
 	s = re.sub(r'[A-Z_]+', cleanForSpeech, s)
-	plat = sys.platform
-	if (plat == "cygwin" or plat.startswith("win")) and SayTools:
-		sys.coinit_flags = 0
-		pythoncom.CoInitialize()
-		try: SayTools.Say(s)
-		except: print __main__.err()
-		pythoncom.CoUninitialize()
-	elif plat == "darwin": # MacOS
-		fd,tmpfile = tempfile.mkstemp(suffix=".aiff")
-		os.close(fd)
-		cmd = ["say", "-o", tmpfile]
-		subprocess.Popen(cmd, stdin=subprocess.PIPE).communicate(s)
-		cmd = ["afplay", tmpfile]
-		subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()
-		try: os.remove(tmpfile)
-		except OSError: pass
-	elif "linux" in plat.lower():
-		pass
+	speech.queue.say(s)
+
+def shutUp():
+	"""
+	Stop any speech in progress and discard speech not yet spoken.
+	"""
+	speech.queue.interrupt()
 
 def cleanForSpeech(m):
 	"""
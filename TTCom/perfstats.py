@@ -0,0 +1,215 @@
+"""Counts and timings of event handling, for the perf command.
+Each server keeps a PerfStats object. Nothing is timed unless
+PerfStats.enabled is True, which the event code tests once per event,
+so leaving this off costs next to nothing.
+A ProfileWindow runs cProfile on every server's event handling for a
+set time and reports the combined results when the time is up.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import threading, thread, cProfile, pstats
+from time import time, sleep
+from timeit import default_timer as timer
+from StringIO import StringIO
+
+class EventStats(object):
+	"""Counts and cumulative seconds for one event type on one server.
+	"""
+	__slots__ = ("count", "parse", "handler", "handlerMax", "triggers", "triggersMax", "log")
+
+	def __init__(self):
+		self.count = 0
+		self.parse = 0.0
+		self.handler = 0.0
+		self.handlerMax = 0.0
+		self.triggers = 0.0
+		self.triggersMax = 0.0
+		self.log = 0.0
+
+	@property
+	def total(self):
+		return self.parse +self.handler +self.triggers +self.log
+
+	def toDict(self):
+		d = dict([(name, getattr(self, name)) for name in self.__slots__])
+		d["total"] = self.total
+		return d
+
+class Histogram(object):
+	"""Counts of durations by order of magnitude, with their total and maximum.
+	"""
+	__slots__ = ("counts", "count", "total", "max")
+	# Upper bounds in seconds; the last count is for anything longer.
+	bounds = (0.001, 0.01, 0.1, 1.0, 10.0)
+	labels = ("<1ms", "<10ms", "<100ms", "<1s", "<10s", ">=10s")
+
+	def __init__(self):
+		self.counts = [0] *(len(self.bounds) +1)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, seconds):
+		i = 0
+		for bound in self.bounds:
+			if seconds < bound: break
+			i += 1
+		self.counts[i] += 1
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max: self.max = seconds
+
+	def format(self):
+		"""Return the nonzero counts as text, such as "12 <1ms, 2 <100ms".
+		"""
+		return ", ".join(["%d %s" % (count, label)
+			for count,label in zip(self.counts, self.labels) if count
+		])
+
+	def toDict(self):
+		return {"count": self.count, "total": self.total, "max": self.max,
+			"buckets": dict(zip(self.labels, self.counts)),
+		}
+
+class PerfStats(object):
+	"""Event counts and timings for one server.
+	Usage from event code:
+		if PerfStats.enabled: server.perf.recordLine(event, parseSecs, handlerSecs)
+	Lines per second are counted over the last window seconds.
+	"""
+	# Set by the perf command; tested before anything is timed.
+	enabled = False
+	# The ProfileWindow in progress, if any.
+	profileWindow = None
+	window = 60
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.events = {}
+		self.lines = 0
+		self.since = time()
+		# Per-second line counts, in a ring indexed by second.
+		self._counts = [0] *self.window
+		self._seconds = [0] *self.window
+
+	def stats(self, event):
+		"""Return the EventStats for event, making it if necessary.
+		"""
+		try: return self.events[event]
+		except KeyError:
+			stats = self.events[event] = EventStats()
+			return stats
+
+	def recordLine(self, event, parse, handler):
+		"""Record one line's parse and handler seconds.
+		"""
+		stats = self.stats(event)
+		stats.count += 1
+		stats.parse += parse
+		stats.handler += handler
+		if handler > stats.handlerMax: stats.handlerMax = handler
+		self.lines += 1
+		now = int(time())
+		i = now %self.window
+		if self._seconds[i] != now:
+			self._seconds[i] = now
+			self._counts[i] = 0
+		self._counts[i] += 1
+
+	def recordTriggers(self, event, seconds):
+		stats = self.stats(event)
+		stats.triggers += seconds
+		if seconds > stats.triggersMax: stats.triggersMax = seconds
+
+	def recordLog(self, event, seconds):
+		self.stats(event).log += seconds
+
+	def linesPerSecond(self):
+		"""Return the lines handled per second over the last window seconds.
+		"""
+		now = int(time())
+		lines = sum([count for count,second in zip(self._counts, self._seconds)
+			if now -second < self.window
+		])
+		span = min(self.window, now -int(self.since) +1)
+		return lines /float(max(span, 1))
+
+	def toDict(self):
+		return {"lines": self.lines,
+			"since": self.since,
+			"linesPerSecond": self.linesPerSecond(),
+			"events": dict([(event, stats.toDict()) for event,stats in self.events.items()]),
+		}
+
+class ProfileWindow(object):
+	"""A cProfile capture of event handling on all servers for a set time.
+	Each event thread gets its own profiler, and the results are combined
+	and passed as text to report when the window closes.
+	Usage:
+		PerfStats.profileWindow = ProfileWindow(30, report)
+	Event code then calls run() for each line; see TeamtalkServer.processLine().
+	"""
+	def __init__(self, seconds, report, top=30):
+		self.seconds = seconds
+		self.report = report
+		self.top = top
+		self._profiles = {}
+		self._running = set()
+		self._lock = threading.Lock()
+		th = threading.Timer(seconds, self.finish)
+		th.daemon = True
+		th.name = "profileWindow"
+		th.start()
+
+	def isRunning(self):
+		"""Return True if the calling thread is already being profiled.
+		"""
+		return thread.get_ident() in self._running
+
+	def run(self, func, *args):
+		"""Call func(*args) under the calling thread's profiler and return its result.
+		"""
+		ident = thread.get_ident()
+		prof = self._profiles.get(ident)
+		if prof is None:
+			with self._lock:
+				prof = self._profiles[ident] = cProfile.Profile()
+		self._running.add(ident)
+		try: return prof.runcall(func, *args)
+		finally: self._running.discard(ident)
+
+	def finish(self):
+		"""Close the window and report what was captured.
+		"""
+		if PerfStats.profileWindow is self:
+			PerfStats.profileWindow = None
+		# Let events already being profiled finish.
+		while self._running: sleep(0.05)
+		if not self._profiles:
+			self.report("Profile: no events in %s seconds" % (self.seconds))
+			return
+		buf = StringIO()
+		stats = None
+		for prof in self._profiles.values():
+			if stats is None: stats = pstats.Stats(prof, stream=buf)
+			else: stats.add(prof)
+		buf.write("Profile of event handling over %s seconds:\n" % (self.seconds))
+		stats.sort_stats("cumulative").print_stats(self.top)
+		self.report(buf.getvalue().rstrip())
@@ -0,0 +1,197 @@
+#! /usr/bin/env python
+
+"""Replay recorded TeamTalk server traffic through TTCom's event handling.
+Feeds the lines recorded in a ttcom.log (or ttcom.log.gz), or in a capture
+file of raw protocol lines from one server, to TeamtalkServer.processLine()
+for each server in the recording, without any network connection.
+Reports lines per second, the time spent on each event type, and a
+checksum of each server's final users and channels, so changes to parsing
+and state handling can be timed and checked against real traffic.
+
+Usage:
+	python replay.py [options] file ...
+By default lines are replayed as fast as possible; -s 1 replays in real
+time and -s 10 at ten times real time. Capture files have no timestamps
+and always replay as fast as possible.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import sys, os, re, gzip, hashlib, argparse
+from time import sleep, time, mktime, strptime
+from timeit import default_timer
+from conf import conf
+from ttapi import TeamtalkServer
+from TableFormatter import TableFormatter
+
+# How hookCoalesced() marks the log line for a flushed coalescing window.
+mergedSuffix = re.compile(r' \(\d+ updates merged\)$')
+
+def openText(path):
+	"""Open a possibly gzipped file for reading.
+	"""
+	if path.endswith(".gz"): return gzip.open(path)
+	return open(path)
+
+def readLog(path):
+	"""Yield (timestamp, shortname, line) for each server line recorded in a ttcom.log file.
+	TTCom's own entries are skipped. A line logged for a coalescing window
+	is yielded as the update it summarizes.
+	"""
+	timestamp = None
+	for entry in openText(path):
+		if not entry.startswith("  "):
+			try: timestamp = mktime(strptime(entry.strip(), "%a %b %d %H:%M:%S %Y"))
+			except ValueError: pass
+			continue
+		shortname,sep,line = entry.strip().partition(": ")
+		if not sep or shortname == "*TTCom*": continue
+		yield timestamp, shortname, mergedSuffix.sub("", line)
+
+def readCapture(path, shortname):
+	"""Yield (None, shortname, line) for each line of a capture file of raw lines from one server.
+	"""
+	for line in openText(path):
+		line = line.rstrip("\r\n")
+		if not line.strip(): continue
+		if line.startswith("teamtalk "):
+			line = "welcome " +line[9:]
+		yield None, shortname, line
+
+class ReplayServer(TeamtalkServer):
+	"""A TeamtalkServer fed from a recording instead of a connection.
+	Output is discarded unless echo is True.
+	"""
+	def __init__(self, shortname, echo=False):
+		TeamtalkServer.__init__(self, shortname, shortname, {})
+		self.echo = echo
+
+	def output(self, line, raw=False, fromEvent=False):
+		if not self.echo: return
+		if raw: print line
+		else: print "[%s] %s" % (self.shortname, line)
+
+	def processLine(self, line, quiet=False):
+		# A live server sends its login right after the welcome.
+		if line.startswith("welcome ") and self.state != "loggedIn":
+			self.state = "loggingIn"
+		return TeamtalkServer.processLine(self, line, quiet)
+
+class Replayer(object):
+	"""Replays recorded lines and keeps timing statistics.
+	Usage:
+		r = Replayer([speed])
+		r.replay(readLog("ttcom.log"))
+		print r.report()
+	speed: Multiple of real time to replay at, or 0 for as fast as possible.
+	"""
+	def __init__(self, speed=0, echo=False, only=None):
+		self.speed = speed
+		self.echo = echo
+		self.only = only
+		self.servers = {}
+		self.lines = 0
+		self.elapsed = 0.0
+		# Event name -> [count, seconds in processLine].
+		self.eventStats = {}
+
+	def server(self, shortname):
+		try: return self.servers[shortname]
+		except KeyError:
+			server = self.servers[shortname] = ReplayServer(shortname, self.echo)
+			return server
+
+	def replay(self, records):
+		"""Replay (timestamp, shortname, line) records.
+		"""
+		start = time()
+		firstTimestamp = None
+		stats = self.eventStats
+		for timestamp,shortname,line in records:
+			if self.only and shortname not in self.only: continue
+			if self.speed and timestamp is not None:
+				if firstTimestamp is None: firstTimestamp = timestamp
+				delay = start +(timestamp -firstTimestamp) /self.speed -time()
+				if delay > 0: sleep(delay)
+			server = self.server(shortname)
+			event = line.split(" ", 1)[0].lower()
+			t0 = default_timer()
+			server.processLine(line)
+			spent = default_timer() -t0
+			try: stat = stats[event]
+			except KeyError: stat = stats[event] = [0, 0.0]
+			stat[0] += 1
+			stat[1] += spent
+			self.lines += 1
+		self.elapsed += time() -start
+
+	@staticmethod
+	def checksum(server):
+		"""Return a checksum of a server's users and channels.
+		Only text fields count, so internal attributes don't change the result.
+		"""
+		md5 = hashlib.md5()
+		for table in (server.users, server.channels):
+			for id in sorted(table):
+				record = table[id]
+				md5.update("%s\n" % (id))
+				for k in sorted(record):
+					v = record[k]
+					if isinstance(v, basestring):
+						md5.update(("%s=%s\n" % (k, v)).encode("utf-8", "replace"))
+		return md5.hexdigest()
+
+	def report(self):
+		"""Return the replay statistics as text.
+		"""
+		buf = []
+		rate = self.lines /self.elapsed if self.elapsed else 0
+		buf.append("%d lines in %0.2f seconds (%d lines/sec)" % (self.lines, self.elapsed, rate))
+		handled = sum([stat[1] for stat in self.eventStats.values()])
+		tbl = TableFormatter("Events", ["Event", "Count", "Total ms", "Mean us", "Share"])
+		for event,stat in sorted(self.eventStats.items(), key=lambda item: -item[1][1]):
+			count,spent = stat
+			tbl.addRow([event, count, "%0.1f" % (spent *1000),
+				"%0.1f" % (spent *1000000 /count),
+				"%0.1f%%" % (100 *spent /handled if handled else 0)
+			])
+		buf.append(tbl.format())
+		tbl = TableFormatter("Servers", ["Server", "Users", "Channels", "Checksum"])
+		for shortname in sorted(self.servers):
+			server = self.servers[shortname]
+			tbl.addRow([shortname, len(server.users), len(server.channels), self.checksum(server)])
+		buf.append(tbl.format())
+		return "\n".join(buf)
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description="Replay recorded TeamTalk traffic through TTCom")
+	parser.add_argument("files", nargs="+", help="ttcom.log files, or capture files with -c")
+	parser.add_argument("-s", "--speed", type=float, default=0, help="Multiple of real time, 0 (the default) for as fast as possible")
+	parser.add_argument("-c", "--capture", metavar="SHORTNAME", help="Files are raw lines from one server, replayed as this server")
+	parser.add_argument("-S", "--server", action="append", dest="only", help="Replay only this server (can be repeated)")
+	parser.add_argument("-v", "--verbose", action="store_true", help="Print event output as it is produced")
+	opts = parser.parse_args(args)
+	if not hasattr(conf, "version"): conf.version = "replay"
+	replayer = Replayer(opts.speed, opts.verbose, opts.only)
+	for path in opts.files:
+		if opts.capture: records = readCapture(path, opts.capture)
+		else: records = readLog(path)
+		replayer.replay(records)
+	print replayer.report()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,75 @@
+"""Read-only snapshots of a server's users and channels.
+The thread reading a server's events is the only one that changes its
+users and channels. It publishes a snapshot after each batch of events,
+and commands running in other threads read the latest snapshot instead
+of the live dictionaries, which can change under them mid-iteration.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from time import time
+from tt_attrdict import AttrDict
+
+class StateSnapshot(object):
+	"""The users and channels of one server at one moment.
+	users and channels are dicts of AttrDict copies keyed like the server's own.
+	Nothing in a snapshot changes after it is made; treat it as read-only.
+	Records that did not change between snapshots are shared by them.
+	"""
+	def __init__(self, users, channels, meID=None, version=0):
+		self.users = users
+		self.channels = channels
+		self.meID = meID
+		self.version = version
+		self.time = time()
+
+	@classmethod
+	def copyOf(cls, users, channels, meID=None, version=0):
+		"""Make a snapshot by copying every record of users and channels.
+		"""
+		return cls(
+			dict([(k, AttrDict(v)) for k,v in users.items()]),
+			dict([(k, AttrDict(v)) for k,v in channels.items()]),
+			meID, version
+		)
+
+	def updated(self, users, channels, userids, chanids, meID=None, version=0):
+		"""Return a new snapshot that shares this one's records except those
+		for userids and chanids, which are copied again from users and channels
+		or dropped if they are gone.
+		"""
+		newUsers = self.users.copy()
+		for userid in userids:
+			user = users.get(userid)
+			if user is None: newUsers.pop(userid, None)
+			else: newUsers[userid] = AttrDict(user)
+		newChannels = self.channels.copy()
+		for chanid in chanids:
+			chan = channels.get(chanid)
+			if chan is None: newChannels.pop(chanid, None)
+			else: newChannels[chanid] = AttrDict(chan)
+		return StateSnapshot(newUsers, newChannels, meID, version)
+
+	@property
+	def me(self):
+		return self.users.get(self.meID)
+
+	def others(self):
+		"""Return the users other than this client's own.
+		"""
+		meID = self.meID
+		return [u for u in self.users.itervalues() if u.userid != meID]
@@ -0,0 +1,336 @@
+"""Speech output for TTCom.
+Text is queued and spoken by a single background thread,
+so code that asks for speech never waits for it to finish.
+Bursts of similar event messages are coalesced into one utterance,
+more important text is spoken before presence churn,
+and pending speech can be discarded at any time.
+
+Copyright (C) 2011-2017 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import sys, os, re, subprocess, threading, time
+
+# For speech on Windows.
+pythoncom = None
+SayTools = None
+try:
+	import pythoncom
+	from win32com.client import Dispatch
+	SayTools = Dispatch("Say.Tools")
+except: pass
+
+# For speech through Speech Dispatcher on Linux.
+speechd = None
+try: import speechd
+except ImportError: pass
+
+# Priorities; lower numbers are spoken first.
+PRI_URGENT = 0
+PRI_MESSAGE = 1
+PRI_NORMAL = 2
+PRI_PRESENCE = 3
+
+def findProgram(name):
+	"""Return the full path of an executable found on the PATH, or None.
+	"""
+	for dir in os.environ.get("PATH", "").split(os.pathsep):
+		path = os.path.join(dir, name)
+		if os.path.isfile(path) and os.access(path, os.X_OK):
+			return path
+	return None
+
+class Speaker(object):
+	"""Base class for platform speech engines.
+	speak() returns when the text has been spoken or stop() is called.
+	This base class says nothing, which is what happens where no engine is available.
+	"""
+	def speak(self, text):
+		pass
+
+	def stop(self):
+		pass
+
+class SayToolsSpeaker(Speaker):
+	"""Speaks through the Say.Tools COM object on Windows.
+	COM is initialized once for the speech thread rather than per utterance.
+	"""
+	def __init__(self):
+		self._comInitialized = False
+
+	def speak(self, text):
+		if not self._comInitialized:
+			sys.coinit_flags = 0
+			pythoncom.CoInitialize()
+			self._comInitialized = True
+		try: SayTools.Say(text)
+		except: pass
+
+class SpeechDispatcherSpeaker(Speaker):
+	"""Speaks through one long-lived Speech Dispatcher connection on Linux.
+	"""
+	def __init__(self):
+		self.client = speechd.SSIPClient("TTCom")
+		self._done = threading.Event()
+
+	def _callback(self, eventType):
+		self._done.set()
+
+	def speak(self, text):
+		self._done.clear()
+		self.client.speak(text, callback=self._callback, event_types=(
+			speechd.CallbackType.END,
+			speechd.CallbackType.CANCEL
+		))
+		# Wake up now and then in case a callback is lost.
+		while not self._done.isSet():
+			self._done.wait(1.0)
+
+	def stop(self):
+		try: self.client.cancel()
+		except: pass
+		self._done.set()
+
+class ProcessSpeaker(Speaker):
+	"""Speaks by running one command per utterance, with the text on stdin.
+	Used for the MacOS say command and for command-line Linux speech tools.
+	stop() kills the process speaking now.
+	"""
+	def __init__(self, cmd):
+		self.cmd = cmd
+		self._proc = None
+
+	def speak(self, text):
+		try:
+			proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE,
+				stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+			)
+		except OSError:
+			return
+		self._proc = proc
+		try: proc.communicate(text.encode("utf-8", "replace"))
+		except (IOError, OSError): pass
+		self._proc = None
+
+	def stop(self):
+		proc = self._proc
+		if not proc: return
+		try: proc.kill()
+		except OSError: pass
+
+def makeSpeaker():
+	"""Return the best available Speaker for this platform.
+	"""
+	plat = sys.platform
+	if (plat == "cygwin" or plat.startswith("win")) and SayTools:
+		return SayToolsSpeaker()
+	elif plat == "darwin":  # MacOS
+		return ProcessSpeaker(["say"])
+	elif "linux" in plat.lower():
+		if speechd:
+			try: return SpeechDispatcherSpeaker()
+			except Exception: pass
+		if findProgram("espeak"):
+			return ProcessSpeaker(["espeak", "--stdin"])
+	return Speaker()
+
+class SpeechRule(object):
+	"""How to queue text that matches a regular expression.
+	priority: Where matching text falls in the speaking order.
+	group: Format string, using named groups from the pattern,
+		that makes a key for coalescing. Texts with the same key
+		that arrive within the coalescing delay are spoken once.
+	summary: Format string for a coalesced utterance.
+		%(count)d is the number of texts merged, and named groups
+		from the pattern are also available.
+	maxAge: Seconds after which matching text is dropped if not yet spoken.
+	"""
+	def __init__(self, pattern, priority=PRI_NORMAL, group=None, summary=None, maxAge=None):
+		self.pattern = re.compile(pattern)
+		self.priority = priority
+		self.group = group
+		self.summary = summary
+		self.maxAge = maxAge
+
+# Rules for the event messages TTCom produces.
+# Each message starts with the server's shortname in brackets.
+defaultRules = [
+	SpeechRule(r'^\[(?P<server>[^]]+)\] (User|Channel) message from ', PRI_MESSAGE),
+	SpeechRule(r'^\[(?P<server>[^]]+)\] \*\*\* Broadcast message from ', PRI_MESSAGE),
+	SpeechRule(r'^\[(?P<server>[^]]+)\] .* logged in$', PRI_PRESENCE,
+		"loggedin %(server)s", "%(count)d users logged in on %(server)s", 30
+	),
+	SpeechRule(r'^\[(?P<server>[^]]+)\] .* logged out$', PRI_PRESENCE,
+		"loggedout %(server)s", "%(count)d users logged out of %(server)s", 30
+	),
+	SpeechRule(r'^\[(?P<server>[^]]+)\] .* (joined|left) ', PRI_PRESENCE,
+		"channels %(server)s", "%(count)d channel changes on %(server)s", 30
+	),
+	SpeechRule(r'^\[(?P<server>[^]]+)\] .*: (status|udpaddr|local subscription|remote subscription) ', PRI_PRESENCE,
+		"updates %(server)s", "%(count)d user updates on %(server)s", 15
+	),
+]
+
+class SpeechItem(object):
+	"""One pending utterance, possibly standing for several coalesced texts.
+	"""
+	def __init__(self, text, priority, seq, readyAt, expires=None, rule=None, groupKey=None, groupdict=None):
+		self.text = text
+		self.priority = priority
+		self.seq = seq
+		self.readyAt = readyAt
+		self.expires = expires
+		self.rule = rule
+		self.groupKey = groupKey
+		self.groupdict = groupdict or {}
+		self.count = 1
+
+	def utterance(self):
+		"""Return the text to speak for this item.
+		"""
+		if self.count == 1 or not self.rule.summary:
+			return self.text
+		d = dict(self.groupdict)
+		d["count"] = self.count
+		return self.rule.summary % d
+
+class SpeechQueue(object):
+	"""Blocking queue of text to speak, with one speaking thread.
+	Usage:
+		q = SpeechQueue()
+		q.say(text[, priority])  # returns immediately
+		q.interrupt()  # stop talking and discard what is pending
+	Priorities come from the first matching rule in q.rules
+	unless one is passed to say().
+	"""
+	def __init__(self, speaker=None, coalesceDelay=1.5, rules=None):
+		self.speaker = speaker
+		self.coalesceDelay = coalesceDelay
+		if rules is None: rules = defaultRules
+		self.rules = list(rules)
+		self.dropped = 0
+		self._items = []
+		self._groups = {}
+		self._seq = 0
+		self._cv = threading.Condition()
+		self._thread = None
+
+	def __len__(self):
+		return len(self._items)
+
+	def _classify(self, text):
+		"""Return the rule matching text and its match object, or (None, None).
+		"""
+		for rule in self.rules:
+			m = rule.pattern.search(text)
+			if m: return rule, m
+		return None, None
+
+	def say(self, text, priority=None):
+		"""Queue text for speaking and return immediately.
+		"""
+		if not isinstance(text, basestring): text = unicode(text)
+		text = text.strip()
+		if not text: return
+		rule,m = self._classify(text)
+		if priority is None:
+			if rule: priority = rule.priority
+			else: priority = PRI_NORMAL
+		now = time.time()
+		groupKey = None
+		groupdict = None
+		expires = None
+		readyAt = now
+		if rule:
+			groupdict = m.groupdict()
+			if rule.group:
+				groupKey = rule.group % groupdict
+				readyAt = now +self.coalesceDelay
+			if rule.maxAge:
+				expires = now +rule.maxAge
+		with self._cv:
+			item = self._groups.get(groupKey) if groupKey else None
+			if item:
+				# Coalesce into the pending utterance for this burst.
+				item.count += 1
+				item.priority = min(item.priority, priority)
+				if expires: item.expires = expires
+			else:
+				self._seq += 1
+				item = SpeechItem(text, priority, self._seq, readyAt, expires, rule, groupKey, groupdict)
+				self._items.append(item)
+				if groupKey: self._groups[groupKey] = item
+			self._cv.notify()
+		self._start()
+
+	def interrupt(self):
+		"""Stop any speech in progress and discard all pending speech.
+		"""
+		with self._cv:
+			self.dropped += len(self._items)
+			self._items = []
+			self._groups = {}
+		if self.speaker: self.speaker.stop()
+
+	def _start(self):
+		"""Start the speaking thread if it is not already running.
+		"""
+		if self._thread: return
+		with self._cv:
+			if self._thread: return
+			self._thread = threading.Thread(target=self._speakLoop)
+			self._thread.daemon = True
+			self._thread.name = "speech"
+			self._thread.start()
+
+	def _next(self):
+		"""Wait for, remove, and return the next item ready to speak.
+		Items whose coalescing delay has not passed are not ready.
+		Expired items are dropped along the way.
+		"""
+		with self._cv:
+			while True:
+				now = time.time()
+				live = []
+				for item in self._items:
+					if item.expires and item.expires < now:
+						self.dropped += item.count
+						if item.groupKey: self._groups.pop(item.groupKey, None)
+						continue
+					live.append(item)
+				self._items = live
+				ready = [item for item in live if item.readyAt <= now]
+				if ready:
+					item = min(ready, key=lambda i: (i.priority, i.seq))
+					self._items.remove(item)
+					if item.groupKey: self._groups.pop(item.groupKey, None)
+					return item
+				if live:
+					self._cv.wait(min([item.readyAt for item in live]) -now)
+				else:
+					self._cv.wait()
+
+	def _speakLoop(self):
+		"""Speak queued items forever.
+		Runs in the speech thread started by _start().
+		"""
+		if not self.speaker: self.speaker = makeSpeaker()
+		while True:
+			item = self._next()
+			try: self.speaker.speak(item.utterance())
+			except Exception: pass
+
+queue = SpeechQueue()
@@ -25,6 +25,22 @@ In a Trigger class, include this:
 
 A Trigger object is instantiated when an event fires and released when
 its trigger processing is completed.
+Which classes exist is worked out once, when this code is loaded or reloaded,
+not on each event.
+
+For code that should stay loaded and see only some events,
+define a subclass of Handler instead:
+	from trigger_cc import Handler
+	class Logins(Handler):
+		events = ["loggedin", "loggedout"]
+		# Optional; without this, all servers.
+		servers = ["simon"]
+		def handle(self, server, event):
+			self.runCommand("system play login.wav")
+One object of each Handler class is made, the first time it is needed,
+and kept until the custom code is reloaded. Its handle() method is called
+only for the listed events and servers, after any Trigger classes.
+Handler classes are called in name order.
 
 Properties given via TriggerBase:
 	event: The event that just fired as a ParmLine object.
@@ -38,18 +54,21 @@ Properties given via TriggerBase:
 		self.runCommand("system play ...")
 	myIP: The IP address of this client on the server that fired this event.
 		Warning: myIP may be None before the "loggedin" event is completed.
+		It is only looked up if used.
 
 Examples of what can be done from Trigger methods:
 self.runCommand("system play ...")
 self.server.outputFromEvent("Blah that prints only if server isn't silenced.")
 self.server.errorFromEvent("blah that prints even for silent servers.")
-mycmd_say("Blah") but warning, that might suspend TTCom a while.
+mycmd_say("Blah"), which queues speech and returns without waiting for it.
 time.sleep(0.5)
 self.server.send[WithWait]("kick userid=%s" % (event.parms.userid))
 (That one can serve to "ban" someone by more than just IP address.)
 
 See also methods in the TriggerBase class in this module.
 See also ttapi classes for info on server, user, and other object types.
+To keep a handler loaded and give it only the events it asks for,
+on its own thread, subscribe it to the event bus instead; see eventbus.py.
 
 Copyright (C) 2011-2017- Doug Lee
 
@@ -68,20 +87,95 @@ with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
+import threading
+
 class TriggerBase(object):
 	def __init__(self, server, event, runCommand):
 		self.server = server
 		self.event = event
 		self.runCommand = runCommand
+
+	def _getMyIP(self):
+		try: return self._myIP
+		except AttributeError: pass
 		# This can be None before login is completed.
-		try: self.myIP = self.server.me.ipaddr
-		except AttributeError: self.myIP = None
+		try: return self.server.me.ipaddr
+		except AttributeError: return None
+	def _setMyIP(self, ip):
+		self._myIP = ip
+	myIP = property(_getMyIP, _setMyIP)
 
 	def nameFromID(self, userid):
 		"""Return a printable user id string from a userid.
 		"""
 		return self.server.nonEmptyNickname(self.server.users[userid])
 
+class Handler(object):
+	"""Base class for long-lived custom trigger code; see the top of this module.
+	events: Event names to handle, or None for all.
+	servers: Server shortnames to handle events from, or None for all.
+	"""
+	events = None
+	servers = None
+
+	def __init__(self, runCommand):
+		self.runCommand = runCommand
+
+	def handle(self, server, event):
+		"""Called with the server and ParmLine of each wanted event.
+		"""
+		pass
+
+# The custom code's classes, found by load().
+# Shortname -> Trigger_<shortname> class.
+serverTriggers = {}
+# The Trigger class, if any.
+allTrigger = None
+# Handler subclasses, in name order.
+handlerClasses = []
+# Handler class -> its one object.
+_handlers = {}
+# Shortname -> event name -> what to call for that event; filled in as events arrive.
+_tables = {}
+_lock = threading.Lock()
+
+def load():
+	"""Find the custom code's Trigger and Handler classes.
+	Runs when this module is loaded or reloaded; see Triggers.loadCustomCode().
+	"""
+	global allTrigger
+	try: customCode
+	except NameError: return
+	for name in sorted(dir(customCode)):
+		obj = getattr(customCode, name)
+		if not isinstance(obj, type): continue
+		if name.startswith("Trigger_"):
+			serverTriggers[name[8:]] = obj
+		elif name == "Trigger":
+			allTrigger = obj
+		elif issubclass(obj, Handler) and obj is not Handler:
+			handlerClasses.append(obj)
+
+def _calls(server, event, runCommand):
+	"""Return what to call, in order, for an event from a server.
+	Each call takes the server and the event's ParmLine.
+	"""
+	try: return _tables[server.shortname][event]
+	except KeyError: pass
+	with _lock:
+		table = _tables.setdefault(server.shortname, {})
+		calls = []
+		for cls in (serverTriggers.get(server.shortname), allTrigger):
+			if cls: calls.append(lambda server, parmline, cls=cls: cls(server, parmline, runCommand))
+		for cls in handlerClasses:
+			if cls.servers is not None and server.shortname not in cls.servers: continue
+			if cls.events is not None and event not in [e.lower() for e in cls.events]: continue
+			handler = _handlers.get(cls)
+			if not handler: handler = _handlers[cls] = cls(runCommand)
+			calls.append(handler.handle)
+		table[event] = calls
+	return calls
+
 try:
 	customCode
 	reload(customCode)
@@ -93,16 +187,10 @@ except NameError:
 	except ImportError:
 		pass
 
+load()
+
 def apply(server, parmline, runCommand):
-	# Is there custom code at all?
-	try: customCode
-	except NameError: return
-	# How about a server-specific Trigger_* class?
-	func = "customCode.Trigger_" +server.shortname
-	try: func = eval(func)
-	except AttributeError: func = None
-	if func: func(server, parmline, runCommand)
-	# And finally, an all-server Trigger class?
-	try: customCode.Trigger
-	except AttributeError: return
-	customCode.Trigger(server, parmline, runCommand)
+	"""Run the custom trigger code that wants this event, if there is any.
+	"""
+	for call in _calls(server, parmline.event, runCommand):
+		call(server, parmline)
@@ -19,10 +19,13 @@ with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
 import threading
-from time import sleep
+from time import sleep, time
 from parmline import ParmLine
-from mycmd import say as mycmd_say
+from mycmd import say as mycmd_say, err
 from OrderedDict import OrderedDict
+from addrmatch import AddressMatcher, parsePrefix
+from perfstats import Histogram, timer
+from actionpolicy import ActionPolicy
 import trigger_cc
 
 class Struct(object):
@@ -41,6 +44,40 @@ class Struct(object):
 		return not self.__eq__(other)
 
 
+def matchError(matchSpec):
+	"""Return why a match can never match, such as a regexp that doesn't compile, or None.
+	"""
+	mevent = matchSpec.event.lower()
+	if mevent == "nodecode": return None
+	if mevent == "line" and matchSpec.parms.get("match"):
+		patterns = [("match", matchSpec.parms["match"])]
+	else:
+		patterns = [("event", matchSpec.event)]
+		patterns.extend([(k, v) for k,v in matchSpec.parms.items() if k != "address"])
+	for k,pattern in patterns:
+		try: re.compile('^'+pattern+'$')
+		except re.error as e:
+			return "invalid regular expression %s for %s: %s" % (pattern, k, e)
+	address = matchSpec.parms.get("address")
+	if address is not None:
+		try: parsePrefix(address)
+		except ValueError as e: return str(e)
+	return None
+
+class MatchStats(object):
+	"""Counts for one match of a trigger.
+	checks: Times the match was checked in full, past any combined filters.
+	hits: Times the match matched and fired its trigger.
+	seconds: Time spent on full checks.
+	"""
+	__slots__ = ("checks", "hits", "lastHit", "seconds")
+
+	def __init__(self):
+		self.checks = 0
+		self.hits = 0
+		self.lastHit = None
+		self.seconds = 0.0
+
 class Trigger(object):
 	"""Match/action triggers for a server.
 	All objects in this class are created by Triggers objects.
@@ -52,6 +89,9 @@ class Trigger(object):
 		self.name = name
 		self.matches = OrderedDict()
 		self.actions = OrderedDict()
+		# The ActionPolicy limiting this trigger's actions, if any.
+		self.policy = None
+		self.resetStats()
 
 	def __hash__(self):
 		"""For sets.
@@ -66,12 +106,32 @@ class Trigger(object):
 			self.name == other.name
 			and self.matches == other.matches
 			and self.actions == other.actions
+			and self.policy == other.policy
 		)
 	def __ne__(self, other):
 		"""Makes comparison for equality work reasonably.
 		"""
 		return not self.__eq__(other)
 
+	def resetStats(self):
+		"""Start this trigger's hit and timing counts over.
+		"""
+		self.hits = 0
+		self.lastHit = None
+		# Match name -> MatchStats.
+		self.matchStats = {}
+		# Action name -> Histogram of seconds taken.
+		self.actionStats = {}
+		if self.policy: self.policy.suppressed = dict.fromkeys(self.policy.suppressed, 0)
+
+	def statsFor(self, match):
+		"""Return the MatchStats for a match, making it if necessary.
+		"""
+		try: return self.matchStats[match.name]
+		except KeyError:
+			stats = self.matchStats[match.name] = MatchStats()
+			return stats
+
 	def addMatch(self, matchSpec, matchName=""):
 		"""Add one match to this trigger.
 		matchSpec should be a ParmLine where the event and parameter values are regexps.
@@ -83,6 +143,8 @@ class Trigger(object):
 		match.value = matchSpec
 		# This allows replacements by exact name match.
 		self.matches[matchName] = match
+		self.parent.invalidate()
+		return match
 
 	def addAction(self, actionSpec, actionName=""):
 		"""Add one action to this trigger.
@@ -96,31 +158,80 @@ class Trigger(object):
 		# This allows replacements by exact name match.
 		self.actions[actionName] = action
 
+	def setPolicy(self, spec):
+		"""Limit this trigger's actions; spec is a dict from actionpolicy.parsePolicy().
+		"""
+		self.policy = ActionPolicy(spec, self._runBatch, self._reportPolicy) if spec else None
+
+	def _reportPolicy(self, text):
+		self.parent.server.errorFromEvent("Trigger %s: %s" % (self.name, text))
+
 	def apply(self, parmline):
 		"""Apply actions if and only if there is a match.
+		Only the first match that matches counts.
 		"""
 		for match in self.matches.values():
+			if (self.name, match.name) in self.parent.invalid: continue
 			if not self._isMatch(match, parmline): continue
-			uinfo = ""
-			if parmline.parms.get("userid"):
-				uinfo = " (userid %s)" % (parmline.parms.userid)
-			# Use errorFromEvent instead of outputFromEvent so it's not
-			# silent if the server is marked silent.
-			self.parent.server.errorFromEvent("%s triggers %s %s%s" % (
-				parmline.event,
-				self.name,
-				match.name or match.value,
-				uinfo
-			))
-			for action in self.actions.values():
-				actionData = Struct()
-				actionData.parmline = parmline
-				actionData.match = match
-				actionData.action = action
-				self._doAction(actionData)
+			self.fire(match, parmline)
 			return True
 		return False
 
+	def fire(self, match, parmline):
+		"""Report a match and perform this trigger's actions.
+		Counts the hit and times each action.
+		"""
+		self.hits += 1
+		self.lastHit = time()
+		uinfo = ""
+		if parmline.parms.get("userid"):
+			uinfo = " (userid %s)" % (parmline.parms.userid)
+		# Use errorFromEvent instead of outputFromEvent so it's not
+		# silent if the server is marked silent.
+		self.parent.server.errorFromEvent("%s triggers %s %s%s" % (
+			parmline.event,
+			self.name,
+			match.name or match.value,
+			uinfo
+		))
+		items = []
+		for action in self.actions.values():
+			actionData = Struct()
+			actionData.parmline = parmline
+			actionData.match = match
+			actionData.action = action
+			if not self.policy:
+				self._timeAction(action.name, self._doAction, actionData)
+				continue
+			items.append((self._actionText(actionData), action.name))
+		# A policy admits or drops the firing's actions all together.
+		if items and self.policy.admit("\n".join([a for a,name in items]), items):
+			for a,name in items:
+				self._timeAction(name, self._runAction, a)
+
+	def _timeAction(self, name, func, arg):
+		"""Call func(arg), adding its time to the histogram for action name.
+		"""
+		started = timer()
+		try: func(arg)
+		finally:
+			try: hist = self.actionStats[name]
+			except KeyError: hist = self.actionStats[name] = Histogram()
+			hist.add(timer() -started)
+
+	def _runBatch(self, items):
+		"""Run the (text, name) action pairs a batch policy held, from its timer thread.
+		Sends to the server go out back to back; only the last one that
+		waits for a reply does so, since replies come back in order.
+		"""
+		waits = [i for i,(a,name) in enumerate(items) if a.lower().startswith("sendwithwait ")]
+		for i,(a,name) in enumerate(items):
+			if waits and i in waits[:-1]:
+				a = "send " +a.split(None, 1)[1]
+			try: self._timeAction(name, self._runAction, a)
+			except Exception:
+				self._reportPolicy("batched action failed: %s" % (err()))
+
 	def _isMatch(self, match, eventline):
 		"""Return True on a match.
 		match is a name,value struct where value is a
@@ -159,43 +270,16 @@ class Trigger(object):
 			if matchKey == "address":
 				# This one is special/magical:
 				# It tries to match against any ".*addr" eventline key,
-				# and it uses special logic, not regexp logic, to match.
-				# First collect the address keys, e.g., ipaddr/udpaddr.
-				addrkeys = filter(lambda k: k.endswith("addr"), eventline.parms.keys())
-				# Then check each for a match.
-				matched = False
-				for ak in addrkeys:
-					addr = eventline.parms[ak]
-					if self._matchAddress(matchRE, addr):
-						matched = True
-						break
-				if not matched: return False
+				# and it uses address prefix logic, not regexp logic, to match.
+				# See Triggers.addressMatches() and the addrmatch module.
+				if matchRE not in self.parent.addressMatches(eventline):
+					return False
 			# Not a "magical" address match.
 			elif not eventline.parms.has_key(matchKey): return False
 			elif not re.match('^'+matchRE+'$', eventline.parms[matchKey], re.IGNORECASE):
 				return False
 		return True
 
-	def _matchAddress(self, matchval, addr):
-		"""Indicate if the given address matches matchval.
-		Matchval should be a full address or the first part of one.
-		Addr should be an event parameter value.
-		Helper for isMatch().
-		"""
-		# Remove any extra brackets/port, often found on UDP address values.
-		if "[" in addr and "]" in addr:
-			addr = re.findall(r'^\[(.*?)]', addr)[0]
-		# Allow IPV4 and IPV6 addresses with the same content to match.
-		if not matchval.startswith(":"):
-			addr = re.sub(r'^(?i)::ffff:', '', addr)
-		# Remove any trailing port from an IPV4 address.
-		addr = re.sub(r':\d+$', '', addr)
-		# If this is a partial address, ad a dott to avoid partial number matches.
-		if len(matchval.split(".")) < 4:
-			matchval += "."
-		# And finally do a left-side simple match.
-		return addr.startswith(matchval)
-
 	def _doAction(self, actionData):
 		"""Perform one action.
 		actionData properties:
@@ -213,6 +297,11 @@ class Trigger(object):
 		If the command begins with "say," the rest of the line is
 		spoken if possible.
 		"""
+		self._runAction(self._actionText(actionData))
+
+	def _actionText(self, actionData):
+		"""Return the text of an action with its substitutions done.
+		"""
 		a = actionData.action.value
 		parmline = actionData.parmline
 		# Include any parameters from the matched line.
@@ -220,7 +309,11 @@ class Trigger(object):
 		# what happens when the author asks for something that doesn't exist.
 		# We throw an error in such a case.
 		ms = lambda m: self._doSubs(m, parmline.parms)
-		a = re.sub(r'%\((\S+?)\)', ms, a)
+		return re.sub(r'%\((\S+?)\)', ms, a)
+
+	def _runAction(self, a):
+		"""Perform an action whose substitutions are done; see _doAction().
+		"""
 		sendFunc = None
 		if a.lower().startswith("send "):
 			sendFunc = self.parent.server.send
@@ -254,6 +347,146 @@ class Trigger(object):
 			val = '%s="%s"' % (k, val)
 		return val
 
+class CombinedPattern(object):
+	"""Many regexps matched against one value in as few scans as possible.
+	Each regexp is matched as Trigger._isMatch() would: case ignored,
+	against the whole value. Regexps that can safely be merged are joined
+	into alternations of named groups, at most maxGroups groups to each,
+	and the group that matched says which regexp did; regexps after it in
+	the same alternation are then checked one by one. Regexps that can't be
+	merged are always checked one by one.
+	Usage:
+		cp = CombinedPattern([(key1, "spam.*"), (key2, "bot[0-9]+")])
+		cp.matches("Bot22")  # -> set([key2])
+	"""
+	# Python 2 allows 100 groups per regexp.
+	maxGroups = 99
+	# Patterns that change meaning, or group numbers, inside an alternation:
+	# top-level alternatives, backreferences, named groups, and inline flags.
+	unmergeable = re.compile(r'\||\\[1-9]|\(\?P|\(\?[iLmsux]')
+
+	def __init__(self, items):
+		# Each chunk is (compiled alternation, [(key, compiled regexp), ...]).
+		self.chunks = []
+		# (key, pattern) pairs checked one by one.
+		self.singles = []
+		chunk = []
+		ngroups = 0
+		for key,pattern in items:
+			try:
+				single = re.compile('^'+pattern+'$', re.IGNORECASE)
+			except re.error:
+				# Not for this class to judge; the caller checks the key.
+				self.singles.append((key, pattern))
+				continue
+			if self.unmergeable.search(pattern) or single.groups >= self.maxGroups:
+				self.singles.append((key, single))
+				continue
+			if chunk and ngroups +single.groups +1 > self.maxGroups:
+				self._addChunk(chunk)
+				chunk = []
+				ngroups = 0
+			chunk.append((key, pattern, single))
+			ngroups += single.groups +1
+		if chunk: self._addChunk(chunk)
+
+	def _addChunk(self, chunk):
+		alternation = "|".join(["(?P<m%d>(?:%s)$)" % (i, pattern)
+			for i,(key,pattern,single) in enumerate(chunk)
+		])
+		self.chunks.append((re.compile(alternation, re.IGNORECASE),
+			[(key, single) for key,pattern,single in chunk]
+		))
+
+	def matches(self, value):
+		"""Return the set of keys whose regexps match value.
+		Keys of regexps that don't compile are always included.
+		"""
+		found = set()
+		for alternation,singles in self.chunks:
+			m = alternation.match(value)
+			if not m: continue
+			i = int(m.lastgroup[1:])
+			found.add(singles[i][0])
+			for key,single in singles[i+1:]:
+				if single.match(value): found.add(key)
+		for key,single in self.singles:
+			if isinstance(single, basestring) or single.match(value):
+				found.add(key)
+		return found
+
+class MatchPlan(object):
+	"""The matches that can apply to one event name, in trigger order,
+	with combined patterns that rule most of them out in a few scans.
+	Made by Triggers.plan().
+	Event names are matched when the plan is made. Parameter regexps are
+	combined for each parameter that more than one match tests, including
+	the whole line for line match= matches; address= values are checked
+	through Triggers.addressMatches().
+	Matches that get past these filters are still checked in full by
+	Trigger._isMatch(), so filtering never changes what matches.
+	Matches that can never match (see matchError()) are left out;
+	Triggers.addMatch() found and reported them.
+	"""
+	def __init__(self, triggers, event):
+		self.triggers = triggers
+		# Events planned for, and time spent in candidates(), for trigger stats.
+		self.events = 0
+		self.seconds = 0.0
+		# (trigger, match) pairs in the order Triggers.apply() would try them.
+		self.entries = []
+		# How many entries were chosen by their event regexps, and the
+		# nodecode and line match= entries, which can match any event.
+		self.byEvent = 0
+		self.lineEntries = []
+		# Parameter name (None for the whole line) -> [(index, regexp), ...].
+		byParm = {}
+		self.addressEntries = []
+		for trigger in triggers.triggers.values():
+			for match in trigger.matches.values():
+				if (trigger.name, match.name) in triggers.invalid: continue
+				m = match.value
+				mevent = m.event.lower()
+				i = len(self.entries)
+				if mevent == "nodecode":
+					self.entries.append((trigger, match))
+					self.lineEntries.append((trigger, match))
+					continue
+				if mevent == "line" and m.parms.get("match"):
+					self.entries.append((trigger, match))
+					self.lineEntries.append((trigger, match))
+					byParm.setdefault(None, []).append((i, m.parms["match"]))
+					continue
+				if not re.match('^'+m.event+'$', event, re.IGNORECASE): continue
+				self.entries.append((trigger, match))
+				self.byEvent += 1
+				for k in m.parms:
+					if k == "address": self.addressEntries.append((i, m.parms[k]))
+					else: byParm.setdefault(k, []).append((i, m.parms[k]))
+		self.filters = []
+		for k,items in byParm.items():
+			if len(items) < 2: continue
+			self.filters.append((k, set([i for i,pattern in items]), CombinedPattern(items)))
+
+	def candidates(self, eventline):
+		"""Yield the (trigger, match) pairs that get past the filters, in order.
+		"""
+		failed = set()
+		parms = eventline.parms
+		for k,keys,cp in self.filters:
+			if k is None: value = eventline.initLine
+			else: value = parms.get(k)
+			if value is None: failed.update(keys)
+			else: failed.update(keys -cp.matches(value))
+		if self.addressEntries:
+			found = self.triggers.addressMatches(eventline)
+			failed.update([i for i,spec in self.addressEntries if spec not in found])
+		if not failed:
+			for entry in self.entries: yield entry
+			return
+		for i,entry in enumerate(self.entries):
+			if i not in failed: yield entry
+
 class Triggers(object):
 	"""Match/action triggers for a server.
 	"""
@@ -262,6 +495,12 @@ class Triggers(object):
 		self.triggers = OrderedDict()
 		self.thr = None
 		self._q = []
+		# All address= match values, made by addressMatcher() when needed.
+		self._addresses = None
+		# Event name -> MatchPlan, made by plan() when needed.
+		self._plans = {}
+		# (trigger name, match name) -> why that match can never match.
+		self.invalid = OrderedDict()
 
 	def __hash__(self):
 		"""For sets.
@@ -290,9 +529,56 @@ class Triggers(object):
 		actions, to separate them from any other match/action sets.
 		matchSpec should be a ParmLine where the event and parameter values are regexps.
 		matchName can name the match arbitrarily.
+		Matches that can never match are kept in self.invalid and skipped;
+		see reportInvalid().
 		"""
 		trigger = self.get(triggerName)
-		trigger.addMatch(matchSpec, matchName)
+		match = trigger.addMatch(matchSpec, matchName)
+		key = (triggerName, match.name)
+		self.invalid.pop(key, None)
+		error = matchError(matchSpec)
+		if error: self.invalid[key] = error
+
+	def needsLine(self, event, line):
+		"""Return True if any match could match a line of event, for event filters.
+		line is stripped and lower-cased; case is ignored in matching anyway.
+		"""
+		plan = self.plan(event)
+		if plan.byEvent: return True
+		for trigger,match in plan.lineEntries:
+			m = match.value
+			if m.event.lower() == "nodecode":
+				if chr(0) in line: return True
+				try: line.decode("utf-8")
+				except UnicodeDecodeError: return True
+			elif re.match('^'+m.parms["match"]+'$', line, re.IGNORECASE):
+				return True
+		return False
+
+	def reportFiltered(self, skips, events, report):
+		"""Call report(text) once for each match that needs events an event filter would skip.
+		skips is a function of an event name, such as EventFilter.skips,
+		and events lists the event names to check.
+		The filter keeps such lines for triggers anyway; see needsLine().
+		"""
+		for trigger in self.triggers.values():
+			for match in trigger.matches.values():
+				if (trigger.name, match.name) in self.invalid: continue
+				m = match.value
+				mevent = m.event
+				if mevent.lower() == "nodecode": continue
+				if mevent.lower() == "line" and m.parms.get("match"): continue
+				names = [event for event in events
+					if skips(event) and re.match('^'+mevent+'$', event, re.IGNORECASE)
+				]
+				if names:
+					report("Trigger %s match %s needs %s events, which events= or ignoreEvents= would skip; they are kept for it" % (trigger.name, match.name, ", ".join(names)))
+
+	def reportInvalid(self, report):
+		"""Call report(text) once for each match that can never match.
+		"""
+		for (triggerName,matchName),error in self.invalid.items():
+			report("Trigger %s match %s ignored: %s" % (triggerName, matchName, error))
 
 	def addAction(self, triggerName, actionSpec, actionName=""):
 		"""Add one action to a trigger.
@@ -304,18 +590,154 @@ class Triggers(object):
 		trigger = self.get(triggerName)
 		trigger.addAction(actionSpec, actionName)
 
+	def setPolicy(self, triggerName, spec):
+		"""Limit a trigger's actions; spec is a dict from actionpolicy.parsePolicy().
+		"""
+		self.get(triggerName).setPolicy(spec)
+
+	def stats(self):
+		"""Return a list of dicts of counts and costs, one for each trigger in order.
+		Each dict has the trigger's name, hits, lastHit, and cost in seconds,
+		lists of dicts for its matches and actions, and the counts of
+		actions its policy dropped, by reason, with the policy itself.
+		evaluations counts the events a match could apply to, checked by
+		combined filters or in full; the time spent in combined filters is
+		shared evenly among the matches they cover.
+		"""
+		evaluations = {}
+		shares = {}
+		for plan in self.plans():
+			if not plan.entries: continue
+			share = plan.seconds /len(plan.entries)
+			for trigger,match in plan.entries:
+				key = (trigger.name, match.name)
+				evaluations[key] = evaluations.get(key, 0) +plan.events
+				shares[key] = shares.get(key, 0.0) +share
+		result = []
+		for trigger in self.triggers.values():
+			matches = []
+			for match in trigger.matches.values():
+				key = (trigger.name, match.name)
+				ms = trigger.matchStats.get(match.name) or MatchStats()
+				matches.append({"name": match.name,
+					"evaluations": evaluations.get(key, 0),
+					"checks": ms.checks,
+					"hits": ms.hits,
+					"lastHit": ms.lastHit,
+					"seconds": ms.seconds +shares.get(key, 0.0),
+				})
+			actions = []
+			for action in trigger.actions.values():
+				hist = trigger.actionStats.get(action.name) or Histogram()
+				d = hist.toDict()
+				d["name"] = action.name
+				d["histogram"] = hist.format()
+				actions.append(d)
+			matchSecs = sum([m["seconds"] for m in matches])
+			actionSecs = sum([a["total"] for a in actions])
+			result.append({"name": trigger.name,
+				"hits": trigger.hits,
+				"lastHit": trigger.lastHit,
+				"evaluations": sum([m["evaluations"] for m in matches]),
+				"matchSeconds": matchSecs,
+				"actionSeconds": actionSecs,
+				"cost": matchSecs +actionSecs,
+				"matches": matches,
+				"actions": actions,
+				"dropped": sum(trigger.policy.suppressed.values()) if trigger.policy else 0,
+				"policy": trigger.policy.toDict() if trigger.policy else None,
+			})
+		return result
+
+	def plans(self):
+		return self._plans.values()
+
+	def resetStats(self):
+		"""Start all trigger hit and timing counts over.
+		"""
+		for trigger in self.triggers.values():
+			trigger.resetStats()
+		for plan in self.plans():
+			plan.events = 0
+			plan.seconds = 0.0
+
+	def invalidate(self):
+		"""Forget what was worked out from the matches, after they change.
+		"""
+		self._addresses = None
+		self._plans = {}
+
+	def plan(self, event):
+		"""Return the MatchPlan for an event name.
+		"""
+		try: return self._plans[event]
+		except KeyError:
+			plan = self._plans[event] = MatchPlan(self, event)
+			return plan
+
 	def apply(self, parmline):
 		"""Apply actions where there is a match.
 		As many match/action sets as match will have their actions applied.
+		Each trigger fires at most once, for the first of its matches that matches,
+		and triggers fire in the order they were defined.
 		"""
 		# config file triggers first.
-		[trigger.apply(parmline) for trigger in self.triggers.values()]
+		plan = self.plan(parmline.event)
+		plan.events += 1
+		started = timer()
+		candidates = list(plan.candidates(parmline))
+		plan.seconds += timer() -started
+		fired = set()
+		for trigger,match in candidates:
+			if trigger.name in fired: continue
+			stats = trigger.statsFor(match)
+			started = timer()
+			try: matched = trigger._isMatch(match, parmline)
+			finally:
+				stats.checks += 1
+				stats.seconds += timer() -started
+			if matched:
+				stats.hits += 1
+				stats.lastHit = time()
+				fired.add(trigger.name)
+				trigger.fire(match, parmline)
 		# Then custom code triggers if any.
 		trigger_cc.apply(self.server, parmline, self.runCommand)
 
+	def addressMatcher(self):
+		"""Return an AddressMatcher holding the address= values of all matches.
+		Values that aren't address prefixes never match.
+		"""
+		am = self._addresses
+		if am is not None: return am
+		am = AddressMatcher()
+		for trigger in self.triggers.values():
+			for match in trigger.matches.values():
+				spec = match.value.parms.get("address")
+				if spec is None: continue
+				try: am.add(spec)
+				except ValueError: pass
+		self._addresses = am
+		return am
+
+	def addressMatches(self, eventline):
+		"""Return the set of address= values matched by any address parameter of eventline,
+		such as ipaddr or udpaddr. Worked out once per event.
+		"""
+		am = self.addressMatcher()
+		cached = getattr(eventline, "addressMatches", None)
+		if cached and cached[0] is am: return cached[1]
+		found = set()
+		parms = eventline.parms
+		for k in parms.keys():
+			if k.endswith("addr"): found.update(am.lookup(parms[k]))
+		eventline.addressMatches = (am, found)
+		return found
+
 	@classmethod
 	def loadCustomCode(cls):
 		"""Load custom trigger code if it exists.
+		Its Trigger and Handler classes are found once here; see trigger_cc.load().
 		"""
 		reload(trigger_cc)
 
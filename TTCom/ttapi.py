@@ -20,12 +20,19 @@ with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-from time import sleep
+from time import sleep, time
 import re, socket
-import threading
+import threading, Queue
+from bisect import bisect_left, insort
 from tt_attrdict import AttrDict
 from parmline import ParmLine
 from conf import conf
+from indexes import FieldIndex, NgramIndex
+from directory import directory
+from snapshot import StateSnapshot
+from coalesce import Coalescer
+from eventfilter import EventFilter, QUIET, DROP
+from perfstats import PerfStats, timer
 
 class ServerState(object):
 	"""Connection states for a server.
@@ -113,6 +120,9 @@ class TeamTalkServerConnection(object):
 		self.disconnectReason = ""
 		self.threads = {}
 		self.curid = None
+		# When the unanswered ping was sent, and the last ping's round trip in seconds.
+		self.pingSent = None
+		self.pingRTT = None
 
 	def __del__(self):
 		"""Called when this object is garbage-collected.
@@ -125,10 +135,13 @@ class TeamTalkServerConnection(object):
 		self.shuttingDown = True
 		self.callback = None
 
-	def notifyCaller(self, msg):
+	def notifyCaller(self, msg, quiet=False):
 		"""Send msg (str or int) to the caller.
+		quiet is passed along only when True; see TeamtalkServer.processLine().
 		"""
-		if self.callback: self.callback(msg)
+		if not self.callback: return
+		if quiet: self.callback(msg, True)
+		else: self.callback(msg)
 
 	def newThread(self, target):
 		"""Start a new thread for this server connection.
@@ -282,6 +295,7 @@ class TeamTalkServerConnection(object):
 		This runs in its own thread.
 		"""
 		while not self.threadEnding():
+			if self.pingSent is None: self.pingSent = time()
 			try: self.sock.send("ping\r\n")
 			except socket.error as e:
 				self.disconnect("Error during ping: %s" % (str(e)))
@@ -329,7 +343,17 @@ class TeamTalkServerConnection(object):
 					self.curid = None
 				elif not self.curid and ll == "pong":
 					# Pongs sent as part of a user command should be in an id block.
+					if self.pingSent is not None:
+						self.pingRTT = time() -self.pingSent
+						self.pingSent = None
 					continue
+				elif not self.curid and self.parent.eventFilter:
+					# Command replies are never filtered.
+					verdict = self.parent.eventFilter.classify(ll)
+					if verdict == DROP: continue
+					if verdict == QUIET:
+						self.notifyCaller(line, True)
+						continue
 				self.notifyCaller(line)
 		except IOError as e: pass
 		# Connection failure by error or just end of stream.
@@ -370,6 +394,8 @@ class TeamtalkServer(object):
 		self.ev_loggedIn = threading.Event()
 		self.ev_loggedOut = threading.Event()
 		self.ev_idblockDone = threading.Event()
+		# Keeps commands from different threads from interleaving their replies.
+		self._requestLock = threading.RLock()
 		self.manualCM = False
 		self.lastError = None
 		self.curID = 0
@@ -377,6 +403,20 @@ class TeamtalkServer(object):
 		self.maxID = 127
 		self._collecting = 0
 		self._outputCollection = []
+		# Queue receiving response lines during a streamed collection; see sendWithStream().
+		self._stream = None
+		# Merges rapid updates when set; see setCoalescing().
+		self.coalescer = None
+		# Decides which events are parsed and reported; see setEventFilter().
+		self.eventFilter = None
+		# The thread dispatching a quiet event, whose output is suppressed; see processLine().
+		self._quietThread = None
+		# Event counts and timings, kept only while PerfStats.enabled is set.
+		self.perf = PerfStats()
+		# Running totals for metrics; see metrics.MetricsServer.
+		self.eventCounts = {}
+		self.reconnects = 0
+		self.commandTimeouts = 0
 		self.host = host
 		if not shortname: shortname = host
 		self.shortname = shortname
@@ -396,9 +436,14 @@ class TeamtalkServer(object):
 		self.loginParms = parms
 		self.disconnect()
 
+	# Least seconds between snapshots published by the event thread; see snapshot().
+	snapshotInterval = 0.05
+
 	def clear(self):
 		"""Clear this object (on init or disconnect).
 		"""
+		self._clearSnapshots()
+		if self.coalescer: self.coalescer.clear()
 		self.conn = None
 		self.waitID = 0
 		self.curID = 0
@@ -406,8 +451,16 @@ class TeamtalkServer(object):
 		self.ev_loggedOut.clear()
 		self.state = "disconnected"
 		self.info = AttrDict()
+		directory.removeServer(self)
 		self.channels = dict()
+		# Channels by path, for findChannels(); see _channelUpdated().
+		self.channelNgrams = NgramIndex()
 		self.users = dict()
+		# Users by the fields most often used to select them; see _userUpdated().
+		self.userIndex = FieldIndex(("channelid", "ipaddr", "usertype"))
+		# Users by name, username, IP address, and userid, for findUsers().
+		self.userNgrams = NgramIndex()
+		self._clearOccupancy()
 		self.files = dict()
 		self.me = None
 
@@ -502,14 +555,28 @@ class TeamtalkServer(object):
 		self.state = "loggedIn"
 		return True
 
-	def processLine(self, line):
+	def processLine(self, line, quiet=False):
 		"""Callback to process inbound text a line at a time.
 		Passed by connect() as the TeamTalkServerConnection callback for events.
 		Uses ParmLine to get eventname,parms (AttrDict) from the line,
 		then dispatches the event to a method named event_<eventname>.
 		If no such method exists for an event, handles this condition.
-		"""
+		If quiet is True, the event only updates state:
+		it produces no output and is not passed to hookEvents().
+		"""
+		if quiet:
+			self._quietThread = threading.current_thread()
+			try: return self.processLine(line)
+			finally: self._quietThread = None
+		window = PerfStats.profileWindow
+		if window and not window.isRunning():
+			return window.run(self.processLine, line)
+		timing = PerfStats.enabled
+		if timing: started = timer()
 		parmline = ParmLine(line)
+		if timing: parsed = timer()
+		counts = self.eventCounts
+		counts[parmline.event] = counts.get(parmline.event, 0) +1
 		# When collecting text, don't dispatch events.
 		if self._handleCollection(parmline):
 			return
@@ -519,7 +586,14 @@ class TeamtalkServer(object):
 			and parmline.event in ["begin", "end"]
 			and parmline.parms.id == str(self.waitID)
 		)
-		if not isOurBlockMarker:
+		parmline.coalesced = None
+		quiet = self._quietThread is not None
+		if self.coalescer and self.state == "loggedIn" and not quiet:
+			cw = self.coalescer.check(parmline)
+			if cw:
+				# Handlers see this on parms, hooks on parmline.
+				parmline.coalesced = parmline.parms._coalesced = cw
+		if not isOurBlockMarker and not quiet:
 			self.hookEvents(parmline, False)
 		# Protect from rogue transmissions, or somebody could execute random code here.
 		# This would require a custom TeamTalk server though.
@@ -532,6 +606,8 @@ class TeamtalkServer(object):
 		except:
 			self.errorFromEvent("Unrecognized line:  %s" % (line))
 			return
+		if timing: dispatched = timer()
+		self._seq += 1
 		try:
 			if not eventFunc(parmline.parms):
 				self.outputFromEvent(line.rstrip())
@@ -539,13 +615,19 @@ class TeamtalkServer(object):
 			self.errorFromEvent("Event dispatch failure: %s\n    Error: %s" % (line,
 				str(e)
 			))
-		if not isOurBlockMarker:
+		finally:
+			self._seq += 1
+		self._publishSnapshot()
+		if timing:
+			self.perf.recordLine(parmline.event, parsed -started, timer() -dispatched)
+		if not isOurBlockMarker and not quiet:
 			self.hookEvents(parmline, True)
 
 	def _handleRecycling(self, force=False):
 		"""Handle autoLogin-on-logout as appropriate.
 		"""
 		if force or (self.autoLogin and not self.manualCM):
+			self.reconnects += 1
 			self.outputFromEvent("Reconnecting")
 			task = lambda: self.login(True)
 			th = threading.Timer(5, task)
@@ -564,6 +646,8 @@ class TeamtalkServer(object):
 		When the response block is done, this method resets waitID to 0.
 		sendWithWait() watches for this then collects the output by calling self._stopCollecting().
 		_stopCollecting() returns the collected output and clears it.
+		sendWithStream() collects the same way but has lines passed to it
+		through self._stream as they arrive; None there signals the end.
 		"""
 		isConnect = (parmline.event == "_connected_")
 		isDisconnect = (parmline.event == "_disconnected_")
@@ -589,6 +673,7 @@ class TeamtalkServer(object):
 				# TODO: Might need to do more here.
 				self._collecting = 0
 				self.waitID = 0
+				self._endStream()
 				self.ev_idblockDone.set()
 			# Handle this line normally even if it cut short a response collection.
 			return False
@@ -598,6 +683,7 @@ class TeamtalkServer(object):
 			# End of response line set.
 			self._collecting = 0
 			self.waitID = 0
+			self._endStream()
 			if isConnect or isDisconnect:
 				self.errorFromEvent("Output collection truncated by server connection interruption")
 				self.ev_idblockDone.set()
@@ -607,10 +693,24 @@ class TeamtalkServer(object):
 			# Eat the closing "end id=..." event.
 			return True
 		# Not end of set, so collect the line.
-		self._outputCollection.append(parmline)
+		self._collect(parmline)
 		# And don't pass it through as an event to process now.
 		return True
 
+	def _collect(self, parmline):
+		"""Add one line to the response being collected.
+		For a streamed collection this waits while the reader is too far behind.
+		"""
+		stream = self._stream
+		if stream is None: self._outputCollection.append(parmline)
+		else: stream.put(parmline)
+
+	def _endStream(self):
+		"""Signal the end of a streamed collection, if one is in progress.
+		"""
+		stream = self._stream
+		if stream is not None: stream.put(None)
+
 	def hookEvents(self, parmline, afterDispatch):
 		"""Stub that subclasses can override for multi-event processing.
 		This method is called twice per event:
@@ -643,6 +743,23 @@ class TeamtalkServer(object):
 		the form of a list of ParmLine objects.
 		See _handleCollection() for a description of the response collection process.
 		IOErrors and EOF cause a connection reset but also bubble up.
+		Commands from different threads wait their turn, except that
+		the thread reading from the server never waits for another
+		thread's reply, since that reply could not arrive until it returned.
+		"""
+		if self.inWatcher():
+			return self._sendWithWait(line, returnResults)
+		with self._requestLock:
+			return self._sendWithWait(line, returnResults)
+
+	def inWatcher(self):
+		"""Returns True if called from the thread that reads from this server.
+		"""
+		try: return threading.current_thread() is self.conn.threads.get("watcher")
+		except AttributeError: return False
+
+	def _sendWithWait(self, line, returnResults=False):
+		"""Does the work for sendWithWait().
 		"""
 		self.curID += 1
 		if self.curID > self.maxID:
@@ -660,16 +777,108 @@ class TeamtalkServer(object):
 			# Break any waiting code so everything can restart.
 			raise
 		if not self.waitOn(self.ev_idblockDone, 8):
+			self.commandTimeouts += 1
 			self.errorFromEvent("Timeout on %s command" % (line.split(None, 1)[0]))
 			self.waitID = 0
 		if returnResults:
 			return self._stopCollecting()
 
+	def sendWithStream(self, line, maxBuffer=1000, timeout=8):
+		"""Send a command to this server and yield its response lines as they arrive.
+		This is a generator of ParmLine objects and otherwise works like
+		sendWithWait(line, True), but the response is never held in full:
+		at most maxBuffer lines wait for the caller, and the server reader
+		waits when that many are pending.
+		timeout is the longest wait in seconds for any one line.
+		If the caller stops early, the rest of the response is read and discarded
+		before another command can be sent.
+		"""
+		if self.inWatcher():
+			# Lines could not arrive while this thread waits for them.
+			for parmline in self.sendWithWait(line, True):
+				yield parmline
+			return
+		self._requestLock.acquire()
+		try:
+			self.curID += 1
+			if self.curID > self.maxID:
+				self.curID = 1
+			line = str(line).rstrip()
+			line += " id={0:0d}".format(self.curID)
+			stream = Queue.Queue(maxBuffer)
+			self._stream = stream
+			self._startCollecting(self.curID)
+			try: self.send(line)
+			except IOError:
+				self._stream = None
+				self._collecting = 0
+				self.waitID = 0
+				# Connection failure.
+				self.disconnect()
+				# Break any waiting code so everything can restart.
+				raise
+			done = False
+			try:
+				while True:
+					try: parmline = stream.get(True, timeout)
+					except Queue.Empty:
+						self.commandTimeouts += 1
+						self.errorFromEvent("Timeout on %s command" % (line.split(None, 1)[0]))
+						break
+					if parmline is None:
+						done = True
+						break
+					yield parmline
+			finally:
+				# Drain whatever the caller did not take.
+				while not done:
+					try: done = (stream.get(True, timeout) is None)
+					except Queue.Empty: break
+				self._stream = None
+				self._collecting = 0
+				self.waitID = 0
+		finally:
+			self._requestLock.release()
+
+	# User fields that nonEmptyNickname() results depend on.
+	nameFields = ("nickname", "username", "usertype", "ipaddr", "udpaddr", "userid")
+
 	def nonEmptyNickname(self, user, forceDetails=False, includeUserType=False):
 		"""Make sure not to output a null string for a user with no nickname.
 		This method can handle user and ban parmlines as input.
 		forceDetails causes userid and IP address to be included.
 		If includeUserType is True, "User" or "Admin" will precede the user information.
+		Results are cached on the user record until updateParms() changes one of nameFields.
+		"""
+		return self._cachedName(user, (forceDetails, includeUserType))
+
+	def nicknameKey(self, user, forceDetails=False):
+		"""Return the lower-case form of nonEmptyNickname(user, forceDetails),
+		for sorting and matching users. Cached like nonEmptyNickname().
+		"""
+		return self._cachedName(user, (forceDetails, False, True))
+
+	def _cachedName(self, user, key):
+		"""Return a name for user from its cache, making and caching it if necessary.
+		key is (forceDetails, includeUserType[, lowercase]).
+		updateParms() replaces the cache rather than clearing it,
+		so a name made from old field values lands in a discarded cache.
+		"""
+		try: names = user._names
+		except AttributeError:
+			names = {}
+			# Plain dicts can't cache, so they just get a fresh name each time.
+			try: user._names = names
+			except AttributeError: pass
+		name = names.get(key)
+		if name is None:
+			if len(key) > 2: name = self._makeName(user, *key[:2]).lower()
+			else: name = self._makeName(user, *key)
+			names[key] = name
+		return name
+
+	def _makeName(self, user, forceDetails, includeUserType):
+		"""Does the work for nonEmptyNickname().
 		"""
 		nickname = user.get("nickname")
 		username = user.get("username")
@@ -730,7 +939,7 @@ class TeamtalkServer(object):
 		"""Indicate if output is being collected and collect it if so.
 		"""
 		if self._collecting == 2:
-			self._outputCollection.append(ParmLine(line))
+			self._collect(ParmLine(line))
 			return True
 		return False
 
@@ -768,7 +977,9 @@ class TeamtalkServer(object):
 
 	def outputFromEvent(self, line, raw=False):
 		"""For event output. See output() for details.
+		Says nothing while a quiet event is dispatched.
 		"""
+		if self._quietThread is threading.current_thread(): return
 		self.output(line, raw, fromEvent=True)
 
 	def errorFromEvent(self, line, raw=False):
@@ -786,38 +997,28 @@ class TeamtalkServer(object):
 				state += "/" +self.conn.state
 			self.output(state)
 			return
-		users = filter(lambda u: u.userid != self.me.userid, self.users.values())
-		if not len(users):
+		if not self.otherUserCount:
 			self.output("No users are connected.")
 			return
-		activeChannels = {}
-		for user in users:
-			channel = user.get("channel")
-			if channel is None:
-				cid = user.get("chanid")
-				if cid: channel = self.channels[cid].channel
-			activeChannels.setdefault(channel, [])
-			activeChannels[channel].append(self.nonEmptyNickname(user))
+		occupancy = self.occupancy
+		nusers = sum([len(members) for members in occupancy.values()])
+		nchannels = len(occupancy) -(None in occupancy)
+		inChannels = sorted([(self.occupancyPath(channel), members)
+			for channel,members in occupancy.items() if channel is not None
+		])
 		lines = []
-		nchannels = 0
-		nusers = 0
-		for channel in sorted(activeChannels):
-			people = activeChannels[channel]
-			people.sort(key=lambda p: p.lower())
-			n = len(people)
-			nusers += n
-			if channel:
-				nchannels += 1
-				lines.append("    %s (%d): %s" % (
-					self.channelname(channel, True),
-					n,
-					", ".join(people)
-				))
-			else:
-				lines.append("    %d not in a channel: %s" % (
-					n,
-					", ".join(people)
-				))
+		if None in occupancy:
+			people = occupancy[None]
+			lines.append("    %d not in a channel: %s" % (
+				len(people),
+				", ".join([p[2] for p in people])
+			))
+		for path,people in inChannels:
+			lines.append("    %s (%d): %s" % (
+				self.channelname(path, True),
+				len(people),
+				", ".join([p[2] for p in people])
+			))
 		lines.insert(0, "Users %d, active channels %d:" % (nusers, nchannels))
 		self.output("\n".join(lines))
 
@@ -832,7 +1033,8 @@ class TeamtalkServer(object):
 				state += "/" +self.conn.state
 			self.output(state)
 			return
-		users = filter(lambda u: u.userid != self.me.userid, self.users.values())
+		snap = self.snapshot()
+		users = snap.others()
 		if not len(users):
 			self.output("No users are connected.")
 			return
@@ -850,14 +1052,14 @@ class TeamtalkServer(object):
 			if protocol is None: protocol = "pp<unknown>"
 			else: protocol = "pp{0}".format(protocol)
 			version = "{0} {1} {2}".format(protocol, version, client).strip()
-			versions.setdefault(version, set())
-			versions[version].add(self.nonEmptyNickname(user))
+			versions.setdefault(version, {})
+			versions[version][self.nonEmptyNickname(user)] = self.nicknameKey(user)
 		lines = []
 		nversions = 0
 		nusers = 0
 		for version in sorted(versions):
-			people = list(versions[version])
-			people.sort(key=lambda p: p.lower())
+			people = versions[version]
+			people = sorted(people, key=people.get)
 			n = len(people)
 			nusers += n
 			if version:
@@ -899,13 +1101,315 @@ class TeamtalkServer(object):
 			]
 		return bitnames
 
+	def _userUpdated(self, user):
+		"""Keep the user indexes current after user is added or changed.
+		Event handlers call this after every change to a user record.
+		"""
+		self.userIndex.update(user.userid, user)
+		self.userNgrams.update(user.userid, self.nicknameKey(user, True))
+		directory.update(self, user)
+		self._place(user)
+		self._dirtyUsers.add(user.userid)
+		self._changes += 1
+
+	def _userRemoved(self, userid):
+		"""Drop a user from the user indexes.
+		"""
+		self.userIndex.remove(userid)
+		self.userNgrams.remove(userid)
+		directory.remove(self, userid)
+		self._unplace(userid)
+		self._dirtyUsers.add(userid)
+		self._changes += 1
+
+	def _channelUpdated(self, chan):
+		"""Keep the channel index current after chan is added or changed.
+		"""
+		try: name = self.channelname(chan.channelid)
+		except (KeyError, TypeError, AttributeError): name = chan.get("channel") or ""
+		self.channelNgrams.update(chan.channelid, name)
+		self._dirtyChannels.add(chan.channelid)
+		self._changes += 1
+
+	def _channelRemoved(self, chanid):
+		"""Drop a channel from the channel index.
+		"""
+		self.channelNgrams.remove(chanid)
+		self._dirtyChannels.add(chanid)
+		self._changes += 1
+
+	def pingRTT(self):
+		"""Return the round trip time in seconds of the last keep-alive ping, or None if there is none yet.
+		"""
+		conn = self.conn
+		if not conn: return None
+		return conn.pingRTT
+
+	def setEventFilter(self, include=None, exclude=None):
+		"""Set which events this server parses and reports.
+		include and exclude are dicts as returned by eventfilter.parseRules();
+		when both are empty, every event is handled.
+		Lines that needsLine() says are needed are handled regardless.
+		"""
+		flt = EventFilter(include, exclude, self.needsLine)
+		if not flt: flt = None
+		self.eventFilter = flt
+
+	@classmethod
+	def eventNames(cls):
+		"""Return the names of the events this class handles.
+		"""
+		return [name[6:] for name in dir(cls) if name.startswith("event_")]
+
+	def needsLine(self, event, line):
+		"""Stub that subclasses can override to keep lines from being filtered out.
+		event is the line's event name, and line is stripped and lower-cased.
+		"""
+		return False
+
+	def setCoalescing(self, windows, triggers="each", detail="net"):
+		"""Merge rapid updates about the same user or channel.
+		windows maps event names to window lengths in seconds; see coalesce.Coalescer
+		for triggers and detail. An empty windows turns coalescing off.
+		"""
+		if not windows:
+			self.coalescer = None
+			return
+		self.coalescer = Coalescer(self, windows, triggers, detail)
+
+	def coalescedRecord(self, key):
+		"""Return the live user or channel record for a coalescing key, or None if it is gone.
+		"""
+		event,id = key
+		if event == "updateuser": return self.users.get(id)
+		return self.channels.get(id)
+
+	def flushCoalesced(self, cw):
+		"""Report the updates merged in a closed coalescing window.
+		Called from the coalescer's thread, so it works from a copy of the record.
+		"""
+		record = self.coalescedRecord(cw.key)
+		if record is None: return
+		current = AttrDict(record)
+		if cw.key[0] == "updateuser": category = self.nonEmptyNickname(current)
+		else: category = current.channel
+		if cw.keepDetails: buf = "; ".join(cw.details)
+		else: buf = self.describeChanges(cw.base, current)
+		if buf:
+			self.outputFromEvent("%s: %s (%d updates merged)" % (category, buf, cw.count))
+		self.hookCoalesced(cw, current)
+
+	def hookCoalesced(self, cw, record):
+		"""Stub that subclasses can override to log or trigger on a flushed coalescing window.
+		record is a copy of the user or channel as of the flush.
+		"""
+		pass
+
+	def _clearOccupancy(self):
+		"""Start the channel occupancy counts over; see _place().
+		"""
+		# Channel (id, or path if the server gives one) -> sorted list of
+		# (nicknameKey, userid, nonEmptyNickname) for its users, None for no channel.
+		# Changed in place by the event thread; readers use the occupancy property.
+		self._members = {}
+		# Channel -> the change count when its members last changed, and
+		# channel -> (that count, tuple of its members) as last given to a reader.
+		self._memberVersions = {}
+		self._frozenMembers = {}
+		self._occupancyChanges = 0
+		# userid -> (channel, entry in _members).
+		self._placement = {}
+		# Users other than this client, and channels with any of them in.
+		self.otherUserCount = 0
+		self.activeChannelCount = 0
+
+	def _place(self, user):
+		"""Keep the channel occupancy counts current after user is added or changed.
+		This client's own user is not counted.
+		"""
+		userid = user.userid
+		if self.me and userid == self.me.userid: return
+		channel = user.get("channel") or user.get("channelid") or None
+		entry = (self.nicknameKey(user), userid, self.nonEmptyNickname(user))
+		old = self._placement.get(userid)
+		if old == (channel, entry): return
+		if old: self._removeOccupant(*old)
+		else: self.otherUserCount += 1
+		self._placement[userid] = (channel, entry)
+		members = self._members.get(channel)
+		if members is None:
+			members = self._members[channel] = []
+			if channel is not None: self.activeChannelCount += 1
+		insort(members, entry)
+		self._membersChanged(channel)
+
+	def _unplace(self, userid):
+		"""Remove a user from the channel occupancy counts.
+		"""
+		old = self._placement.pop(userid, None)
+		if not old: return
+		self.otherUserCount -= 1
+		self._removeOccupant(*old)
+
+	def _removeOccupant(self, channel, entry):
+		members = self._members.get(channel)
+		if members is None: return
+		i = bisect_left(members, entry)
+		if i < len(members) and members[i] == entry: del members[i]
+		if members:
+			self._membersChanged(channel)
+			return
+		del self._members[channel]
+		self._memberVersions.pop(channel, None)
+		self._frozenMembers.pop(channel, None)
+		if channel is not None: self.activeChannelCount -= 1
+
+	def _membersChanged(self, channel):
+		# Counts are never reused, so a reader can't keep a tuple made before a change.
+		self._occupancyChanges += 1
+		self._memberVersions[channel] = self._occupancyChanges
+
+	@property
+	def occupancy(self):
+		"""Return a dict of channel (id, or path if the server gives one) to a sorted tuple
+		of (nicknameKey, userid, nonEmptyNickname) for its users, None for no channel.
+		This client's own user is not included. Tuples are made only for
+		channels that changed since the last call, and are never changed,
+		so the result can be used from any thread without locking.
+		"""
+		versions = self._memberVersions
+		frozen = self._frozenMembers
+		result = {}
+		for channel,members in self._members.items():
+			version = versions.get(channel)
+			cached = frozen.get(channel)
+			if cached is None or cached[0] != version:
+				# Read the version first: a change during the copy makes it stale next time.
+				cached = (version, tuple(members))
+				frozen[channel] = cached
+			result[channel] = cached[1]
+		return result
+
+	def occupancyPath(self, channel):
+		"""Return the channel path for an occupancy key.
+		"""
+		if channel.startswith("/"): return channel
+		chan = self.channels.get(channel)
+		if chan and chan.channel: return chan.channel
+		try: return self.channelname(channel, False, True)
+		except (KeyError, TypeError): return channel
+
+	def _clearSnapshots(self):
+		"""Start snapshots over, as when users and channels are replaced wholesale.
+		"""
+		# _changes counts changes to users and channels.
+		# _seq is odd while an event is being dispatched, for snapshot().
+		self._changes = getattr(self, "_changes", 0) +1
+		self._seq = getattr(self, "_seq", 0) +2
+		self._dirtyUsers = set()
+		self._dirtyChannels = set()
+		self._snapshot = None
+		self._publishedAt = 0
+
+	def _publishSnapshot(self, force=False):
+		"""Publish a snapshot of users and channels if they changed since the last one.
+		Called by the event thread between events, when nothing is changing;
+		at most one snapshot is made per snapshotInterval unless force is True.
+		Only records changed since the last snapshot are copied.
+		"""
+		snap = self._snapshot
+		if snap is not None and snap.version == self._changes: return
+		if not force:
+			# Logins bring a flood of events; publish once they are done.
+			if self.state == "loggingIn": return
+			if time() -self._publishedAt < self.snapshotInterval: return
+		version = self._changes
+		meID = self.me.userid if self.me else None
+		userids,self._dirtyUsers = self._dirtyUsers,set()
+		chanids,self._dirtyChannels = self._dirtyChannels,set()
+		if snap is None:
+			snap = StateSnapshot.copyOf(self.users, self.channels, meID, version)
+		else:
+			snap = snap.updated(self.users, self.channels, userids, chanids, meID, version)
+		self._snapshot = snap
+		self._publishedAt = time()
+
+	def snapshot(self):
+		"""Return a StateSnapshot of this server's users and channels.
+		Code outside the event thread should read users and channels from
+		this rather than iterating self.users and self.channels.
+		The event thread's latest snapshot is returned if it is current.
+		Otherwise a new one is copied here, and the copy is retried if an event
+		was dispatched meanwhile, so the result is never a mix of before and after.
+		Nothing here blocks the event thread.
+		"""
+		snap = self._snapshot
+		if snap is not None and snap.version == self._changes: return snap
+		copy = None
+		for i in range(5):
+			seq = self._seq
+			if seq % 2:
+				# An event is being dispatched.
+				sleep(0.001)
+				continue
+			version = self._changes
+			meID = self.me.userid if self.me else None
+			copy = StateSnapshot.copyOf(self.users, self.channels, meID, version)
+			if self._seq == seq: return copy
+		# Events are arriving too fast to copy between them.
+		if snap is not None: return snap
+		if copy is not None: return copy
+		# Nothing published yet, as during a login: a copy taken mid-event
+		# beats none, and items() copies each dict in one step.
+		meID = self.me.userid if self.me else None
+		return StateSnapshot.copyOf(self.users, self.channels, meID, self._changes)
+
+	def findUsers(self, text):
+		"""Return the users whose nonEmptyNickname(user, True) contains text, case ignored.
+		This covers nicknames, usernames, IP addresses, and userids.
+		"""
+		users = self.users
+		return [users[userid] for userid in self.userNgrams.search(text) if userid in users]
+
+	def findChannels(self, text):
+		"""Return the channels whose channelname() contains text, case ignored.
+		"""
+		channels = self.channels
+		return [channels[chanid] for chanid in self.channelNgrams.search(text) if chanid in channels]
+
 	def updateParms(self, category, parms, newParms, silent=False):
 		"""Update parms with newParms and report changes as appropriate.
 		"""
 		oldParms = parms.copy()
 		parms.update(newParms)
+		if hasattr(parms, "_names"):
+			for k in self.nameFields:
+				if oldParms.get(k) != parms.get(k):
+					# Names cached by nonEmptyNickname() are out of date.
+					parms._names = {}
+					break
 		self.reportUDPMasquerading(oldParms, parms)
 		if silent: return
+		cw = getattr(newParms, "_coalesced", None)
+		if cw is not None:
+			# Reported with the rest of its coalescing window; see flushCoalesced().
+			if cw.keepDetails: cw.addDetail(self.describeChanges(oldParms, parms))
+			return
+		self.reportChanges(category, oldParms, parms)
+
+	def reportChanges(self, category, oldParms, parms):
+		"""Report what changed from oldParms to parms, prefixed by category if given.
+		"""
+		buf = self.describeChanges(oldParms, parms)
+		if not buf: return
+		if category:
+			buf = "%s: %s" % (category, buf)
+		self.outputFromEvent(buf)
+
+	def describeChanges(self, oldParms, parms):
+		"""Return a description of what changed from oldParms to parms,
+		or an empty string if nothing worth reporting changed.
+		"""
 		all = set(oldParms) & set(parms)
 		buf = []
 		statusDone = False
@@ -982,11 +1486,7 @@ class TeamtalkServer(object):
 						continue
 				self.includeUpdate(buf, k, v1, v2)
 			else: continue
-		buf = ", ".join(buf)
-		if not buf: return
-		if category:
-			buf = "%s: %s" % (category, buf)
-		self.outputFromEvent(buf)
+		return ", ".join(buf)
 
 	def addrAndPort(self, udpaddr):
 		"""Split and return address and port out of a UDP address.
@@ -1274,6 +1774,7 @@ class TeamtalkServer(object):
 		self.users.setdefault(userid, AttrDict())
 		self.me = self.users[userid]
 		self.me["userid"] = userid
+		self._userUpdated(self.me)
 		return True
 
 	def event_ok(self, parms):
@@ -1298,6 +1799,7 @@ class TeamtalkServer(object):
 		For the signal of successful login completion, see the "ok" event.
 		"""
 		self.updateParms("Login accepted", self.users[parms['userid']], parms)
+		self._userUpdated(self.users[parms.userid])
 		udpaddr = self.users.values()[0].get("udpaddr")
 		if (not udpaddr
 		or udpaddr == "[::]:0"
@@ -1324,6 +1826,7 @@ class TeamtalkServer(object):
 		# For when someone pulls a list of users from several servers at once.
 		self.users[parms['userid']].server = self
 		self.updateParms("Logged in", self.users[parms['userid']], parms)
+		self._userUpdated(self.users[parms.userid])
 		if (self.state != "loggingIn"
 		and (self.users[parms.userid].nickname)):
 			self.outputFromEvent("%s logged in" %
@@ -1342,6 +1845,7 @@ class TeamtalkServer(object):
 		"""
 		self.channels.setdefault(parms.channelid, AttrDict())
 		self.updateParms("Add channel", self.channels[parms['channelid']], parms)
+		self._channelUpdated(self.channels[parms.channelid])
 		# Only show channel creations if we're not logging in right now.
 		# Otherwise there's quite a flood of these on some servers.
 		if self.state != "loggingIn":
@@ -1353,6 +1857,7 @@ class TeamtalkServer(object):
 		"""
 		self.outputFromEvent("Removed channel %s" % (self.channels[parms.channelid].channel))
 		del self.channels[parms['channelid']]
+		self._channelRemoved(parms.channelid)
 		return True
 
 	def event_updatechannel(self, parms):
@@ -1362,6 +1867,7 @@ class TeamtalkServer(object):
 		name = chan.channel
 		self.updateParms(name, self.channels[parms.channelid], parms)
 		if self.is5(): self._updateChannelValue(chan)
+		self._channelUpdated(chan)
 		return True
 
 	def _updateChannelValue(self, chan):
@@ -1391,6 +1897,7 @@ class TeamtalkServer(object):
 			self.users[parms['userid']].temporary = True
 		else:
 			self.updateParms("Add user", user, parms, True)
+		self._userUpdated(user)
 		if self.state != "loggingIn":
 			issues = ""
 			self.outputFromEvent("%s joined %s" % (
@@ -1414,6 +1921,9 @@ class TeamtalkServer(object):
 			# This user record sprang up on a channel join,
 			# which means this server hides users until you join their channel.
 			del self.users[parms.userid]
+			self._userRemoved(parms.userid)
+		else:
+			self._userUpdated(u)
 		return True
 
 	def event_loggedout(self, parms):
@@ -1424,11 +1934,18 @@ class TeamtalkServer(object):
 			self.outputFromEvent("You are logged out")
 			self.state = "connected"
 			self.channels = dict()
+			self.channelNgrams.clear()
 			self.users = dict()
+			self.userIndex.clear()
+			self.userNgrams.clear()
+			directory.removeServer(self)
+			self._clearSnapshots()
+			self._clearOccupancy()
 			userid = self.info.userid
 			self.users.setdefault(userid, AttrDict())
 			self.me = self.users[userid]
 			self.me["userid"] = userid
+			self._userUpdated(self.me)
 			self.ev_loggedIn.clear()
 			self.ev_loggedOut.set()
 			self._handleRecycling()
@@ -1436,6 +1953,7 @@ class TeamtalkServer(object):
 		if self.users[parms.userid].nickname:
 			self.outputFromEvent("%s logged out" % (self.nonEmptyNickname(self.users[parms.userid], False, True)))
 		del self.users[parms['userid']]
+		self._userRemoved(parms.userid)
 		return True
 
 	def logout(self):
@@ -1472,6 +1990,7 @@ class TeamtalkServer(object):
 		else:
 			name = self.nonEmptyNickname(self.users[parms.userid])
 			self.updateParms(name, self.users[parms['userid']], parms)
+		self._userUpdated(user)
 		return True
 
 	def event_messagedeliver(self, parms):
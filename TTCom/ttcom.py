@@ -12,7 +12,7 @@ The iniparse module is under separate license and copyright;
 see that file for details.
 """
 
-import sys, threading
+import sys, threading, socket
 from TTComCmd import TTComCmd
 # More for command-line Python support.
 import os, time
@@ -25,10 +25,13 @@ if __name__ == "__main__":
 	# Keep args out of the cmd system.
 	del sys.argv[1:]
 	noAutoLogins = False
+	daemon = False
 	shortnames = []
 	for arg in args:
 		if arg == "-n":
 			noAutoLogins = True
+		elif arg == "-d":
+			daemon = True
 		else:
 			noAutoLogins = True
 			shortnames.append(arg)
@@ -37,4 +40,14 @@ if __name__ == "__main__":
 	if shortnames:
 		cur = shortnames[-1]
 		app.onecmd("server " +cur)
-	app.run()
+	if daemon:
+		# Headless: commands come from the control socket instead of a terminal.
+		from daemon import ControlServer
+		path = conf.option("control") or "ttcom.sock"
+		try: control = ControlServer(app, path)
+		except socket.error as e:
+			sys.exit("Can't listen on %s: %s" % (path, str(e)))
+		print "Listening on " +path
+		control.serve()
+	else:
+		app.run()